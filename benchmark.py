@@ -0,0 +1,646 @@
+# benchmark.py
+"""Load and benchmark suite for the file server's browse, tree, upload, stream and zip paths.
+
+Builds a synthetic tree (a wide directory, a deep chain, many small files and
+a few huge ones) and drives the app through Flask's test client in this
+process, through a main.py it starts itself (--server), or over HTTP against
+a server that is already running (--url). Each scenario reports throughput
+and p50/p95/p99 latency, and the whole run is written to a JSON file that
+--compare checks a later run against.
+
+    python benchmark.py --scale 0.1
+    python benchmark.py --server --server-args="--workers 4" --output after.json --compare before.json
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import uuid
+import shutil
+import random
+import signal
+import socket
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import quote, urlencode, urlsplit
+
+import main
+
+# --- Configuration ---
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+SCENARIOS = ('browse', 'tree', 'upload', 'stream', 'zip')
+TREE_SPEC_FILE = '.benchmark-tree.json' # Written into a generated tree so later runs with the same spec reuse it
+BENCH_USERNAME = 'benchmark'
+BENCH_PASSWORD = 'benchmark'
+ACCEPT_ENCODING = 'gzip, deflate, br, zstd' # What browsers send, so JSON responses are compressed as they would be
+BLOCK_SIZE = 1024 * 1024 # Random data is generated a block at a time and rotated to make files and chunks
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # The smallest chunk size the browser client picks
+STREAM_RANGE_SIZE = 1024 * 1024 # Bytes asked for by each ranged /stream request, about what a media player seeks for
+READ_SIZE = 1024 * 1024
+SERVER_START_TIMEOUT = 30 # Seconds a started server gets to accept connections
+INDEX_WAIT_TIMEOUT = 600 # Seconds to wait for a started server to finish indexing the tree
+
+def tree_spec(scale):
+    """Sizes of the synthetic tree; scale 1 is about 650 MB on disk."""
+    def scaled(n):
+        return max(1, int(n * scale))
+    return {
+        'wide_files': scaled(20000), # Files in the one wide directory
+        'wide_max_size': 4096,
+        'deep_levels': scaled(64), # Nesting depth of the deep chain
+        'deep_files': 8, # Files on each level of the deep chain
+        'small_dirs': scaled(50),
+        'small_files': 200, # Files in each of the small_dirs
+        'small_max_size': 16 * 1024,
+        'huge_files': 2,
+        'huge_size': scaled(256 * 1024 * 1024),
+    }
+
+# --- Synthetic Tree ---
+def generate_tree(root, spec, seed):
+    """Create the tree under root, returning False if an earlier run already made the same one there."""
+    marker = os.path.join(root, TREE_SPEC_FILE)
+    wanted = dict(spec, seed=seed)
+    try:
+        with open(marker) as f:
+            if json.load(f) == wanted:
+                return False
+    except (OSError, ValueError):
+        pass
+    if os.path.isdir(root) and os.listdir(root) and not os.path.exists(marker):
+        raise SystemExit(f"{root} is not empty and wasn't made by this benchmark; pick an empty directory with --tree.")
+    for name in ('wide', 'deep', 'small', 'huge', 'uploads'):
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    rng = random.Random(seed)
+    block = rng.randbytes(BLOCK_SIZE)
+    words = [rng.randbytes(rng.randrange(2, 8)).hex() for _ in range(512)]
+
+    wide = os.path.join(root, 'wide')
+    os.makedirs(wide)
+    for i in range(spec['wide_files']):
+        write_file(os.path.join(wide, f"file-{i:06}.dat"), rotated(block, rng.randrange(BLOCK_SIZE), rng.randrange(spec['wide_max_size'])))
+
+    level = os.path.join(root, 'deep')
+    for depth in range(spec['deep_levels']):
+        level = os.path.join(level, f"level-{depth:03}")
+        os.makedirs(level)
+        for i in range(spec['deep_files']):
+            write_file(os.path.join(level, f"file-{i}.txt"), text_content(rng, words, rng.randrange(spec['small_max_size'])))
+
+    for d in range(spec['small_dirs']):
+        directory = os.path.join(root, 'small', f"dir-{d:03}")
+        os.makedirs(directory)
+        for i in range(spec['small_files']):
+            size = rng.randrange(spec['small_max_size'])
+            if i % 2:
+                write_file(os.path.join(directory, f"file-{i:04}.bin"), rotated(block, rng.randrange(BLOCK_SIZE), size))
+            else:
+                write_file(os.path.join(directory, f"file-{i:04}.txt"), text_content(rng, words, size))
+
+    huge = os.path.join(root, 'huge')
+    os.makedirs(huge)
+    for i in range(spec['huge_files']):
+        with open(os.path.join(huge, f"huge-{i}.bin"), 'wb') as f:
+            for offset in range(0, spec['huge_size'], BLOCK_SIZE):
+                f.write(rotated(block, rng.randrange(BLOCK_SIZE), min(BLOCK_SIZE, spec['huge_size'] - offset)))
+
+    with open(marker, 'w') as f:
+        json.dump(wanted, f)
+    return True
+
+def rotated(block, shift, size):
+    """size bytes of block starting at shift, wrapping around, so files differ without generating new random data."""
+    data = block[shift:] + block[:shift]
+    return data[:size]
+
+def text_content(rng, words, size):
+    """Roughly size bytes of space-separated words, compressible like real text."""
+    text = ' '.join(rng.choices(words, k=size // 8 + 1)).encode()
+    return text[:size]
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def tree_files(root, directory):
+    return sorted(os.path.join(root, directory, name) for name in os.listdir(os.path.join(root, directory)))
+
+# --- Clients ---
+class InProcessClient:
+    """Requests through Flask's test client, so only the app's own work is measured."""
+
+    def __init__(self, username, password):
+        self.client = main.app.test_client()
+        response = self.client.post('/login', data={'username': username, 'password': password})
+        if response.status_code != 302:
+            raise SystemExit(f"Login as {username} failed with status {response.status_code}.")
+
+    def request(self, method, path, headers=None, body=None):
+        """Send a request and read the whole response, returning (status, body length, body if it is JSON)."""
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        try:
+            if response.mimetype == 'application/json':
+                data = response.get_data()
+                return response.status_code, len(data), decode_json(data, response.headers.get('Content-Encoding'))
+            return response.status_code, sum(len(chunk) for chunk in response.iter_encoded()), None
+        finally:
+            response.close()
+
+class HttpClient:
+    """Requests over one keep-alive connection to a running server, as a browser tab would make them."""
+
+    def __init__(self, base_url, username, password):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.cookies = {}
+        self.connection = None
+        status, _, _ = self.request('POST', '/login', {'Content-Type': 'application/x-www-form-urlencoded'},
+                                    urlencode({'username': username, 'password': password}).encode())
+        if status != 302:
+            raise SystemExit(f"Login as {username} failed with status {status}.")
+
+    def request(self, method, path, headers=None, body=None):
+        """Send a request and read the whole response, returning (status, body length, body if it is JSON)."""
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{name}={value}" for name, value in self.cookies.items())
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=600)
+            try:
+                self.connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                self.connection.close()
+                self.connection = None # The server closed an idle keep-alive connection; reconnect once
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        if response.getheader('Content-Type', '').startswith('application/json'):
+            data = response.read()
+            return response.status, len(data), decode_json(data, response.getheader('Content-Encoding'))
+        length = 0
+        while chunk := response.read(READ_SIZE):
+            length += len(chunk)
+        return response.status, length, None
+
+def decode_json(data, encoding):
+    if encoding == 'gzip':
+        data = gzip.decompress(data)
+    elif encoding == 'br':
+        data = main.brotli.decompress(data)
+    elif encoding == 'zstd':
+        data = main.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+# --- Measurement ---
+class Recorder:
+    """Latency and bytes of every request in one scenario, gathered from several threads."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0
+
+    def request(self, client, method, path, headers=None, body=None, expect=(200,)):
+        """Time one request, counting the bytes sent and received; 429s are retried rather than counted."""
+        headers = dict(headers or {}, **{'Accept-Encoding': ACCEPT_ENCODING})
+        while True:
+            start = time.perf_counter()
+            status, length, data = client.request(method, path, headers, body)
+            elapsed = time.perf_counter() - start
+            if status != 429:
+                break
+            with self.lock:
+                self.retries += 1
+            time.sleep(0.05)
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.bytes += length + (len(body) if body else 0)
+            if status not in expect:
+                self.errors += 1
+        return status, data
+
+    def run(self, clients, tasks, work):
+        """Call work(client, task) for each task from one thread per client, timing the whole batch."""
+        pending = deque(tasks)
+
+        def worker(client):
+            while True:
+                try:
+                    task = pending.popleft()
+                except IndexError:
+                    return
+                work(client, task)
+
+        threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.seconds += time.perf_counter() - start
+
+    def result(self, **details):
+        latencies = sorted(self.latencies)
+        return {
+            'scenario': self.name,
+            'requests': len(latencies),
+            'errors': self.errors,
+            'retries': self.retries,
+            'seconds': round(self.seconds, 4),
+            'requests_per_second': round(len(latencies) / self.seconds, 2) if self.seconds else None,
+            'bytes': self.bytes,
+            'bytes_per_second': round(self.bytes / self.seconds) if self.seconds else None,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                'p50': percentile_ms(latencies, 50),
+                'p95': percentile_ms(latencies, 95),
+                'p99': percentile_ms(latencies, 99),
+                'max': round(latencies[-1] * 1000, 3) if latencies else None,
+            },
+            **details,
+        }
+
+def percentile_ms(ordered, q):
+    """The q-th percentile of sorted latencies in milliseconds, interpolating between the nearest two."""
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return round((ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)) * 1000, 3)
+
+# --- Scenarios ---
+def bench_browse(ctx):
+    """Page through the wide directory the way the file list does as it scrolls, sorted by name and unsorted."""
+    results = []
+    path = '/api/browse' + quote(os.path.join(ctx.root, 'wide'))
+    for sort in ('name', 'none'):
+        recorder = Recorder(f"browse_{sort}")
+
+        def page_through(client, iteration):
+            offset = 0
+            while offset is not None:
+                status, page = recorder.request(client, 'GET', f"{path}?sort={sort}&offset={offset}&limit={ctx.args.page_size}")
+                offset = page.get('next_offset') if status == 200 and page else None
+
+        recorder.run(ctx.clients, range(ctx.args.iterations), page_through)
+        results.append(recorder.result(entries=ctx.spec['wide_files'], page_size=ctx.args.page_size))
+    return results
+
+def bench_tree(ctx):
+    """Load the directory tree three levels deep, then expand the deep chain one level at a time."""
+    recorder = Recorder('tree')
+    deep = [os.path.join(ctx.root, 'deep')]
+    for depth in range(ctx.spec['deep_levels'] - 1):
+        deep.append(os.path.join(deep[-1], f"level-{depth:03}"))
+
+    def load_tree(client, iteration):
+        for path, depth in [(ctx.root, 3), (os.path.join(ctx.root, 'small'), 1)] + [(level, 1) for level in deep]:
+            cursor = ''
+            while cursor is not None:
+                status, page = recorder.request(client, 'GET', f"/api/dir_tree?{urlencode({'path': path, 'depth': depth, 'cursor': cursor})}")
+                cursor = page.get('next_cursor') if status == 200 and page else None
+
+    recorder.run(ctx.clients, range(ctx.args.iterations), load_tree)
+    return [recorder.result(levels=len(deep))]
+
+def bench_upload(ctx):
+    """Upload files in 1 MB chunks from every client at once, then finalize them."""
+    rng = random.Random(ctx.args.seed)
+    block = rng.randbytes(BLOCK_SIZE)
+    size = ctx.args.upload_size
+    total_chunks = max(1, -(-size // UPLOAD_CHUNK_SIZE))
+    target_dir = os.path.join(ctx.root, 'uploads', uuid.uuid4().hex)
+    os.makedirs(target_dir)
+    uploads = []
+    for i in range(ctx.args.uploads):
+        shifts = [rng.randrange(BLOCK_SIZE) for _ in range(total_chunks)]
+        hasher = hashlib.sha256()
+        for index, shift in enumerate(shifts):
+            hasher.update(rotated(block, shift, min(UPLOAD_CHUNK_SIZE, size - index * UPLOAD_CHUNK_SIZE)))
+        fields = {'upload_id': uuid.uuid4().hex, 'total_chunks': total_chunks, 'file_size': size,
+                  'chunk_size': UPLOAD_CHUNK_SIZE, 'filename': f"upload-{i}.bin", 'target_dir': target_dir}
+        uploads.append((fields, shifts, hasher.hexdigest()))
+
+    chunks = Recorder('upload_chunks')
+
+    def send_chunk(client, task):
+        fields, shifts, file_hash = uploads[task[1]]
+        index = task[0]
+        data = rotated(block, shifts[index], min(UPLOAD_CHUNK_SIZE, size - index * UPLOAD_CHUNK_SIZE))
+        body, content_type = multipart(dict(fields, chunk_index=index), data)
+        chunks.request(client, 'POST', '/upload', {'Content-Type': content_type}, body)
+
+    # Chunks of all uploads interleaved, as when a folder of files is dropped on the page
+    chunks.run(ctx.clients, [(index, i) for index in range(total_chunks) for i in range(len(uploads))], send_chunk)
+
+    finalize = Recorder('upload_finalize')
+
+    def finish(client, upload):
+        fields, shifts, file_hash = upload
+        finalize.request(client, 'POST', '/upload/finalize', {'Content-Type': 'application/x-www-form-urlencoded'},
+                         urlencode(dict(fields, file_hash=file_hash)).encode())
+
+    finalize.run(ctx.clients, uploads, finish)
+    shutil.rmtree(os.path.join(ctx.root, 'uploads'), ignore_errors=True)
+    return [chunks.result(uploads=len(uploads), upload_size=size, chunk_size=UPLOAD_CHUNK_SIZE),
+            finalize.result(uploads=len(uploads), upload_size=size)]
+
+def multipart(fields, data):
+    """Encode a chunk upload the way the browser's FormData does."""
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode() for name, value in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="blob"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+    parts.append(data)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def bench_stream(ctx):
+    """Seek around the huge files with ranged /stream requests, as media players do."""
+    recorder = Recorder('stream_ranges')
+    rng = random.Random(ctx.args.seed)
+    files = tree_files(ctx.root, 'huge')
+    size = ctx.spec['huge_size']
+    ranges = []
+    for _ in range(ctx.args.stream_requests):
+        start = rng.randrange(max(1, size - STREAM_RANGE_SIZE))
+        ranges.append((rng.choice(files), start, min(start + STREAM_RANGE_SIZE, size) - 1))
+
+    def fetch_range(client, task):
+        path, start, end = task
+        recorder.request(client, 'GET', '/stream' + quote(path), {'Range': f"bytes={start}-{end}"}, expect=(206,))
+
+    recorder.run(ctx.clients, ranges, fetch_range)
+    return [recorder.result(range_size=STREAM_RANGE_SIZE)]
+
+def bench_zip(ctx):
+    """Download the folder of small files as a zip, stored and deflated."""
+    results = []
+    path = '/download_folder' + quote(os.path.join(ctx.root, 'small'))
+    clients = ctx.clients[:ctx.args.iterations]
+    for compression in ('store', 'deflate'):
+        recorder = Recorder(f"zip_{compression}")
+        recorder.run(clients, range(ctx.args.iterations),
+                     lambda client, iteration: recorder.request(client, 'GET', f"{path}?compression={compression}"))
+        results.append(recorder.result(files=ctx.spec['small_dirs'] * ctx.spec['small_files']))
+    return results
+
+BENCHMARKS = {'browse': bench_browse, 'tree': bench_tree, 'upload': bench_upload, 'stream': bench_stream, 'zip': bench_zip}
+
+# --- Running ---
+class Context:
+    def __init__(self, args, root, spec, clients):
+        self.args = args
+        self.root = root
+        self.spec = spec
+        self.clients = clients
+
+def prepare_data(workdir, root):
+    """Give main.py a data directory in workdir that allows the tree and has a benchmark admin."""
+    os.chdir(workdir) # main.py keeps its data relative to the working directory
+    main.setup()
+    config = main.get_config()
+    config['allowed_directories'] = [root]
+    main.save_config(config)
+    users = main.get_users()
+    users[BENCH_USERNAME] = {'password_hash': main.generate_password_hash(BENCH_PASSWORD), 'is_admin': True, 'allowed_dirs': []}
+    main.save_users(users)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def local_server(workdir, server_args):
+    """Run main.py from workdir on a free port for the duration of the block."""
+    port = free_port()
+    log_path = os.path.join(workdir, 'server.log')
+    with open(log_path, 'w') as log:
+        # In its own process group, so Gunicorn's workers can be stopped along with it
+        process = subprocess.Popen([sys.executable, MAIN_PATH, '--host', '127.0.0.1', '--port', str(port)] + server_args,
+                                   cwd=workdir, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            if process.poll() is not None or time.monotonic() > deadline:
+                with open(log_path) as log:
+                    raise SystemExit(f"The server didn't start:\n{log.read()[-2000:]}")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        stop_process_group(process)
+
+def stop_process_group(process):
+    """Stop process and everything it started, killing them if they haven't exited after the server's graceful timeout."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=main.SERVER_GRACEFUL_TIMEOUT + 10)
+    except ProcessLookupError:
+        pass # Already gone
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    try:
+        os.killpg(process.pid, signal.SIGKILL) # Workers that outlived their master
+    except ProcessLookupError:
+        pass
+
+def wait_for_index(client):
+    """Wait until the server's first index scan is done, so it isn't walking the tree while being measured."""
+    deadline = time.monotonic() + INDEX_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        status, _, stats = client.request('GET', '/api/cache_stats')
+        if status != 200 or not stats:
+            return
+        index = stats['file_index']
+        if index['last_scan'] is not None and not index['scanning']:
+            return
+        time.sleep(0.5)
+    print("The file index is still scanning; measuring anyway.")
+
+def run_benchmarks(args, root, spec, new_client):
+    clients = [new_client() for _ in range(args.concurrency)]
+    ctx = Context(args, root, spec, clients)
+    results = []
+    for name in args.scenarios:
+        print(f"Running {name}...", flush=True)
+        for result in BENCHMARKS[name](ctx):
+            print_result(result)
+            results.append(result)
+    return results
+
+def print_result(result):
+    latency = result['latency_ms']
+    throughput = result['bytes_per_second'] or 0
+    print(f"  {result['scenario']:<16} {result['requests']:>6} req {result['errors']:>4} err "
+          f"{result['requests_per_second'] or 0:>9.1f} req/s {throughput / 1024 / 1024:>9.1f} MB/s  "
+          f"p50 {latency['p50'] or 0:>9.2f} ms  p95 {latency['p95'] or 0:>9.2f} ms  p99 {latency['p99'] or 0:>9.2f} ms", flush=True)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(MAIN_PATH),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline_path, threshold):
+    """Print each scenario's change against an earlier run, returning the scenarios that got worse than threshold percent."""
+    with open(baseline_path) as f:
+        earlier = json.load(f)
+    baseline = {result['scenario']: result for result in earlier['results']}
+    regressions = []
+    print(f"\nCompared with {baseline_path} (commit {earlier.get('commit')}):")
+    for key in ('mode', 'server_args', 'settings', 'tree'):
+        if earlier.get(key) != report[key]:
+            print(f"  Note: the runs differ in {key}, so the numbers may not be comparable.")
+    for result in report['results']:
+        before = baseline.get(result['scenario'])
+        if before is None:
+            continue
+        changes = {
+            'p50': percent_change(before['latency_ms']['p50'], result['latency_ms']['p50']),
+            'p95': percent_change(before['latency_ms']['p95'], result['latency_ms']['p95']),
+            'p99': percent_change(before['latency_ms']['p99'], result['latency_ms']['p99']),
+            'throughput': percent_change(before['bytes_per_second'], result['bytes_per_second']),
+        }
+        worse = [key for key, change in changes.items() if change is not None
+                 and (change < -threshold if key == 'throughput' else change > threshold)]
+        if worse:
+            regressions.append(result['scenario'])
+        print(f"  {result['scenario']:<16} " + '  '.join(
+            f"{key} {'n/a' if change is None else f'{change:+.1f}%'}" for key, change in changes.items())
+            + ('  REGRESSION' if worse else ''))
+    return regressions
+
+def percent_change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the file server on a synthetic tree.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--server', action='store_true', help="start main.py on a free port and benchmark it over HTTP")
+    mode.add_argument('--url', help="benchmark a server that is already running, e.g. http://127.0.0.1:5001")
+    parser.add_argument('--server-args', default='', help="extra command line for main.py with --server, e.g. \"--workers 4 --threads 8\"")
+    parser.add_argument('--username', default=BENCH_USERNAME, help="login for --url; it needs access to --tree")
+    parser.add_argument('--password', default=BENCH_PASSWORD)
+    parser.add_argument('--workdir', help="where the data directory and tree go; by default a temporary directory that is deleted afterwards")
+    parser.add_argument('--tree', help="directory for the synthetic tree, reused between runs (default: WORKDIR/tree)")
+    parser.add_argument('--scale', type=float, default=1.0, help="size of the tree relative to the default of about 650 MB")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the tree and the requests made")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=4, help="clients sending requests at once")
+    parser.add_argument('--iterations', type=int, default=5, help="passes over the tree for browse, tree and zip")
+    parser.add_argument('--page-size', type=int, default=main.BROWSE_PAGE_SIZE, help="entries per browse request")
+    parser.add_argument('--uploads', type=int, default=8, help="files sent by the upload scenario")
+    parser.add_argument('--upload-size', type=int, default=32 * 1024 * 1024, help="bytes in each uploaded file")
+    parser.add_argument('--stream-requests', type=int, default=200, help="ranged requests sent by the stream scenario")
+    parser.add_argument('--output', help="JSON results file (default: benchmark-<time>.json)")
+    parser.add_argument('--compare', help="results file of an earlier run to compare against")
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help="percent a latency may rise or throughput fall against --compare before the run fails")
+    return parser.parse_args()
+
+@contextmanager
+def working_directory(path):
+    """Yield the directory to keep the data and tree in: path, or a temporary directory that is deleted afterwards."""
+    if path:
+        os.makedirs(path, exist_ok=True)
+        yield os.path.abspath(path)
+        return
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='fileserver-bench-')
+    try:
+        yield workdir
+    finally:
+        os.chdir(cwd) # prepare_data moved into workdir
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_in(args, workdir, spec):
+    """Generate the tree and run the benchmarks against the server args chose, returning (mode, results)."""
+    root = os.path.abspath(args.tree or os.path.join(workdir, 'tree'))
+    print(f"Preparing the tree in {root}...", flush=True)
+    os.makedirs(root, exist_ok=True)
+    start = time.perf_counter()
+    generated = generate_tree(root, spec, args.seed)
+    print(f"  {'generated' if generated else 'reused'} in {time.perf_counter() - start:.1f} s", flush=True)
+
+    if args.url:
+        mode = 'http'
+        results = run_benchmarks(args, root, spec, lambda: HttpClient(args.url, args.username, args.password))
+    else:
+        prepare_data(workdir, root)
+        if args.server:
+            mode = 'server'
+            with local_server(workdir, args.server_args.split()) as url:
+                wait_for_index(HttpClient(url, BENCH_USERNAME, BENCH_PASSWORD))
+                results = run_benchmarks(args, root, spec, lambda: HttpClient(url, BENCH_USERNAME, BENCH_PASSWORD))
+        else:
+            mode = 'in-process'
+            main.file_index.rescan(main.index_roots()) # What the background indexer would have done by now
+            results = run_benchmarks(args, root, spec, lambda: InProcessClient(BENCH_USERNAME, BENCH_PASSWORD))
+    return mode, results
+
+def run(args):
+    started = datetime.now(timezone.utc)
+    output = os.path.abspath(args.output or f"benchmark-{started:%Y%m%d-%H%M%S}.json")
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    spec = tree_spec(args.scale)
+    with working_directory(args.workdir) as workdir:
+        mode, results = run_in(args, workdir, spec)
+
+    report = {
+        'started': started.isoformat(),
+        'commit': git_commit(),
+        'mode': mode,
+        'server_args': args.server_args if args.server else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {key: getattr(args, key) for key in ('scale', 'seed', 'concurrency', 'iterations', 'page_size',
+                                                         'uploads', 'upload_size', 'stream_requests', 'scenarios')},
+        'tree': spec,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline and compare(report, baseline, args.max_regression):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run(parse_args()))
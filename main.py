@@ -1,14 +1,80 @@
 # main.py
 import os
 import json
+import re
+import secrets
+import struct
 import hashlib
+import heapq
+import bisect
+import copy
+import io
+import sys
+import asyncio
+import argparse
+import gzip
+import zlib
 import shutil
 import tempfile
+import zipfile
+import sqlite3
+import stat
+import fnmatch
 import mimetypes
-from datetime import timedelta
-from flask import Flask, render_template_string, request, redirect, url_for, session, send_from_directory, jsonify, Response, after_this_request, make_response
+import threading
+import multiprocessing
+import time
+from urllib.parse import quote, unquote_to_bytes
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta, timezone
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, make_response, g
+from jinja2 import DictLoader
+from werkzeug.http import parse_range_header, is_resource_modified, parse_date
 from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from werkzeug.serving import run_simple, WSGIRequestHandler
+from werkzeug.wsgi import FileWrapper
+from functools import lru_cache, partial, wraps
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None # Only the hashlib upload hashes are offered
+
+try:
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.workers import SUPPORTED_WORKERS
+except ImportError:
+    BaseApplication = None # Served by Werkzeug's threaded server instead
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows; uploads are only coordinated between threads of one process
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # Assets are precompressed with gzip only
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # Responses are compressed with brotli or gzip only
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None # Fall back to mtime checks plus a short TTL
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+    THUMBNAIL_FORMAT = 'WEBP' if pil_features.check('webp') else 'JPEG'
+except ImportError:
+    Image = None # No previews; icon view shows file icons for images too
+    THUMBNAIL_FORMAT = None
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024 # 16 GB limit
@@ -24,19 +90,8 @@ LAYOUT_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Python File Server</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css" rel="stylesheet">
-    <style>
-        .dark .bg-gray-100 { background-color: #1a202c; }
-        .dark .bg-white { background-color: #2d3748; }
-        .dark .text-gray-800 { color: #e2e8f0; }
-        .dark .text-gray-700 { color: #a0aec0; }
-        .dark .border-gray-200 { border-color: #4a5568; }
-        .dark .hover\\:bg-gray-50:hover { background-color: #4a5568; }
-        .dark .hover\\:bg-gray-200:hover { background-color: #4a5568; }
-        input[type=range]::-webkit-slider-thumb { -webkit-appearance: none; appearance: none; width: 16px; height: 16px; background: #3b82f6; cursor: pointer; border-radius: 50%; }
-        input[type=range]::-moz-range-thumb { width: 16px; height: 16px; background: #3b82f6; cursor: pointer; border-radius: 50%; }
-    </style>
+    <link href="{{ asset_url('app.css') }}" rel="stylesheet">
+    <link href="{{ asset_url('layout.css') }}" rel="stylesheet">
 </head>
 <body class="bg-gray-100 text-gray-800">
     <div class="flex h-screen">
@@ -87,7 +142,7 @@ LAYOUT_HTML = """
                     <div class="w-full bg-gray-200 rounded-full h-2.5">
                         <div id="hash-progress-bar" class="bg-yellow-400 h-2.5 rounded-full" style="width: 0%"></div>
                     </div>
-                     <div class="text-sm text-right mt-1">Generating hash for resumable upload...</div>
+                     <div class="text-sm text-right mt-1">Hashing file for verification...</div>
                 </div>
                 <div id="upload-status" class="mt-4 hidden">
                     <div class="flex justify-between mb-1">
@@ -108,20 +163,7 @@ LAYOUT_HTML = """
         </div>
     </div>
 
-    <script>
-        // Theme switcher
-        const themeToggle = document.getElementById('theme-toggle');
-        const html = document.documentElement;
-
-        themeToggle.addEventListener('click', () => {
-            html.classList.toggle('dark');
-            localStorage.setItem('theme', html.classList.contains('dark') ? 'dark' : 'light');
-        });
-
-        if (localStorage.getItem('theme') === 'dark') {
-            html.classList.add('dark');
-        }
-    </script>
+    <script src="{{ asset_url('layout.js') }}"></script>
 </body>
 </html>
 """
@@ -133,7 +175,7 @@ LOGIN_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Login - Python File Server</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    <link href="{{ asset_url('app.css') }}" rel="stylesheet">
     <style>
         .dark .bg-gray-100 { background-color: #1a202c; }
         .dark .bg-white { background-color: #2d3748; }
@@ -172,7 +214,7 @@ SETUP_ADMIN_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Admin Setup - Python File Server</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    <link href="{{ asset_url('app.css') }}" rel="stylesheet">
 </head>
 <body class="bg-gray-100 text-gray-800">
     <div class="flex items-center justify-center h-screen">
@@ -207,7 +249,18 @@ INDEX_HTML = """
         </button>
         <h1 id="current-path-header" class="text-2xl font-bold truncate">Files</h1>
     </div>
-    <div>
+    <div class="flex items-center space-x-2">
+        <form id="search-form">
+            <input id="search-input" type="search" placeholder="Search all files" class="px-3 py-2 border rounded text-sm dark:bg-gray-700 dark:border-gray-600">
+        </form>
+        <input id="filter-input" type="search" placeholder="Filter, e.g. IMG_*.jpg" class="px-3 py-2 border rounded text-sm dark:bg-gray-700 dark:border-gray-600">
+        <select id="sort-select" title="Sort by" class="px-3 py-2 border rounded text-sm dark:bg-gray-700 dark:border-gray-600">
+            <option value="name">Name</option>
+            <option value="size">Size</option>
+            <option value="mtime">Modified</option>
+            <option value="type">Type</option>
+        </select>
+        <button id="sort-order-btn" title="Reverse order" data-order="asc" class="p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700"><i class="fas fa-arrow-up"></i></button>
         <button id="list-view-btn" class="p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700"><i class="fas fa-list"></i></button>
         <button id="icon-view-btn" class="p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700"><i class="fas fa-th-large"></i></button>
     </div>
@@ -216,368 +269,7 @@ INDEX_HTML = """
     <!-- File items will be injected here by JavaScript -->
 </div>
 
-<script src="https://cdnjs.cloudflare.com/ajax/libs/crypto-js/4.1.1/crypto-js.min.js"></script>
-<script>
-    const fileView = document.getElementById('file-view');
-    const listViewBtn = document.getElementById('list-view-btn');
-    const iconViewBtn = document.getElementById('icon-view-btn');
-    const treeContainer = document.getElementById('directory-tree');
-    const currentPathHeader = document.getElementById('current-path-header');
-    const upDirBtn = document.getElementById('up-dir-btn');
-    let currentPath = '';
-
-    const VIDEO_EXTENSIONS = ['.mp4', '.webm', '.ogv', '.mkv'];
-
-    function formatBytes(bytes, decimals = 2) {
-        if (!+bytes) return '0 Bytes'
-        const k = 1024
-        const dm = decimals < 0 ? 0 : decimals
-        const sizes = ['Bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
-        const i = Math.floor(Math.log(bytes) / Math.log(k))
-        return `${parseFloat((bytes / Math.pow(k, i)).toFixed(dm))} ${sizes[i]}`
-    }
-
-    function renderDirectoryTree(nodes) {
-        const ul = document.createElement('ul');
-        nodes.forEach(node => {
-            const li = document.createElement('li');
-            const hasChildren = node.children && node.children.length > 0;
-            
-            const chevron = hasChildren ? `<i class="fas fa-chevron-right mr-1 text-xs cursor-pointer expand-icon"></i>` : '<span class="inline-block w-4 mr-1"></span>';
-
-            li.innerHTML = `
-                <div class="flex items-center">
-                    ${chevron}
-                    <a href="#" data-path="${node.path}" class="block p-1 rounded hover:bg-gray-200 dark:hover:bg-gray-700 flex-grow dir-name-link truncate">
-                        <i class="fas fa-folder mr-2 text-yellow-500"></i>
-                        <span>${node.name}</span>
-                    </a>
-                </div>
-            `;
-            
-            if (hasChildren) {
-                const childUl = renderDirectoryTree(node.children);
-                childUl.classList.add('ml-4', 'hidden');
-                li.appendChild(childUl);
-            }
-            ul.appendChild(li);
-        });
-        return ul;
-    }
-
-    async function fetchDirectoryTree() {
-        try {
-            const response = await fetch('/api/dir_tree');
-            if (!response.ok) return null;
-            return await response.json();
-        } catch (e) {
-            console.error("Failed to fetch directory tree:", e);
-            return null;
-        }
-    }
-
-    async function fetchAndRenderFiles(path) {
-        currentPath = path;
-        currentPathHeader.textContent = path;
-        
-        const apiPath = path === '/' ? '' : (path.startsWith('/') ? path.substring(1) : path);
-        const response = await fetch(`/api/browse/${apiPath}`);
-        
-        if (!response.ok) {
-            const err = await response.json().catch(() => ({ error: 'Failed to load directory.' }));
-            fileView.innerHTML = `<p class="text-red-500">${err.error || 'An unknown error occurred.'}</p>`;
-            return;
-        }
-
-        const items = await response.json();
-        renderFiles(items);
-    }
-
-    function renderFiles(items) {
-        const viewMode = fileView.dataset.view || 'list';
-
-        if (viewMode === 'list') {
-            fileView.className = 'grid grid-cols-1 gap-2';
-        } else {
-            fileView.className = 'grid grid-cols-3 sm:grid-cols-4 md:grid-cols-6 lg:grid-cols-8 gap-4 text-center';
-        }
-
-        fileView.innerHTML = '';
-        if (!items || items.length === 0) {
-            fileView.innerHTML = '<p class="text-gray-500">This directory is empty.</p>';
-            return;
-        }
-
-        items.forEach(item => {
-            const isDir = item.is_dir;
-            const element = document.createElement('div');
-            element.dataset.path = item.path;
-            element.dataset.isDir = item.is_dir;
-            
-            if (viewMode === 'list') {
-                element.className = 'flex items-center justify-between p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700';
-                const icon = isDir ? 'fa-folder text-yellow-500' : 'fa-file text-gray-500';
-                const fileExt = item.name.substring(item.name.lastIndexOf('.')).toLowerCase();
-                const isVideo = VIDEO_EXTENSIONS.includes(fileExt);
-
-                let actions = `<a href="${item.is_dir ? '#' : `/download${item.path}`}" class="text-green-500 hover:underline mr-4 download-link">${item.is_dir ? 'Download ZIP' : 'Download'}</a>`;
-                if (isVideo) {
-                    actions += `<a href="/stream${item.path}" target="_blank" class="text-purple-500 hover:underline">Stream</a>`;
-                }
-
-                element.innerHTML = `
-                    <div class="flex items-center truncate w-3/5">
-                        <i class="fas ${icon} fa-fw mr-4"></i>
-                        <a href="#" class="truncate">${item.name}</a>
-                    </div>
-                    <div class="w-1/5 text-right pr-4">
-                        ${!isDir ? formatBytes(item.size) : ''}
-                    </div>
-                    <div class="flex-shrink-0 w-1/5 text-right">
-                        ${actions}
-                    </div>
-                `;
-            } else { // Icon view
-                element.className = 'flex flex-col items-center p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700 cursor-pointer';
-                const icon = isDir ? 'fa-folder fa-3x text-yellow-500' : 'fa-file fa-3x text-gray-500';
-                 element.innerHTML = `
-                    <div class="flex flex-col items-center">
-                        <i class="fas ${icon} mb-2"></i>
-                        <span class="text-sm truncate w-24">${item.name}</span>
-                    </div>
-                `;
-            }
-            fileView.appendChild(element);
-        });
-    }
-
-    treeContainer.addEventListener('click', e => {
-        const expandIcon = e.target.closest('.expand-icon');
-        if (expandIcon) {
-            e.preventDefault();
-            const childUl = expandIcon.parentElement.nextElementSibling;
-            if (childUl) {
-                childUl.classList.toggle('hidden');
-                expandIcon.classList.toggle('fa-chevron-right');
-                expandIcon.classList.toggle('fa-chevron-down');
-            }
-            return;
-        }
-
-        const link = e.target.closest('.dir-name-link');
-        if (link && link.dataset.path) {
-            e.preventDefault();
-            fetchAndRenderFiles(link.dataset.path);
-        }
-    });
-
-    fileView.addEventListener('dblclick', e => {
-        const itemElement = e.target.closest('[data-path]');
-        if (itemElement && itemElement.dataset.isDir === 'true') {
-            fetchAndRenderFiles(itemElement.dataset.path);
-        }
-    });
-
-    fileView.addEventListener('click', e => {
-        const downloadLink = e.target.closest('.download-link');
-        if (downloadLink && (downloadLink.href.includes('/download_folder') || downloadLink.href.endsWith('#'))) {
-            e.preventDefault();
-            const zippingStatus = document.getElementById('zipping-status');
-            const zippingFilename = document.getElementById('zipping-filename');
-            const path = downloadLink.closest('[data-path]').dataset.path;
-            const token = `zip-token-${Date.now()}`;
-            zippingFilename.textContent = path;
-            zippingStatus.classList.remove('hidden');
-            
-            window.location.href = `/download_folder${path}?token=${token}`;
-
-            const interval = setInterval(() => {
-                if (document.cookie.includes(`download-ready=${token}`)) {
-                    zippingStatus.classList.add('hidden');
-                    document.cookie = `download-ready=; Path=/; Expires=Thu, 01 Jan 1970 00:00:01 GMT;`;
-                    clearInterval(interval);
-                }
-            }, 500);
-        }
-    });
-
-    listViewBtn.addEventListener('click', () => {
-        fileView.dataset.view = 'list';
-        fetchAndRenderFiles(currentPath);
-    });
-
-    iconViewBtn.addEventListener('click', () => {
-        fileView.dataset.view = 'icon';
-        fetchAndRenderFiles(currentPath);
-    });
-
-    upDirBtn.addEventListener('click', () => {
-        if (currentPath === '/' || !currentPath) {
-            return;
-        }
-        let parentPath = currentPath.substring(0, currentPath.lastIndexOf('/'));
-        if (parentPath === '') {
-            parentPath = '/';
-        }
-        fetchAndRenderFiles(parentPath);
-    });
-    
-    // Upload functionality
-    const uploadFileBtn = document.getElementById('upload-file-btn');
-    const uploadFolderBtn = document.getElementById('upload-folder-btn');
-    const fileInput = document.getElementById('file-input');
-    const folderInput = document.getElementById('folder-input');
-    
-    uploadFileBtn.addEventListener('click', () => fileInput.click());
-    uploadFolderBtn.addEventListener('click', () => folderInput.click());
-    fileInput.addEventListener('change', () => handleFiles(fileInput.files));
-    folderInput.addEventListener('change', () => {
-        handleFiles(folderInput.files).then(() => {
-            fetchDirectoryTree(); // Refresh tree after folder upload
-        });
-    });
-
-    document.body.addEventListener('dragover', (e) => { e.preventDefault(); e.stopPropagation(); });
-    document.body.addEventListener('drop', (e) => {
-        e.preventDefault();
-        e.stopPropagation();
-        if (e.target.closest('main')) {
-             handleFiles(e.dataTransfer.files).then(() => {
-                fetchDirectoryTree();
-             });
-        }
-    });
-
-    async function handleFiles(files) {
-        for (const file of files) {
-            await uploadFile(file);
-        }
-    }
-
-    async function uploadFile(file) {
-        const hashStatus = document.getElementById('hash-status');
-        const hashFilename = document.getElementById('hash-filename');
-        const hashProgressBar = document.getElementById('hash-progress-bar');
-        const hashPercentage = document.getElementById('hash-percentage');
-        
-        hashFilename.textContent = file.name;
-        hashStatus.classList.remove('hidden');
-
-        const fileHash = await hashFile(file, (progress) => {
-            const percentage = Math.round(progress);
-            hashProgressBar.style.width = `${percentage}%`;
-            hashPercentage.textContent = `${percentage}%`;
-        });
-
-        hashStatus.classList.add('hidden');
-
-        const chunkSize = 1024 * 1024; // 1MB
-        const totalChunks = Math.ceil(file.size / chunkSize);
-        
-        const uploadStatus = document.getElementById('upload-status');
-        const uploadFilename = document.getElementById('upload-filename');
-        const uploadProgressBar = document.getElementById('upload-progress-bar');
-        const uploadDetails = document.getElementById('upload-details');
-        const uploadSpeed = document.getElementById('upload-speed');
-
-        uploadFilename.textContent = file.webkitRelativePath || file.name;
-        uploadStatus.classList.remove('hidden');
-
-        let startTime = Date.now();
-        let uploadedBytes = 0;
-
-        for (let i = 0; i < totalChunks; i++) {
-            const start = i * chunkSize;
-            const end = Math.min(start + chunkSize, file.size);
-            const chunk = file.slice(start, end);
-
-            const formData = new FormData();
-            formData.append('file', chunk);
-            formData.append('file_hash', fileHash);
-            formData.append('chunk_index', i);
-            formData.append('total_chunks', totalChunks);
-            formData.append('filename', file.name);
-            formData.append('target_dir', currentPath);
-            formData.append('relative_path', file.webkitRelativePath || '');
-
-            try {
-                const response = await fetch('/upload', { method: 'POST', body: formData });
-                const result = await response.json();
-
-                uploadedBytes += chunk.size;
-                const elapsedTime = (Date.now() - startTime) / 1000;
-                const speed = elapsedTime > 0 ? uploadedBytes / elapsedTime : 0;
-                
-                const percentage = Math.round(((i + 1) / totalChunks) * 100);
-                uploadProgressBar.style.width = `${percentage}%`;
-                uploadDetails.textContent = `${formatBytes(uploadedBytes)} / ${formatBytes(file.size)} (${percentage}%)`;
-                uploadSpeed.textContent = `${formatBytes(speed)}/s`;
-
-            } catch (error) {
-                console.error('Upload failed:', error);
-                uploadStatus.classList.add('hidden');
-                return;
-            }
-        }
-        
-        setTimeout(() => uploadStatus.classList.add('hidden'), 3000);
-        fetchAndRenderFiles(currentPath);
-    }
-
-    function hashFile(file, progressCallback) {
-        return new Promise((resolve, reject) => {
-            const chunkSize = 1024 * 1024 * 2; // 2MB chunks for hashing
-            const totalChunks = Math.ceil(file.size / chunkSize);
-            let currentChunk = 0;
-            const hasher = CryptoJS.algo.SHA256.create();
-            const reader = new FileReader();
-
-            reader.onload = (event) => {
-                const wordArray = CryptoJS.lib.WordArray.create(event.target.result);
-                hasher.update(wordArray);
-                currentChunk++;
-                
-                if (progressCallback) {
-                    progressCallback((currentChunk / totalChunks) * 100);
-                }
-
-                if (currentChunk < totalChunks) {
-                    loadNext();
-                } else {
-                    const hash = hasher.finalize().toString();
-                    resolve(hash);
-                }
-            };
-            
-            reader.onerror = (error) => reject(error);
-
-            function loadNext() {
-                const start = currentChunk * chunkSize;
-                const end = Math.min(start + chunkSize, file.size);
-                reader.readAsArrayBuffer(file.slice(start, end));
-            }
-
-            loadNext();
-        });
-    }
-
-    async function initialLoad() {
-        const treeData = await fetchDirectoryTree();
-        if (treeData && treeData.length > 0) {
-            treeContainer.innerHTML = '';
-            treeContainer.appendChild(renderDirectoryTree(treeData));
-            const firstLink = document.querySelector('#directory-tree a.dir-name-link');
-            if (firstLink) {
-                 await fetchAndRenderFiles(firstLink.dataset.path);
-            }
-        } else {
-            fileView.innerHTML = '<p>No accessible directories. Please contact an administrator.</p>';
-        }
-    }
-
-    document.addEventListener('DOMContentLoaded', initialLoad);
-
-</script>
+<script src="{{ asset_url('index.js') }}" data-hash-worker="{{ asset_url('hash-worker.js') }}" data-thumbnail-types="{{ thumbnail_types|join(' ') }}"></script>
 """
 
 ADMIN_HTML = """
@@ -606,6 +298,45 @@ ADMIN_HTML = """
     </ul>
 </div>
 
+<!-- Disk Usage -->
+<div class="bg-white p-6 rounded-lg shadow-md mb-6">
+    <h2 class="text-xl font-bold mb-4">Disk Usage</h2>
+    {% if usage_path %}
+    <div class="flex justify-between items-center mb-4">
+        <span class="font-semibold truncate">{{ usage_path }}</span>
+        <span>{% if usage_total %}{{ usage_total[0]|filesize }} &middot; {{ usage_total[1] }} files{% endif %}</span>
+    </div>
+    <a href="{{ url_for('admin', usage=usage_up) if usage_up else url_for('admin') }}" class="block text-blue-500 hover:underline mb-2">&larr; Up</a>
+    {% endif %}
+    <ul>
+        {% for path, size, files in usage_rows %}
+        <li class="flex justify-between items-center mb-2">
+            <a href="{{ url_for('admin', usage=path) }}" class="text-blue-500 hover:underline truncate">{{ path }}</a>
+            <span class="flex-shrink-0 ml-2">{{ size|filesize }} &middot; {{ files }} files</span>
+        </li>
+        {% else %}
+        <li class="text-gray-500">{{ 'No subfolders.' if usage_path else 'The file index has not sized any directories yet.' }}</li>
+        {% endfor %}
+    </ul>
+</div>
+
+<!-- Upload Scratch Space -->
+<div class="bg-white p-6 rounded-lg shadow-md mb-6">
+    <h2 class="text-xl font-bold mb-4">Unfinished Uploads</h2>
+    {% if scratch.last_sweep %}
+    <ul>
+        <li class="flex justify-between items-center mb-2"><span>Scratch space in use</span><span>{{ scratch.bytes|filesize }} of {{ scratch.budget|filesize }}</span></li>
+        <li class="flex justify-between items-center mb-2"><span>Uploads in progress</span><span>{{ scratch.uploads }}</span></li>
+        <li class="flex justify-between items-center mb-2"><span>Expired after sitting idle</span><span>{{ scratch.expired }}</span></li>
+        <li class="flex justify-between items-center mb-2"><span>Dropped to stay within budget</span><span>{{ scratch.evicted }}</span></li>
+        <li class="flex justify-between items-center mb-2"><span>Space reclaimed</span><span>{{ scratch.reclaimed_bytes|filesize }}</span></li>
+        <li class="flex justify-between items-center text-gray-500"><span>Last checked</span><span>{{ scratch.last_sweep|datetime }}</span></li>
+    </ul>
+    {% else %}
+    <p class="text-gray-500">Not checked yet.</p>
+    {% endif %}
+</div>
+
 <!-- User Management -->
 <div class="bg-white p-6 rounded-lg shadow-md">
     <h2 class="text-xl font-bold mb-4">User Management</h2>
@@ -651,239 +382,3817 @@ ADMIN_HTML = """
 </div>
 """
 
-# --- Configuration ---
-DATA_DIR = 'data'
-UPLOADS_DIR = 'uploads'
-USERS_FILE = os.path.join(DATA_DIR, 'users.json')
-CONFIG_FILE = os.path.join(DATA_DIR, 'config.json')
-CHUNK_DIR = os.path.join(UPLOADS_DIR, 'chunks')
-
-# --- Helper Functions ---
-def setup():
-    """Create necessary directories and files if they don't exist."""
-    os.makedirs(DATA_DIR, exist_ok=True)
-    os.makedirs(UPLOADS_DIR, exist_ok=True)
-    os.makedirs(CHUNK_DIR, exist_ok=True)
-    if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'w') as f:
-            json.dump({}, f)
-    if not os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump({'allowed_directories': ['/']}, f)
+# --- Embedded Static Assets ---
+# Served from /assets under content-hashed names so browsers can cache them indefinitely.
 
-def get_users():
-    """Load user data from the JSON file."""
-    with open(USERS_FILE, 'r') as f:
-        return json.load(f)
+# Tailwind utilities used by the embedded pages, compiled ahead of time so no
+# browser has to build them from the CDN. Add a rule here when a template
+# starts using a new class.
+UTILITY_CSS = """
+*, ::before, ::after { box-sizing: border-box; border: 0 solid #e5e7eb; }
+html { line-height: 1.5; -webkit-text-size-adjust: 100%; tab-size: 4; font-family: ui-sans-serif, system-ui, -apple-system, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif; }
+body { margin: 0; line-height: inherit; }
+h1, h2, h3, h4, p, ul, form { margin: 0; }
+h1, h2, h3, h4 { font-size: inherit; font-weight: inherit; }
+ul { list-style: none; padding: 0; }
+a { color: inherit; text-decoration: inherit; }
+button, input, select { font-family: inherit; font-size: 100%; line-height: inherit; color: inherit; margin: 0; padding: 0; }
+button { background-color: transparent; background-image: none; cursor: pointer; text-transform: none; }
+input::placeholder { color: #9ca3af; opacity: 1; }
+[hidden] { display: none; }
 
-def save_users(users):
-    """Save user data to the JSON file."""
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=4)
+.space-x-2 > :not([hidden]) ~ :not([hidden]) { margin-left: .5rem; }
+.block { display: block; }
+.inline-block { display: inline-block; }
+.flex { display: flex; }
+.inline-flex { display: inline-flex; }
+.grid { display: grid; }
+.relative { position: relative; }
+.absolute { position: absolute; }
+.hidden { display: none; }
+.h-2\\.5 { height: .625rem; }
+.h-16 { height: 4rem; }
+.h-full { height: 100%; }
+.h-screen { height: 100vh; }
+.w-4 { width: 1rem; }
+.w-16 { width: 4rem; }
+.w-24 { width: 6rem; }
+.w-64 { width: 16rem; }
+.w-1\\/5 { width: 20%; }
+.w-3\\/5 { width: 60%; }
+.w-full { width: 100%; }
+.max-w-md { max-width: 28rem; }
+.flex-1 { flex: 1 1 0%; }
+.flex-shrink-0 { flex-shrink: 0; }
+.flex-grow { flex-grow: 1; }
+.cursor-pointer { cursor: pointer; }
+.grid-cols-1 { grid-template-columns: repeat(1, minmax(0, 1fr)); }
+.grid-cols-3 { grid-template-columns: repeat(3, minmax(0, 1fr)); }
+.flex-col { flex-direction: column; }
+.items-center { align-items: center; }
+.justify-center { justify-content: center; }
+.justify-between { justify-content: space-between; }
+.gap-2 { gap: .5rem; }
+.gap-4 { gap: 1rem; }
+.overflow-hidden { overflow: hidden; }
+.object-cover { object-fit: cover; }
+.overflow-y-auto { overflow-y: auto; }
+.truncate { overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+.rounded { border-radius: .25rem; }
+.rounded-lg { border-radius: .5rem; }
+.rounded-full { border-radius: 9999px; }
+.border { border-width: 1px; }
+.border-b { border-bottom-width: 1px; }
+.bg-blue-500 { background-color: #3b82f6; }
+.bg-blue-600 { background-color: #2563eb; }
+.bg-gray-100 { background-color: #f3f4f6; }
+.bg-gray-200 { background-color: #e5e7eb; }
+.bg-green-500 { background-color: #22c55e; }
+.bg-indigo-500 { background-color: #6366f1; }
+.bg-white { background-color: #fff; }
+.bg-yellow-400 { background-color: #facc15; }
+.p-1 { padding: .25rem; }
+.p-2 { padding: .5rem; }
+.p-4 { padding: 1rem; }
+.p-6 { padding: 1.5rem; }
+.p-8 { padding: 2rem; }
+.px-3 { padding-left: .75rem; padding-right: .75rem; }
+.px-4 { padding-left: 1rem; padding-right: 1rem; }
+.py-2 { padding-top: .5rem; padding-bottom: .5rem; }
+.pb-6 { padding-bottom: 1.5rem; }
+.pr-4 { padding-right: 1rem; }
+.mb-1 { margin-bottom: .25rem; }
+.mb-2 { margin-bottom: .5rem; }
+.mb-4 { margin-bottom: 1rem; }
+.mb-6 { margin-bottom: 1.5rem; }
+.ml-2 { margin-left: .5rem; }
+.ml-4 { margin-left: 1rem; }
+.mr-1 { margin-right: .25rem; }
+.mr-2 { margin-right: .5rem; }
+.mr-4 { margin-right: 1rem; }
+.mt-1 { margin-top: .25rem; }
+.mt-4 { margin-top: 1rem; }
+.text-center { text-align: center; }
+.text-right { text-align: right; }
+.text-xs { font-size: .75rem; line-height: 1rem; }
+.text-sm { font-size: .875rem; line-height: 1.25rem; }
+.text-lg { font-size: 1.125rem; line-height: 1.75rem; }
+.text-xl { font-size: 1.25rem; line-height: 1.75rem; }
+.text-2xl { font-size: 1.5rem; line-height: 2rem; }
+.text-3xl { font-size: 1.875rem; line-height: 2.25rem; }
+.font-medium { font-weight: 500; }
+.font-semibold { font-weight: 600; }
+.font-bold { font-weight: 700; }
+.text-blue-500 { color: #3b82f6; }
+.text-gray-500 { color: #6b7280; }
+.text-gray-700 { color: #374151; }
+.text-gray-800 { color: #1f2937; }
+.text-green-500 { color: #22c55e; }
+.text-purple-500 { color: #a855f7; }
+.text-red-500 { color: #ef4444; }
+.text-white { color: #fff; }
+.text-yellow-500 { color: #eab308; }
+.shadow { box-shadow: 0 1px 3px 0 rgb(0 0 0 / .1), 0 1px 2px -1px rgb(0 0 0 / .1); }
+.shadow-md { box-shadow: 0 4px 6px -1px rgb(0 0 0 / .1), 0 2px 4px -2px rgb(0 0 0 / .1); }
+@keyframes pulse { 50% { opacity: .5; } }
+.animate-pulse { animation: pulse 2s cubic-bezier(.4, 0, .6, 1) infinite; }
+.hover\\:bg-blue-600:hover { background-color: #2563eb; }
+.hover\\:bg-gray-200:hover { background-color: #e5e7eb; }
+.hover\\:bg-green-600:hover { background-color: #16a34a; }
+.hover\\:text-gray-700:hover { color: #374151; }
+.hover\\:underline:hover { text-decoration-line: underline; }
+.dark .dark\\:bg-gray-700 { background-color: #374151; }
+.dark .dark\\:border-gray-600 { border-color: #4b5563; }
+.dark .dark\\:hover\\:bg-gray-700:hover { background-color: #374151; }
+@media (min-width: 640px) {
+    .sm\\:grid-cols-4 { grid-template-columns: repeat(4, minmax(0, 1fr)); }
+}
+@media (min-width: 768px) {
+    .md\\:w-1\\/2 { width: 50%; }
+    .md\\:grid-cols-2 { grid-template-columns: repeat(2, minmax(0, 1fr)); }
+    .md\\:grid-cols-6 { grid-template-columns: repeat(6, minmax(0, 1fr)); }
+}
+@media (min-width: 1024px) {
+    .lg\\:grid-cols-8 { grid-template-columns: repeat(8, minmax(0, 1fr)); }
+}
+"""
 
-def get_config():
-    """Load configuration from the JSON file."""
-    with open(CONFIG_FILE, 'r') as f:
-        return json.load(f)
+# Icons keep Font Awesome's class names but are drawn from these 24x24 SVG
+# paths through a CSS mask, so they take the text colour and need no font.
+ICON_PATHS = {
+    'file': 'M6 2h8l6 6v12a2 2 0 0 1-2 2H6a2 2 0 0 1-2-2V4a2 2 0 0 1 2-2zm7 1.5V9h5.5z',
+    'file-arrow-up': 'M6 2h8l6 6v12a2 2 0 0 1-2 2H6a2 2 0 0 1-2-2V4a2 2 0 0 1 2-2zm6 8l-4.5 4.5H11V19h2v-4.5h3.5z',
+    'folder': 'M2 6a2 2 0 0 1 2-2h5l2 2h9a2 2 0 0 1 2 2v10a2 2 0 0 1-2 2H4a2 2 0 0 1-2-2z',
+    'folder-plus': 'M2 6a2 2 0 0 1 2-2h5l2 2h9a2 2 0 0 1 2 2v10a2 2 0 0 1-2 2H4a2 2 0 0 1-2-2zm9 4v2.5H8.5v2H11V17h2v-2.5h2.5v-2H13V10z',
+    'moon': 'M21 12.8A9 9 0 1 1 11.2 3a7 7 0 0 0 9.8 9.8z',
+    'arrow-up': 'M12 3l7 7-1.4 1.4-4.6-4.6V21h-2V6.8l-4.6 4.6L5 10z',
+    'arrow-down': 'M12 21l-7-7 1.4-1.4 4.6 4.6V3h2v14.2l4.6-4.6L19 14z',
+    'list': 'M3 5h3v3H3zm5 0.5h13v2H8zM3 10.5h3v3H3zm5 0.5h13v2H8zM3 16h3v3H3zm5 0.5h13v2H8z',
+    'th-large': 'M3 3h8v8H3zm10 0h8v8h-8zM3 13h8v8H3zm10 0h8v8h-8z',
+    'chevron-right': 'M8.6 4.6L10 3.2l8.8 8.8-8.8 8.8-1.4-1.4 7.4-7.4z',
+    'chevron-down': 'M4.6 8.6L3.2 10l8.8 8.8 8.8-8.8-1.4-1.4-7.4 7.4z',
+}
 
-def save_config(config):
-    """Save configuration to the JSON file."""
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
+def icon_css():
+    """Build the CSS that draws each ICON_PATHS entry for its fa-<name> class."""
+    rules = [
+        '.fas { display: inline-block; width: 1em; height: 1em; vertical-align: -.125em; background-color: currentColor;'
+        ' -webkit-mask: var(--icon) center / contain no-repeat; mask: var(--icon) center / contain no-repeat; }',
+        '.fa-fw { width: 1.25em; }',
+        '.fa-3x { font-size: 3em; }',
+    ]
+    for name, path in ICON_PATHS.items():
+        svg = f"<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 24 24' fill-rule='evenodd'><path d='{path}'/></svg>"
+        rules.append(f'.fa-{name} {{ --icon: url("data:image/svg+xml,{quote(svg)}"); }}')
+    return '\n'.join(rules)
 
-def is_admin_setup():
-    """Check if an admin user has been created."""
-    users = get_users()
-    for user in users.values():
-        if user.get('is_admin'):
-            return True
-    return False
+LAYOUT_CSS = """
+.dark .bg-gray-100 { background-color: #1a202c; }
+.dark .bg-white { background-color: #2d3748; }
+.dark .text-gray-800 { color: #e2e8f0; }
+.dark .text-gray-700 { color: #a0aec0; }
+.dark .border-gray-200 { border-color: #4a5568; }
+.dark .hover\\:bg-gray-50:hover { background-color: #4a5568; }
+.dark .hover\\:bg-gray-200:hover { background-color: #4a5568; }
+input[type=range]::-webkit-slider-thumb { -webkit-appearance: none; appearance: none; width: 16px; height: 16px; background: #3b82f6; cursor: pointer; border-radius: 50%; }
+input[type=range]::-moz-range-thumb { width: 16px; height: 16px; background: #3b82f6; cursor: pointer; border-radius: 50%; }
+"""
 
-def get_user_dirs():
-    user = session['user']
-    config = get_config()
-    if user.get('is_admin'):
-        return config['allowed_directories']
-    return user.get('allowed_dirs', [])
+LAYOUT_JS = """
+// Theme switcher
+const themeToggle = document.getElementById('theme-toggle');
+const html = document.documentElement;
 
-def build_dir_tree(path, user_dirs):
-    tree = []
-    if not os.path.isdir(path):
-        return tree
-        
-    try:
-        for entry in os.scandir(path):
-            if entry.is_dir():
-                is_allowed = any(os.path.abspath(entry.path).startswith(os.path.abspath(d)) for d in user_dirs)
-                if is_allowed:
-                    node = {'name': entry.name, 'path': entry.path, 'children': build_dir_tree(entry.path, user_dirs)}
-                    tree.append(node)
-    except PermissionError:
-        pass # Ignore directories we can't access
-    return tree
+themeToggle.addEventListener('click', () => {
+    html.classList.toggle('dark');
+    localStorage.setItem('theme', html.classList.contains('dark') ? 'dark' : 'light');
+});
 
-def render_with_layout(template_string, **context):
-    """Helper to render a content string within the main layout."""
-    context['session'] = session
-    content_html = render_template_string(template_string, **context)
-    return render_template_string(LAYOUT_HTML, content=content_html, **context)
+if (localStorage.getItem('theme') === 'dark') {
+    html.classList.add('dark');
+}
+"""
 
-# --- Decorators ---
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user' not in session:
-            return redirect(url_for('login'))
-        session.permanent = True # Extend session on activity
-        return f(*args, **kwargs)
-    return decorated_function
+INDEX_JS = """
+const fileView = document.getElementById('file-view');
+const listViewBtn = document.getElementById('list-view-btn');
+const iconViewBtn = document.getElementById('icon-view-btn');
+const treeContainer = document.getElementById('directory-tree');
+const currentPathHeader = document.getElementById('current-path-header');
+const upDirBtn = document.getElementById('up-dir-btn');
+let currentPath = '';
 
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user' not in session or not session['user'].get('is_admin'):
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
+const VIDEO_EXTENSIONS = ['.mp4', '.webm', '.ogv', '.mkv'];
+const THUMBNAIL_EXTENSIONS = document.currentScript.dataset.thumbnailTypes.split(' ').filter(Boolean);
 
-# --- Routes ---
-@app.route('/')
-@login_required
-def index():
-    return render_with_layout(INDEX_HTML)
+function formatBytes(bytes, decimals = 2) {
+    if (!+bytes) return '0 Bytes'
+    const k = 1024
+    const dm = decimals < 0 ? 0 : decimals
+    const sizes = ['Bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
+    const i = Math.floor(Math.log(bytes) / Math.log(k))
+    return `${parseFloat((bytes / Math.pow(k, i)).toFixed(dm))} ${sizes[i]}`
+}
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if not is_admin_setup():
-        return redirect(url_for('setup_admin'))
-    
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
-        users = get_users()
-        user = users.get(username)
-        if user and check_password_hash(user['password_hash'], password):
-            session.permanent = True
-            session['user'] = user
-            session['user']['username'] = username
-            return redirect(url_for('index'))
-        return render_template_string(LOGIN_HTML, error='Invalid username or password')
-    return render_template_string(LOGIN_HTML)
+function renderDirectoryTree(nodes, parentPath = null, nextCursor = null) {
+    const ul = document.createElement('ul');
+    appendTreeNodes(ul, nodes, parentPath, nextCursor);
+    return ul;
+}
 
-@app.route('/logout')
-def logout():
-    session.pop('user', None)
-    return redirect(url_for('login'))
+function appendTreeNodes(ul, nodes, parentPath, nextCursor) {
+    nodes.forEach(node => {
+        const li = document.createElement('li');
+        const isLoaded = Array.isArray(node.children);
+        const isLeaf = isLoaded && node.children.length === 0 && !node.next_cursor;
 
-@app.route('/setup_admin', methods=['GET', 'POST'])
-def setup_admin():
-    if is_admin_setup():
-        return redirect(url_for('login'))
+        const chevron = !isLeaf ? `<i class="fas fa-chevron-right mr-1 text-xs cursor-pointer expand-icon"></i>` : '<span class="inline-block w-4 mr-1"></span>';
 
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
-        users = get_users()
-        if username in users:
-            return render_template_string(SETUP_ADMIN_HTML, error='Username already exists')
+        li.innerHTML = `
+            <div class="flex items-center">
+                ${chevron}
+                <a href="#" data-path="${node.path}" class="block p-1 rounded hover:bg-gray-200 dark:hover:bg-gray-700 flex-grow dir-name-link truncate">
+                    <i class="fas fa-folder mr-2 text-yellow-500"></i>
+                    <span>${node.name}</span>
+                </a>
+            </div>
+        `;
         
-        users[username] = {
-            'password_hash': generate_password_hash(password),
-            'is_admin': True,
-            'allowed_dirs': []
+        if (isLoaded && !isLeaf) {
+            const childUl = renderDirectoryTree(node.children, node.path, node.next_cursor);
+            childUl.classList.add('ml-4', 'hidden');
+            li.appendChild(childUl);
         }
-        save_users(users)
-        return redirect(url_for('login'))
-    return render_template_string(SETUP_ADMIN_HTML)
+        ul.appendChild(li);
+    });
 
-@app.route('/admin', methods=['GET', 'POST'])
-@admin_required
-def admin():
-    if request.method == 'POST':
-        new_dir = request.form.get('new_dir')
-        if new_dir and os.path.isdir(new_dir):
-            config = get_config()
-            if new_dir not in config['allowed_directories']:
-                config['allowed_directories'].append(os.path.abspath(new_dir))
-                save_config(config)
-        
-        remove_dir = request.form.get('remove_dir')
-        if remove_dir:
-            config = get_config()
-            if remove_dir in config['allowed_directories']:
-                config['allowed_directories'].remove(remove_dir)
-                save_config(config)
+    if (nextCursor) {
+        const li = document.createElement('li');
+        li.innerHTML = `<a href="#" class="block p-1 text-sm text-blue-500 hover:underline load-more-link">Load more&hellip;</a>`;
+        li.firstElementChild.dataset.parent = parentPath;
+        li.firstElementChild.dataset.cursor = nextCursor;
+        ul.appendChild(li);
+    }
+}
 
-        return redirect(url_for('admin'))
+async function fetchDirectoryTree(path = null, cursor = null) {
+    const params = new URLSearchParams();
+    if (path) params.set('path', path);
+    if (cursor) params.set('cursor', cursor);
+    try {
+        const response = await fetch(`/api/dir_tree?${params}`);
+        if (!response.ok) return null;
+        return await response.json();
+    } catch (e) {
+        console.error("Failed to fetch directory tree:", e);
+        return null;
+    }
+}
 
-    config = get_config()
-    users = get_users()
-    return render_with_layout(ADMIN_HTML, config=config, users=users)
+// The file view is virtualized: only the rows on screen exist in the DOM and
+// the server hands out sorted, filtered pages of the listing as they scroll in.
+const BROWSE_PAGE_SIZE = 200;
+const LIST_ROW_HEIGHT = 44;
+const ICON_ROW_HEIGHT = 112;
+const ICON_MIN_WIDTH = 112;
+const OVERSCAN_ROWS = 4;
+const fileScroller = fileView.closest('main');
+const filterInput = document.getElementById('filter-input');
+const sortSelect = document.getElementById('sort-select');
+const sortOrderBtn = document.getElementById('sort-order-btn');
+let listing = null;
+let renderQueued = false;
 
-@app.route('/admin/create_user', methods=['POST'])
-@admin_required
-def create_user():
-    username = request.form['username']
-    password = request.form['password']
-    users = get_users()
-    if username in users:
-        return redirect(url_for('admin'))
-    
-    users[username] = {
-        'password_hash': generate_password_hash(password),
-        'is_admin': 'is_admin' in request.form,
-        'allowed_dirs': request.form.getlist('allowed_dirs')
+function browseQuery(offset) {
+    const params = new URLSearchParams({ sort: listing.sort, order: listing.order, offset, limit: BROWSE_PAGE_SIZE });
+    if (listing.filter) {
+        // Anything with a wildcard is a glob; plain text matches names that start with it
+        params.set(/[*?[]/.test(listing.filter) ? 'glob' : 'prefix', listing.filter);
     }
-    save_users(users)
-    return redirect(url_for('admin'))
+    return params;
+}
 
-@app.route('/admin/delete_user/<username>', methods=['POST'])
+async function loadPage(page) {
+    const current = listing;
+    current.pages.set(page, null);
+    const apiPath = current.path === '/' ? '' : (current.path.startsWith('/') ? current.path.substring(1) : current.path);
+    let response;
+    try {
+        response = await fetch(`/api/browse/${apiPath}?${browseQuery(page * BROWSE_PAGE_SIZE)}`);
+    } catch (e) {
+        console.error("Failed to fetch directory page:", e);
+        current.pages.delete(page);
+        return false;
+    }
+    if (current !== listing) return false;
+
+    if (!response.ok) {
+        const err = await response.json().catch(() => ({ error: 'Failed to load directory.' }));
+        listing = null;
+        fileView.style.height = '';
+        fileView.innerHTML = `<p class="text-red-500">${err.error || 'An unknown error occurred.'}</p>`;
+        return false;
+    }
+
+    const data = await response.json();
+    if (current !== listing) return false;
+    current.pages.set(page, data.items);
+    if (data.total !== current.total) {
+        // The directory changed since the first page; pages fetched earlier may be off by a few rows
+        current.total = data.total;
+        current.renderedRange = null;
+    }
+    return true;
+}
+
+async function fetchAndRenderFiles(path) {
+    const samePath = listing && listing.path === path;
+    currentPath = path;
+    currentPathHeader.textContent = path;
+    listing = {
+        path,
+        sort: sortSelect.value,
+        order: sortOrderBtn.dataset.order,
+        filter: filterInput.value.trim(),
+        total: 0,
+        pages: new Map(),
+        renderedRange: null,
+    };
+    if (!samePath) fileScroller.scrollTop = 0;
+    if (await loadPage(0)) renderFiles();
+}
+
+function renderFiles() {
+    if (!listing) return;
+    const viewMode = fileView.dataset.view || 'list';
+
+    if (listing.total === 0) {
+        fileView.className = '';
+        fileView.style.height = '';
+        fileView.innerHTML = `<p class="text-gray-500">${listing.filter ? 'No matching files.' : 'This directory is empty.'}</p>`;
+        listing.renderedRange = null;
+        return;
+    }
+
+    const perRow = viewMode === 'list' ? 1 : Math.max(1, Math.floor(fileView.clientWidth / ICON_MIN_WIDTH));
+    const rowHeight = viewMode === 'list' ? LIST_ROW_HEIGHT : ICON_ROW_HEIGHT;
+    const rowCount = Math.ceil(listing.total / perRow);
+    const viewTop = fileScroller.getBoundingClientRect().top - fileView.getBoundingClientRect().top;
+    const firstRow = Math.max(0, Math.floor(viewTop / rowHeight) - OVERSCAN_ROWS);
+    const lastRow = Math.min(rowCount - 1, Math.ceil((viewTop + fileScroller.clientHeight) / rowHeight) + OVERSCAN_ROWS);
+
+    const firstItem = firstRow * perRow;
+    const lastItem = Math.min(listing.total - 1, (lastRow + 1) * perRow - 1);
+    const current = listing;
+    for (let page = Math.floor(firstItem / BROWSE_PAGE_SIZE); page <= Math.floor(lastItem / BROWSE_PAGE_SIZE); page++) {
+        if (!current.pages.has(page)) {
+            loadPage(page).then(loaded => {
+                if (loaded) {
+                    current.renderedRange = null;
+                    renderFiles();
+                }
+            });
+        }
+    }
+
+    const range = `${viewMode}:${perRow}:${firstRow}:${lastRow}`;
+    if (listing.renderedRange === range) return;
+    listing.renderedRange = range;
+
+    fileView.className = 'relative';
+    fileView.style.height = `${rowCount * rowHeight}px`;
+    thumbnailObserver.disconnect();
+    fileView.innerHTML = '';
+    for (let row = firstRow; row <= lastRow; row++) {
+        const rowElement = document.createElement('div');
+        rowElement.className = viewMode === 'list' ? 'absolute w-full' : 'absolute w-full grid gap-4 text-center';
+        rowElement.style.top = `${row * rowHeight}px`;
+        rowElement.style.height = `${rowHeight}px`;
+        if (viewMode !== 'list') rowElement.style.gridTemplateColumns = `repeat(${perRow}, minmax(0, 1fr))`;
+        for (let index = row * perRow; index < Math.min((row + 1) * perRow, listing.total); index++) {
+            const page = listing.pages.get(Math.floor(index / BROWSE_PAGE_SIZE));
+            const item = page && page[index % BROWSE_PAGE_SIZE];
+            rowElement.appendChild(item ? renderItem(item, viewMode) : renderPlaceholder());
+        }
+        fileView.appendChild(rowElement);
+    }
+}
+
+function scheduleRender() {
+    if (renderQueued) return;
+    renderQueued = true;
+    requestAnimationFrame(() => {
+        renderQueued = false;
+        renderFiles();
+    });
+}
+
+function renderPlaceholder() {
+    const element = document.createElement('div');
+    element.className = 'h-full p-2';
+    element.innerHTML = '<div class="h-full bg-gray-200 rounded animate-pulse"></div>';
+    return element;
+}
+
+function renderItem(item, viewMode) {
+    const isDir = item.is_dir;
+    const element = document.createElement('div');
+    element.dataset.path = item.path;
+    element.dataset.isDir = item.is_dir;
+    if (isDir && item.file_count != null) {
+        element.dataset.size = item.size;
+        element.dataset.fileCount = item.file_count;
+    }
+
+    if (viewMode === 'list') {
+        element.className = 'flex items-center justify-between p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700';
+        const icon = isDir ? 'fa-folder text-yellow-500' : 'fa-file text-gray-500';
+        const fileExt = item.name.substring(item.name.lastIndexOf('.')).toLowerCase();
+        const isVideo = VIDEO_EXTENSIONS.includes(fileExt);
+
+        let actions = `<a href="${item.is_dir ? '#' : `/download${item.path}`}" class="text-green-500 hover:underline mr-4 download-link">${item.is_dir ? 'Download ZIP' : 'Download'}</a>`;
+        if (isVideo) {
+            actions += `<a href="/stream${item.path}" target="_blank" class="text-purple-500 hover:underline">Stream</a>`;
+        }
+
+        element.innerHTML = `
+            <div class="flex items-center truncate w-3/5">
+                <i class="fas ${icon} fa-fw mr-4"></i>
+                <a href="#" class="truncate">${item.name}</a>
+            </div>
+            <div class="w-1/5 text-right pr-4">
+                ${!isDir ? formatBytes(item.size) : item.file_count != null ? `${formatBytes(item.size)} <span class="text-gray-500">(${item.file_count} files)</span>` : ''}
+            </div>
+            <div class="flex-shrink-0 w-1/5 text-right">
+                ${actions}
+            </div>
+        `;
+    } else { // Icon view
+        element.className = 'flex flex-col items-center p-2 rounded hover:bg-gray-200 dark:hover:bg-gray-700 cursor-pointer';
+        const icon = isDir ? 'fa-folder fa-3x text-yellow-500' : 'fa-file fa-3x text-gray-500';
+         element.innerHTML = `
+            <div class="flex flex-col items-center">
+                <i class="fas ${icon} mb-2"></i>
+                <span class="text-sm truncate w-24">${item.name}</span>
+            </div>
+        `;
+        const fileExt = item.name.substring(item.name.lastIndexOf('.')).toLowerCase();
+        if (!isDir && THUMBNAIL_EXTENSIONS.includes(fileExt)) {
+            const thumbnail = document.createElement('img');
+            thumbnail.className = 'w-16 h-16 object-cover rounded mb-2';
+            thumbnail.alt = '';
+            thumbnail.dataset.src = `/thumbnail${item.path.split('/').map(encodeURIComponent).join('/')}?v=${item.mtime}`;
+            // Keep the file icon if there's no preview
+            thumbnail.addEventListener('error', () => thumbnail.replaceWith(renderFileIcon()));
+            element.querySelector('i').replaceWith(thumbnail);
+            thumbnailObserver.observe(thumbnail);
+        }
+    }
+    return element;
+}
+
+function renderFileIcon() {
+    const icon = document.createElement('i');
+    icon.className = 'fas fa-file fa-3x text-gray-500 mb-2';
+    return icon;
+}
+
+// Previews are only requested once they scroll near the visible part of the file view
+const thumbnailObserver = new IntersectionObserver(entries => {
+    entries.forEach(entry => {
+        if (entry.isIntersecting) {
+            entry.target.src = entry.target.dataset.src;
+            thumbnailObserver.unobserve(entry.target);
+        }
+    });
+}, { root: fileScroller, rootMargin: `${ICON_ROW_HEIGHT}px 0px` });
+
+// Search results come from the server-side file index and are appended a page at a time
+const SEARCH_PAGE_SIZE = 100;
+const searchForm = document.getElementById('search-form');
+const searchInput = document.getElementById('search-input');
+let searchQuery = null;
+
+async function runSearch(query, offset = 0) {
+    const params = new URLSearchParams({ q: query, offset, limit: SEARCH_PAGE_SIZE });
+    let data;
+    try {
+        const response = await fetch(`/api/search?${params}`);
+        data = await response.json();
+        if (!response.ok) throw new Error(data.error);
+    } catch (e) {
+        fileView.innerHTML = `<p class="text-red-500">Search failed: ${e.message}</p>`;
+        return;
+    }
+    if (offset === 0) {
+        listing = null;
+        searchQuery = query;
+        currentPathHeader.textContent = `Search: ${query}`;
+        fileView.className = 'grid grid-cols-1 gap-2';
+        fileView.style.height = '';
+        fileView.innerHTML = '';
+        fileScroller.scrollTop = 0;
+        if (data.items.length === 0) {
+            fileView.innerHTML = '<p class="text-gray-500">No files found.</p>';
+            return;
+        }
+    } else if (query !== searchQuery) {
+        return;
+    }
+    fileView.querySelectorAll('.search-more-link').forEach(link => link.remove());
+    data.items.forEach(item => fileView.appendChild(renderItem({ ...item, name: item.path }, 'list')));
+    if (data.next_offset) {
+        const more = document.createElement('a');
+        more.href = '#';
+        more.className = 'block p-1 text-sm text-blue-500 hover:underline search-more-link';
+        more.innerHTML = 'Load more&hellip;';
+        more.dataset.offset = data.next_offset;
+        fileView.appendChild(more);
+    }
+}
+
+searchForm.addEventListener('submit', e => {
+    e.preventDefault();
+    const query = searchInput.value.trim();
+    if (query) runSearch(query);
+});
+
+fileView.addEventListener('click', e => {
+    const moreLink = e.target.closest('.search-more-link');
+    if (moreLink) {
+        e.preventDefault();
+        runSearch(searchQuery, Number(moreLink.dataset.offset));
+    }
+});
+
+fileScroller.addEventListener('scroll', scheduleRender, { passive: true });
+window.addEventListener('resize', scheduleRender);
+
+let filterTimer = null;
+filterInput.addEventListener('input', () => {
+    clearTimeout(filterTimer);
+    filterTimer = setTimeout(() => fetchAndRenderFiles(currentPath), 250);
+});
+
+sortSelect.addEventListener('change', () => fetchAndRenderFiles(currentPath));
+
+sortOrderBtn.addEventListener('click', () => {
+    const descending = sortOrderBtn.dataset.order !== 'desc';
+    sortOrderBtn.dataset.order = descending ? 'desc' : 'asc';
+    sortOrderBtn.firstElementChild.classList.toggle('fa-arrow-up', !descending);
+    sortOrderBtn.firstElementChild.classList.toggle('fa-arrow-down', descending);
+    fetchAndRenderFiles(currentPath);
+});
+
+treeContainer.addEventListener('click', async e => {
+    const expandIcon = e.target.closest('.expand-icon');
+    if (expandIcon) {
+        e.preventDefault();
+        const li = expandIcon.closest('li');
+        let childUl = expandIcon.parentElement.nextElementSibling;
+        if (!childUl) {
+            // Children are fetched the first time a node is expanded
+            if (li.dataset.loading) return;
+            li.dataset.loading = 'true';
+            const path = li.querySelector('.dir-name-link').dataset.path;
+            const data = await fetchDirectoryTree(path);
+            delete li.dataset.loading;
+            if (!data) return;
+            if (data.children.length === 0 && !data.next_cursor) {
+                expandIcon.outerHTML = '<span class="inline-block w-4 mr-1"></span>';
+                return;
+            }
+            childUl = renderDirectoryTree(data.children, path, data.next_cursor);
+            childUl.classList.add('ml-4', 'hidden');
+            li.appendChild(childUl);
+        }
+        childUl.classList.toggle('hidden');
+        expandIcon.classList.toggle('fa-chevron-right');
+        expandIcon.classList.toggle('fa-chevron-down');
+        return;
+    }
+
+    const moreLink = e.target.closest('.load-more-link');
+    if (moreLink) {
+        e.preventDefault();
+        const data = await fetchDirectoryTree(moreLink.dataset.parent, moreLink.dataset.cursor);
+        if (!data) return;
+        const ul = moreLink.closest('ul');
+        moreLink.parentElement.remove();
+        appendTreeNodes(ul, data.children, moreLink.dataset.parent, data.next_cursor);
+        return;
+    }
+
+    const link = e.target.closest('.dir-name-link');
+    if (link && link.dataset.path) {
+        e.preventDefault();
+        fetchAndRenderFiles(link.dataset.path);
+    }
+});
+
+fileView.addEventListener('dblclick', e => {
+    const itemElement = e.target.closest('[data-path]');
+    if (itemElement && itemElement.dataset.isDir === 'true') {
+        fetchAndRenderFiles(itemElement.dataset.path);
+    }
+});
+
+fileView.addEventListener('click', e => {
+    const downloadLink = e.target.closest('.download-link');
+    if (downloadLink && (downloadLink.href.includes('/download_folder') || downloadLink.href.endsWith('#'))) {
+        e.preventDefault();
+        const zippingStatus = document.getElementById('zipping-status');
+        const zippingFilename = document.getElementById('zipping-filename');
+        const folder = downloadLink.closest('[data-path]').dataset;
+        const path = folder.path;
+        const token = `zip-token-${Date.now()}`;
+        zippingFilename.textContent = folder.fileCount ? `${path} (${formatBytes(Number(folder.size))} in ${folder.fileCount} files)` : path;
+        zippingStatus.classList.remove('hidden');
+        
+        window.location.href = `/download_folder${path}?token=${token}`;
+
+        const interval = setInterval(() => {
+            if (document.cookie.includes(`download-ready=${token}`)) {
+                zippingStatus.classList.add('hidden');
+                document.cookie = `download-ready=; Path=/; Expires=Thu, 01 Jan 1970 00:00:01 GMT;`;
+                clearInterval(interval);
+            }
+        }, 500);
+    }
+});
+
+listViewBtn.addEventListener('click', () => {
+    fileView.dataset.view = 'list';
+    renderFiles();
+});
+
+iconViewBtn.addEventListener('click', () => {
+    fileView.dataset.view = 'icon';
+    renderFiles();
+});
+
+upDirBtn.addEventListener('click', () => {
+    if (currentPath === '/' || !currentPath) {
+        return;
+    }
+    let parentPath = currentPath.substring(0, currentPath.lastIndexOf('/'));
+    if (parentPath === '') {
+        parentPath = '/';
+    }
+    fetchAndRenderFiles(parentPath);
+});
+
+// Upload functionality
+const uploadFileBtn = document.getElementById('upload-file-btn');
+const uploadFolderBtn = document.getElementById('upload-folder-btn');
+const fileInput = document.getElementById('file-input');
+const folderInput = document.getElementById('folder-input');
+
+uploadFileBtn.addEventListener('click', () => fileInput.click());
+uploadFolderBtn.addEventListener('click', () => folderInput.click());
+fileInput.addEventListener('change', () => handleFiles(fileInput.files));
+folderInput.addEventListener('change', () => {
+    handleFiles(folderInput.files).then(() => {
+        fetchDirectoryTree(); // Refresh tree after folder upload
+    });
+});
+
+document.body.addEventListener('dragover', (e) => { e.preventDefault(); e.stopPropagation(); });
+document.body.addEventListener('drop', (e) => {
+    e.preventDefault();
+    e.stopPropagation();
+    if (e.target.closest('main')) {
+         handleFiles(e.dataTransfer.files).then(() => {
+            fetchDirectoryTree();
+         });
+    }
+});
+
+const UPLOAD_FILES_IN_PARALLEL = 2;
+const UPLOAD_CHUNKS_IN_FLIGHT = 4; // Per file; keep files x chunks within the server's per-user limit
+const MIN_CHUNK_SIZE = 1024 * 1024; // 1MB
+const MAX_CHUNK_SIZE = 64 * 1024 * 1024;
+const TARGET_CHUNK_SECONDS = 2;
+const MAX_CHUNK_ATTEMPTS = 5;
+let chunkThroughput = 0; // Smoothed bytes/s of a single chunk request, used to size the next file's chunks
+
+const uploadProgress = { totalBytes: 0, sentBytes: 0, startTime: 0, activeFiles: 0 };
+
+function updateUploadStatus(name) {
+    const uploadStatus = document.getElementById('upload-status');
+    const uploadFilename = document.getElementById('upload-filename');
+    const uploadProgressBar = document.getElementById('upload-progress-bar');
+    const uploadDetails = document.getElementById('upload-details');
+    const uploadSpeed = document.getElementById('upload-speed');
+
+    uploadStatus.classList.remove('hidden');
+    if (name) {
+        uploadFilename.textContent = uploadProgress.activeFiles > 1 ? `${name} (+${uploadProgress.activeFiles - 1} more)` : name;
+    }
+    const elapsedTime = (Date.now() - uploadProgress.startTime) / 1000;
+    const speed = elapsedTime > 0 ? uploadProgress.sentBytes / elapsedTime : 0;
+    const percentage = uploadProgress.totalBytes ? Math.round((uploadProgress.sentBytes / uploadProgress.totalBytes) * 100) : 100;
+    uploadProgressBar.style.width = `${percentage}%`;
+    uploadDetails.textContent = `${formatBytes(uploadProgress.sentBytes)} / ${formatBytes(uploadProgress.totalBytes)} (${percentage}%)`;
+    uploadSpeed.textContent = `${formatBytes(speed)}/s`;
+}
+
+function pickChunkSize() {
+    // Aim for chunks that take a couple of seconds each, so fast links aren't bound by per-request latency
+    let size = MIN_CHUNK_SIZE;
+    while (size < MAX_CHUNK_SIZE && size * 2 <= chunkThroughput * TARGET_CHUNK_SECONDS) {
+        size *= 2;
+    }
+    return size;
+}
+
+async function handleFiles(files) {
+    const queue = Array.from(files);
+    if (uploadProgress.activeFiles === 0) {
+        uploadProgress.totalBytes = 0;
+        uploadProgress.sentBytes = 0;
+        uploadProgress.startTime = Date.now();
+    }
+    uploadProgress.totalBytes += queue.reduce((total, file) => total + file.size, 0);
+
+    const workers = Array.from({ length: Math.min(UPLOAD_FILES_IN_PARALLEL, queue.length) }, async () => {
+        while (queue.length > 0) {
+            await uploadFile(queue.shift());
+        }
+    });
+    await Promise.all(workers);
+}
+
+function randomUploadId() {
+    return Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function uploadFile(file) {
+    const hashStatus = document.getElementById('hash-status');
+    const hashFilename = document.getElementById('hash-filename');
+    const hashProgressBar = document.getElementById('hash-progress-bar');
+    const hashPercentage = document.getElementById('hash-percentage');
+    const targetDir = currentPath;
+    const displayName = file.webkitRelativePath || file.name;
+
+    // The file is hashed in a worker while its chunks upload; the hash is only needed to finalize
+    hashFilename.textContent = file.name;
+    hashStatus.classList.remove('hidden');
+    const hashPromise = hashFile(file, (progress) => {
+        const percentage = Math.round(progress);
+        hashFilename.textContent = file.name;
+        hashProgressBar.style.width = `${percentage}%`;
+        hashPercentage.textContent = `${percentage}%`;
+    });
+
+    // Reuse the id and chunk size of an interrupted attempt so the server can resume it
+    const resumeKey = `upload:${targetDir}:${displayName}:${file.size}:${file.lastModified}`;
+    let resume = JSON.parse(localStorage.getItem(resumeKey) || 'null');
+    if (!resume) {
+        resume = { uploadId: randomUploadId(), chunkSize: pickChunkSize() };
+        localStorage.setItem(resumeKey, JSON.stringify(resume));
+    }
+    const chunkSize = resume.chunkSize;
+    const totalChunks = Math.max(1, Math.ceil(file.size / chunkSize));
+    const uploadFields = {
+        upload_id: resume.uploadId,
+        total_chunks: totalChunks,
+        file_size: file.size,
+        chunk_size: chunkSize,
+        filename: file.name,
+        target_dir: targetDir,
+        relative_path: file.webkitRelativePath || '',
+    };
+
+    uploadProgress.activeFiles++;
+    updateUploadStatus(displayName);
+
+    if (await uploadFromCopy(uploadFields, hashPromise)) {
+        localStorage.removeItem(resumeKey);
+        uploadProgress.sentBytes += file.size;
+        updateUploadStatus();
+        finishUpload(targetDir);
+        return;
+    }
+
+    // Ask which chunks the server already has so an interrupted upload resumes where it stopped
+    const received = new Set(Array.from({ length: totalChunks }, (_, i) => i));
+    try {
+        const statusResponse = await fetch(`/upload/status?${new URLSearchParams(uploadFields)}`);
+        if (statusResponse.ok) {
+            const status = await statusResponse.json();
+            status.missing.forEach(([first, last]) => {
+                for (let i = first; i <= last; i++) received.delete(i);
+            });
+        } else {
+            received.clear();
+        }
+    } catch (error) {
+        received.clear();
+    }
+
+    const pending = [];
+    for (let i = 0; i < totalChunks; i++) {
+        if (received.has(i)) {
+            uploadProgress.sentBytes += Math.max(0, Math.min(chunkSize, file.size - i * chunkSize));
+        } else {
+            pending.push(i);
+        }
+    }
+    updateUploadStatus(displayName);
+
+    async function sendChunk(i) {
+        const start = i * chunkSize;
+        const end = Math.min(start + chunkSize, file.size);
+        const chunk = file.slice(start, end);
+
+        const formData = new FormData();
+        formData.append('file', chunk);
+        formData.append('chunk_index', i);
+        for (const [name, value] of Object.entries(uploadFields)) {
+            formData.append(name, value);
+        }
+        if (window.crypto && crypto.subtle) {
+            // Lets the server reject a damaged chunk right away instead of failing the whole file
+            const digest = await crypto.subtle.digest('SHA-256', await chunk.arrayBuffer());
+            formData.append('chunk_hash', Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join(''));
+        }
+
+        for (let attempt = 1; attempt <= MAX_CHUNK_ATTEMPTS; attempt++) {
+            const sentAt = Date.now();
+            try {
+                const response = await fetch('/upload', { method: 'POST', body: formData });
+                if (response.status === 429) {
+                    // Server is at its upload limit for us; back off and try again
+                    const retryAfter = parseFloat(response.headers.get('Retry-After')) || 1;
+                    await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+                    attempt--;
+                    continue;
+                }
+                if (response.ok) {
+                    const seconds = Math.max((Date.now() - sentAt) / 1000, 0.001);
+                    const sample = chunk.size / seconds;
+                    chunkThroughput = chunkThroughput ? 0.7 * chunkThroughput + 0.3 * sample : sample;
+                    uploadProgress.sentBytes += chunk.size;
+                    updateUploadStatus();
+                    return true;
+                }
+                if (response.status !== 400 && response.status < 502) {
+                    const result = await response.json().catch(() => ({}));
+                    console.error('Upload failed:', result.message || response.status);
+                    return false;
+                }
+            } catch (error) {
+                console.error('Chunk upload failed, retrying:', error);
+            }
+            await new Promise(resolve => setTimeout(resolve, attempt * 1000));
+        }
+        return false;
+    }
+
+    let failed = false;
+    const lanes = Array.from({ length: Math.min(UPLOAD_CHUNKS_IN_FLIGHT, pending.length) }, async () => {
+        while (pending.length > 0 && !failed) {
+            if (!await sendChunk(pending.shift())) {
+                failed = true;
+            }
+        }
+    });
+    await Promise.all(lanes);
+
+    if (failed) {
+        hashPromise.cancel();
+    } else {
+        try {
+            const formData = new FormData();
+            for (const [name, value] of Object.entries(uploadFields)) {
+                formData.append(name, value);
+            }
+            formData.append('file_hash', await hashPromise);
+            const response = await fetch('/upload/finalize', { method: 'POST', body: formData });
+            const result = await response.json().catch(() => ({}));
+            if (response.ok) {
+                localStorage.removeItem(resumeKey);
+            } else {
+                console.error('Upload failed:', result.message || response.status);
+            }
+        } catch (error) {
+            console.error('Upload failed:', error);
+        }
+    }
+    finishUpload(targetDir);
+}
+
+async function uploadFromCopy(uploadFields, hashPromise) {
+    // Ask before sending anything; only a file the same size as one the server has waits for its hash
+    async function check(fields) {
+        const formData = new FormData();
+        for (const [name, value] of Object.entries(fields)) {
+            formData.append(name, value);
+        }
+        const response = await fetch('/upload/check', { method: 'POST', body: formData });
+        return response.ok ? response.json() : {};
+    }
+    try {
+        if (!(await check(uploadFields)).candidates) return false;
+        return (await check({ ...uploadFields, file_hash: await hashPromise })).complete === true;
+    } catch (error) {
+        console.error('Upload pre-flight failed:', error);
+        return false;
+    }
+}
+
+function finishUpload(targetDir) {
+    document.getElementById('hash-status').classList.add('hidden');
+
+    uploadProgress.activeFiles--;
+    if (uploadProgress.activeFiles === 0) {
+        setTimeout(() => {
+            if (uploadProgress.activeFiles === 0) document.getElementById('upload-status').classList.add('hidden');
+        }, 3000);
+    }
+    if (targetDir === currentPath) {
+        fetchAndRenderFiles(currentPath);
+    }
+}
+
+const HASH_SLICE_SIZE = 4 * 1024 * 1024;
+const hashWorkerUrl = document.currentScript.dataset.hashWorker;
+
+function hashFile(file, progressCallback) {
+    // Hashing runs in a worker so the page stays responsive while it reads the whole file
+    const worker = new Worker(hashWorkerUrl);
+    const promise = new Promise((resolve, reject) => {
+        worker.onmessage = (event) => {
+            if (event.data.hash) {
+                worker.terminate();
+                resolve(event.data.hash);
+            } else if (progressCallback) {
+                progressCallback(event.data.progress);
+            }
+        };
+        worker.onerror = (error) => {
+            worker.terminate();
+            reject(error);
+        };
+    });
+    worker.postMessage({ file, sliceSize: HASH_SLICE_SIZE });
+    promise.cancel = () => worker.terminate();
+    return promise;
+}
+
+async function initialLoad() {
+    const treeData = await fetchDirectoryTree();
+    if (treeData && treeData.children.length > 0) {
+        treeContainer.innerHTML = '';
+        treeContainer.appendChild(renderDirectoryTree(treeData.children));
+        const firstLink = document.querySelector('#directory-tree a.dir-name-link');
+        if (firstLink) {
+             await fetchAndRenderFiles(firstLink.dataset.path);
+        }
+    } else {
+        fileView.innerHTML = '<p>No accessible directories. Please contact an administrator.</p>';
+    }
+}
+
+document.addEventListener('DOMContentLoaded', initialLoad);
+"""
+
+HASH_WORKER_JS = """
+// Incremental SHA-256 over typed arrays, so a file can be hashed slice by slice without holding it in memory
+const K = new Int32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]);
+
+class Sha256 {
+    constructor() {
+        this.state = new Int32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+        this.buffer = new Uint8Array(64);
+        this.buffered = 0;
+        this.length = 0;
+        this.w = new Int32Array(64);
+    }
+
+    update(data) {
+        let offset = 0;
+        this.length += data.length;
+        if (this.buffered > 0) {
+            offset = Math.min(64 - this.buffered, data.length);
+            this.buffer.set(data.subarray(0, offset), this.buffered);
+            this.buffered += offset;
+            if (this.buffered < 64) return;
+            this.compress(this.buffer, 0);
+            this.buffered = 0;
+        }
+        for (; offset + 64 <= data.length; offset += 64) {
+            this.compress(data, offset);
+        }
+        this.buffer.set(data.subarray(offset), 0);
+        this.buffered = data.length - offset;
+    }
+
+    compress(data, offset) {
+        const w = this.w;
+        for (let t = 0; t < 16; t++) {
+            const i = offset + t * 4;
+            w[t] = (data[i] << 24) | (data[i + 1] << 16) | (data[i + 2] << 8) | data[i + 3];
+        }
+        for (let t = 16; t < 64; t++) {
+            const x = w[t - 15], y = w[t - 2];
+            const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+            const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+            w[t] = (w[t - 16] + s0 + w[t - 7] + s1) | 0;
+        }
+        const s = this.state;
+        let a = s[0], b = s[1], c = s[2], d = s[3], e = s[4], f = s[5], g = s[6], h = s[7];
+        for (let t = 0; t < 64; t++) {
+            const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+            const t1 = (h + S1 + ((e & f) ^ (~e & g)) + K[t] + w[t]) | 0;
+            const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+            const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+            h = g; g = f; f = e; e = (d + t1) | 0;
+            d = c; c = b; b = a; a = (t1 + t2) | 0;
+        }
+        s[0] = (s[0] + a) | 0; s[1] = (s[1] + b) | 0; s[2] = (s[2] + c) | 0; s[3] = (s[3] + d) | 0;
+        s[4] = (s[4] + e) | 0; s[5] = (s[5] + f) | 0; s[6] = (s[6] + g) | 0; s[7] = (s[7] + h) | 0;
+    }
+
+    hexdigest() {
+        const length = this.length;
+        const padding = new Uint8Array((this.buffered < 56 ? 56 : 120) - this.buffered + 8);
+        padding[0] = 0x80;
+        const view = new DataView(padding.buffer);
+        view.setUint32(padding.length - 8, Math.floor(length / 0x20000000));
+        view.setUint32(padding.length - 4, (length % 0x20000000) * 8);
+        this.update(padding);
+        return Array.from(this.state, word => (word >>> 0).toString(16).padStart(8, '0')).join('');
+    }
+}
+
+self.onmessage = async (event) => {
+    const { file, sliceSize } = event.data;
+    const hasher = new Sha256();
+    for (let offset = 0; offset < file.size; offset += sliceSize) {
+        const buffer = await file.slice(offset, offset + sliceSize).arrayBuffer();
+        hasher.update(new Uint8Array(buffer));
+        self.postMessage({ progress: (Math.min(offset + sliceSize, file.size) / file.size) * 100 });
+    }
+    self.postMessage({ hash: hasher.hexdigest() });
+};
+"""
+
+@app.template_filter('filesize')
+def format_size(size):
+    """Human-readable byte count, as formatBytes shows it in the browser."""
+    for unit in ('Bytes', 'KB', 'MB', 'GB', 'TB', 'PB'):
+        if size < 1024 or unit == 'PB':
+            return f"{round(size, 2):g} {unit}"
+        size /= 1024
+
+@app.template_filter('datetime')
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+# Templates are compiled once and then served from Jinja's cache
+app.jinja_loader = DictLoader({
+    'layout.html': LAYOUT_HTML,
+    'login.html': LOGIN_HTML,
+    'setup_admin.html': SETUP_ADMIN_HTML,
+    'index.html': INDEX_HTML,
+    'admin.html': ADMIN_HTML,
+})
+for template_name in app.jinja_loader.list_templates():
+    app.jinja_env.get_template(template_name)
+
+ASSETS = {} # versioned filename -> (encodings, mimetype, etag)
+ASSET_FILENAMES = {} # logical name -> versioned filename
+
+def minify_css(css):
+    """Strip comments and collapse the whitespace around CSS punctuation."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    return re.sub(r' ?([{};,>]) ?', r'\1', css).strip()
+
+def minify_js(js):
+    """Drop indentation, blank lines and whole-line comments; statements are left untouched."""
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+MINIFIERS = {'text/css': minify_css, 'text/javascript': minify_js}
+
+def register_asset(name, content, mimetype):
+    """Publish an embedded asset under a filename that changes whenever its content does.
+
+    The minified body is compressed once here, so requests only pick a ready-made encoding.
+    """
+    data = MINIFIERS.get(mimetype, str)(content).encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(name)
+    versioned = f"{stem}.{digest}{ext}"
+    encodings = {None: data, 'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli:
+        encodings['br'] = brotli.compress(data, quality=11)
+    if zstandard:
+        encodings['zstd'] = zstandard.ZstdCompressor(level=19).compress(data)
+    ASSETS[versioned] = (encodings, mimetype, digest)
+    ASSET_FILENAMES[name] = versioned
+
+def negotiate_encoding(available, preference=('br', 'zstd', 'gzip')):
+    """Pick the best content coding the client accepts from those we have, or None for identity."""
+    for encoding in preference:
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+register_asset('app.css', UTILITY_CSS + icon_css(), 'text/css')
+register_asset('layout.css', LAYOUT_CSS, 'text/css')
+register_asset('layout.js', LAYOUT_JS, 'text/javascript')
+register_asset('index.js', INDEX_JS, 'text/javascript')
+register_asset('hash-worker.js', HASH_WORKER_JS, 'text/javascript')
+
+@app.template_global()
+def asset_url(name):
+    return url_for('asset', filename=ASSET_FILENAMES[name])
+
+# --- Configuration ---
+DATA_DIR = 'data'
+UPLOADS_DIR = 'uploads'
+USERS_FILE = os.path.join(DATA_DIR, 'users.json')
+CONFIG_FILE = os.path.join(DATA_DIR, 'config.json')
+CHUNK_DIR = os.path.join(UPLOADS_DIR, 'chunks')
+REAPER_STATS_FILE = os.path.join(DATA_DIR, 'upload_reaper.json')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60 # Asset URLs change with their content, so they never need revalidating
+FILE_HASH_RE = re.compile(r'[0-9a-f]{16,128}') # Hex digest sent by the client, also used in chunk file names
+UPLOAD_HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+if xxhash is not None:
+    UPLOAD_HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+    UPLOAD_HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+DEFAULT_UPLOAD_HASH = 'sha256'
+DEDUP_HASH_ALGORITHMS = ('sha256', 'blake2b') # Only collision-resistant hashes are trusted to identify content
+DEDUP_HARDLINKS = False # Opt in to hardlinking duplicate uploads where reflinks aren't supported; an edit to either file then changes both
+FICLONE = 0x40049409 # Linux ioctl that makes a file share another's data blocks (Btrfs, XFS, ...)
+UPLOAD_ID_RE = re.compile(r'[A-Za-z0-9_-]{16,64}') # Client-chosen id for uploads whose hash comes at finalize
+PARTIAL_UPLOAD_RE = re.compile(r'\..+\.[A-Za-z0-9_-]{16}\.part') # Name of an in-place upload's file until it is verified
+UPLOAD_WRITE_SIZE = 1024 * 1024
+UPLOAD_SESSION_TTL = 7 * 24 * 3600 # Seconds an upload may go without a new chunk before it is abandoned
+UPLOAD_SCRATCH_BUDGET = 50 * 1024 * 1024 * 1024 # Disk space for unfinished uploads; the least recently active are dropped beyond it
+UPLOAD_REAP_MIN_IDLE = 15 * 60 # Uploads that received a chunk this recently are never dropped to make room
+UPLOAD_MAX_CHUNKS = 100_000 # Chunks one upload may be split into; bounds the memory and work its bitmap takes
+UPLOAD_SESSION_IDLE = 15 * 60 # Seconds an upload's session stays in memory unused; it is rebuilt from the manifest if the upload resumes
+UPLOAD_REAP_INTERVAL = 5 * 60 # Seconds between sweeps of CHUNK_DIR
+MAX_UPLOAD_STREAMS_PER_USER = 8 # Concurrent chunk requests one user may have in flight, per worker process
+DIR_TREE_PAGE_SIZE = 500 # Subdirectories returned per /api/dir_tree page
+DIR_TREE_MAX_PAGE_SIZE = 5000
+DIR_TREE_MAX_DEPTH = 3
+DIR_CACHE_MAX_ENTRIES = 1024 # Directory listings kept in memory for /api/browse
+DIR_CACHE_TTL = 10 # Seconds a listing is trusted without inotify, to pick up in-place size changes
+BROWSE_PAGE_SIZE = 200 # Entries returned per /api/browse page
+BROWSE_MAX_PAGE_SIZE = 5000
+BROWSE_MAX_VIEWS = 8 # Sorted/filtered views kept per cached directory
+BROWSE_STREAM_BATCH_BYTES = 16 * 1024 # Entries of an unsorted page sent together; each send is flushed through compression
+BROWSE_STREAM_BATCH_SECONDS = 0.1 # Send what has been read so far once a slow directory has taken this long
+INDEX_DB = os.path.join(DATA_DIR, 'index.db')
+INDEX_RESCAN_INTERVAL = 30 * 60 # Seconds between full rescans; inotify keeps the index current in between
+INDEX_RETRY_DELAY = 60 # Seconds the indexer waits after an unexpected error
+INDEX_BATCH_SIZE = 1000 # Rows written per transaction during a scan
+INDEX_EVENT_DELAY = 200 # Milliseconds to let inotify events pile up before applying them
+INDEX_SKIP_DIRS = ('/proc', '/sys', '/dev', '/run') # Never indexed, even when / is allowed
+SEARCH_PAGE_SIZE = 100
+SEARCH_MAX_PAGE_SIZE = 1000
+DISK_USAGE_TOP = 15 # Largest folders listed per directory on the admin disk usage view
+THUMBNAIL_DIR = os.path.join(DATA_DIR, 'thumbnails')
+THUMBNAIL_SIZES = {'small': 160, 'large': 1600} # Longest side in pixels of each preview size
+THUMBNAIL_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_CACHE_BYTES = 1024 * 1024 * 1024 # Disk space for previews; the least recently used go first
+THUMBNAIL_WORKERS = 2 # Processes rendering previews, per server worker process
+THUMBNAIL_TIMEOUT = 30 # Seconds a request waits for its preview to render
+THUMBNAIL_PREWARM = True # Render the small preview of an uploaded image as soon as it is verified
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600 # Browser cache lifetime of previews requested with a ?v= version
+COMPRESS_CACHE_DIR = os.path.join(DATA_DIR, 'compressed')
+COMPRESS_CACHE_BYTES = 2 * 1024 * 1024 * 1024 # Disk space for compressed copies of text files; the least recently used go first
+COMPRESS_MIN_SIZE = 1024 # Responses smaller than this aren't worth compressing
+COMPRESS_MAX_FILE_SIZE = 256 * 1024 * 1024 # Bigger text files are sent as they are rather than keep a core busy compressing
+COMPRESSION_LEVELS = {'zstd': 3, 'br': 5, 'gzip': 6} # Fast settings, since most responses are compressed while they are sent
+# Preference order when compressing on the fly; zstd gives the best ratio for its speed
+COMPRESSION_ENCODINGS = tuple(encoding for encoding, available in (('zstd', zstandard), ('br', brotli), ('gzip', zlib)) if available)
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'application/xml', 'application/x-ndjson',
+    'application/yaml', 'application/toml', 'application/sql', 'application/x-sh', 'image/svg+xml',
+}
+COMPRESSIBLE_EXTENSIONS = { # Text files that mimetypes doesn't know, so they'd otherwise count as binary
+    '.log', '.md', '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', '.jsonl', '.ndjson', '.tsv', '.srt', '.vtt',
+}
+ZIP_READ_SIZE = 1024 * 1024
+ZIP64_THRESHOLD = 2 * 1024 * 1024 * 1024 # Files this big get ZIP64 headers up front since the output can't be seeked back
+STREAM_CHUNK_SIZE = 1024 * 1024
+MAX_RANGES = 32 # Range requests asking for more parts than this get the whole file
+STORED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.iso',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.m4a', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.webm', '.ogv', '.mov', '.avi',
+}
+METRICS_DIR = os.path.join(DATA_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 5 # Seconds between each worker writing its metrics for /metrics to add up
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # Upper bounds in seconds of the request duration histogram
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5001
+SERVER_WORKERS = 2 # Worker processes; each keeps its own directory cache and upload limits
+SERVER_THREADS = 16 # Requests each worker serves at once, so long transfers don't hold up browsing
+SERVER_KEEPALIVE = 5 # Seconds an idle keep-alive connection is held open
+SERVER_GRACEFUL_TIMEOUT = 30 # Seconds in-flight requests get to finish on shutdown or reload
+SERVER_ASYNCIO = False # Stream responses from an asyncio event loop instead of holding a thread each
+SERVER_CONNECTIONS = 4096 # Open connections each asyncio worker accepts
+ASGI_STREAM_CHUNK_SIZE = 256 * 1024 # File bytes read per step in asyncio mode; about what each slow client keeps buffered
+
+# --- Directory Listing Cache ---
+class DirListingCache:
+    """Bounded LRU cache of directory listings, validated against the directory mtime.
+
+    When inotify_simple is installed each cached directory is watched and its
+    entry dropped as soon as anything inside it changes. Otherwise entries are
+    only trusted for DIR_CACHE_TTL seconds.
+    """
+
+    def __init__(self, max_entries=DIR_CACHE_MAX_ENTRIES, ttl=DIR_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # path -> (mtime_ns, loaded_at, items, watch descriptor)
+        self.watches = {} # watch descriptor -> path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.inotify = None
+        self.watch_mask = 0
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+            except OSError as e:
+                print(f"inotify unavailable, falling back to polling: {e}")
+            else:
+                self.watch_mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MODIFY |
+                                   inotify_flags.ATTRIB | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_FROM |
+                                   inotify_flags.MOVED_TO | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF)
+                threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    def get(self, path, loader):
+        """Return the cached listing for path, calling loader(path) on a miss."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == mtime_ns and (entry[3] is not None or now - entry[1] < self.ttl):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        items = loader(path)
+
+        with self.lock:
+            old = self.entries.pop(path, None)
+            wd = old[3] if old and old[3] is not None else self._add_watch(path)
+            self.entries[path] = (mtime_ns, now, items, wd)
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self._remove_watch(evicted[3])
+                self.evictions += 1
+        return items
+
+    def invalidate(self, path):
+        """Drop the cached listing for path, if any."""
+        with self.lock:
+            entry = self.entries.pop(os.path.abspath(path), None)
+            if entry:
+                self._remove_watch(entry[3])
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'invalidation': 'inotify' if self.inotify else 'poll',
+            }
+
+    def _add_watch(self, path):
+        if not self.inotify:
+            return None
+        try:
+            wd = self.inotify.add_watch(path, self.watch_mask)
+        except OSError:
+            return None # Out of watches or gone already; the TTL still applies
+        self.watches[wd] = path
+        return wd
+
+    def _remove_watch(self, wd):
+        if wd is None or self.watches.pop(wd, None) is None:
+            return
+        try:
+            self.inotify.rm_watch(wd)
+        except OSError:
+            pass # Directory was deleted and the watch is gone already
+
+    def _watch_loop(self):
+        while True:
+            for event in self.inotify.read():
+                with self.lock:
+                    path = self.watches.get(event.wd)
+                if path:
+                    self.invalidate(path)
+
+dir_cache = DirListingCache()
+
+def reset_dir_cache():
+    """Give a newly forked worker process its own cache, since the inotify watcher thread doesn't survive fork."""
+    global dir_cache
+    if dir_cache.inotify:
+        dir_cache.inotify.close()
+    dir_cache = DirListingCache()
+
+# --- Upload Sessions ---
+MANIFEST_HEADER = struct.Struct('<QQ') # total_chunks and the number of chunks recorded, followed by one bit per chunk
+
+class UploadSession:
+    """Tracks which chunks of one upload have arrived and hashes them as they land.
+
+    Received chunks are recorded in a bitmap persisted next to the chunks, so an
+    upload can be resumed after a restart, worker processes can share it, and
+    completion is a counter comparison instead of a stat per chunk. The full-file hash is built while
+    chunks stream in; a chunk that arrives ahead of the next expected one is
+    only read back from disk once the gap before it is filled.
+
+    Each upload has its own directory under CHUNK_DIR, sharded by the first two
+    characters of its id, holding the manifest and, unless the chunks are
+    written at their offsets into a preallocated partial file (partial_path
+    set), one file per chunk. An in-place upload also notes its partial_path
+    there, so the reaper can find the file if the upload is abandoned.
+    """
+
+    def __init__(self, upload_id, file_hash, total_chunks, algorithm=DEFAULT_UPLOAD_HASH, partial_path=None, chunk_size=None, file_size=None):
+        self.upload_id = upload_id
+        self.file_hash = file_hash
+        self.total_chunks = total_chunks
+        self.algorithm = algorithm
+        self.partial_path = partial_path
+        self.chunk_size = chunk_size
+        self.file_size = file_size
+        self.directory = os.path.join(CHUNK_DIR, upload_id[:2], upload_id)
+        self.manifest_path = os.path.join(self.directory, 'manifest')
+        self.bitmap = bytearray((total_chunks + 7) // 8)
+        self.received = 0
+        self.hasher = UPLOAD_HASH_ALGORITHMS[algorithm]()
+        self.hashed_chunks = 0 # Chunks [0, hashed_chunks) have been fed to hasher
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.refresh()
+
+    @property
+    def params(self):
+        return (self.file_hash, self.total_chunks, self.algorithm, self.partial_path, self.chunk_size, self.file_size)
+
+    def refresh(self):
+        """Pick up chunks recorded by other worker processes, returning False if the upload was finished elsewhere.
+
+        As in _record, the bitmap is only read when the count in the header
+        shows that another process has recorded chunks since we last looked.
+        """
+        try:
+            with open(self.manifest_path, 'rb') as f, self.lock:
+                header = f.read(MANIFEST_HEADER.size)
+                if len(header) != MANIFEST_HEADER.size or MANIFEST_HEADER.unpack(header) != (self.total_chunks, self.received):
+                    f.seek(0)
+                    self._merge(f)
+        except FileNotFoundError:
+            return self.received == 0
+        return True
+
+    def _merge(self, f):
+        """OR the bitmap stored in manifest f into ours, returning False if f doesn't hold a manifest for this upload."""
+        header = f.read(MANIFEST_HEADER.size)
+        bitmap = f.read()
+        if len(header) != MANIFEST_HEADER.size or MANIFEST_HEADER.unpack(header)[0] != self.total_chunks or len(bitmap) != len(self.bitmap):
+            return False
+        mine = int.from_bytes(self.bitmap, 'little')
+        new = int.from_bytes(bitmap, 'little') & ~mine
+        if new:
+            self.received += new.bit_count()
+            self.bitmap[:] = (mine | new).to_bytes(len(self.bitmap), 'little')
+        return True
+
+    def has_chunk(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def store_chunk(self, index, stream, chunk_hash=None):
+        """Write one chunk and record it, returning True only for the call that completes the upload.
+
+        Raises ValueError if the chunk doesn't fit the file or doesn't match chunk_hash.
+        """
+        if self.has_chunk(index):
+            return False # Resent after a lost response; keep the copy we already hashed
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            running = self.hasher.copy() if index == self.hashed_chunks else None
+        chunk_hasher = UPLOAD_HASH_ALGORITHMS[self.algorithm]()
+        hashers = (chunk_hasher, running) if running is not None else (chunk_hasher,)
+
+        if self.partial_path:
+            write_chunk_at(self.partial_path, self.file_size, index * self.chunk_size, stream, hashers)
+        else:
+            with open(self.chunk_path(index), 'wb') as f:
+                while block := stream.read(UPLOAD_WRITE_SIZE):
+                    f.write(block)
+                    hash_block(hashers, block)
+
+        if chunk_hash and chunk_hasher.hexdigest() != chunk_hash.lower():
+            raise ValueError("Chunk hash mismatch")
+
+        with self.lock:
+            if not self._record(index):
+                return False
+            if running is not None and self.hashed_chunks == index:
+                self.hasher = running
+                self.hashed_chunks += 1
+            self._catch_up()
+            return self.received == self.total_chunks
+
+    def _catch_up(self):
+        """Feed chunks that arrived out of order to the running hash once the gap before them is filled."""
+        while self.hashed_chunks < self.total_chunks and self.has_chunk(self.hashed_chunks):
+            for block in self.read_chunk(self.hashed_chunks):
+                hash_block((self.hasher,), block)
+            self.hashed_chunks += 1
+
+    def chunk_path(self, index):
+        return os.path.join(self.directory, str(index))
+
+    def read_chunk(self, index):
+        """Yield a stored chunk back from disk."""
+        if self.partial_path:
+            start = index * self.chunk_size
+            yield from read_file_range(self.partial_path, start, min(start + self.chunk_size, self.file_size))
+        else:
+            with open(self.chunk_path(index), 'rb') as f:
+                while block := f.read(UPLOAD_WRITE_SIZE):
+                    yield block
+
+    def finish(self, target_path):
+        """Move a completed upload into place if its hash matches; otherwise discard it."""
+        with self.lock:
+            self._catch_up() # Chunks stored before a restart haven't been hashed yet
+        verified = self.hashed_chunks == self.total_chunks and self.hasher.hexdigest() == self.file_hash
+        if self.partial_path:
+            if verified:
+                os.replace(self.partial_path, target_path)
+            else:
+                os.remove(self.partial_path)
+            self._remove_directory()
+            return verified
+
+        if verified:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path, 'wb') as outfile:
+                for i in range(self.total_chunks):
+                    with open(self.chunk_path(i), 'rb') as infile:
+                        shutil.copyfileobj(infile, outfile, UPLOAD_WRITE_SIZE)
+        for i in range(self.total_chunks):
+            os.remove(self.chunk_path(i))
+        self._remove_directory()
+        return verified
+
+    def discard(self):
+        """Delete whatever was received of an upload that is no longer needed."""
+        paths = [self.partial_path] if self.partial_path else [self.chunk_path(i) for i in range(self.total_chunks) if self.has_chunk(i)]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._remove_directory()
+
+    def _remove_directory(self):
+        """Remove the upload's directory once its manifest and chunks are gone."""
+        try:
+            os.remove(os.path.join(self.directory, 'partial'))
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass # Already gone, or another request started the upload over
+
+    def missing_ranges(self):
+        """Return the chunks still to be sent as [first, last] pairs."""
+        ranges = []
+        with self.lock:
+            for index in range(self.total_chunks):
+                if self.has_chunk(index):
+                    continue
+                if ranges and ranges[-1][1] == index - 1:
+                    ranges[-1][1] = index
+                else:
+                    ranges.append([index, index])
+        return ranges
+
+    def _record(self, index):
+        """Mark a chunk received in the manifest, returning False if it already was.
+
+        The manifest is locked first, so worker processes storing chunks of the
+        same upload never overwrite each other's bits. Every bit we hold is on
+        disk too, so while the recorded count in the header matches ours the
+        bitmaps are the same and only the header needs reading; the whole
+        bitmap is merged only after another process has recorded chunks.
+        """
+        fd = os.open(self.manifest_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        with open(fd, 'r+b') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            header = f.read(MANIFEST_HEADER.size)
+            valid = len(header) == MANIFEST_HEADER.size and MANIFEST_HEADER.unpack(header) == (self.total_chunks, self.received)
+            if not valid:
+                f.seek(0)
+                valid = self._merge(f)
+            if not valid:
+                f.seek(0)
+                f.truncate()
+                f.write(MANIFEST_HEADER.pack(self.total_chunks, self.received) + self.bitmap)
+                if self.partial_path:
+                    with open(os.path.join(self.directory, 'partial'), 'wb') as note:
+                        note.write(os.fsencode(os.path.abspath(self.partial_path)))
+            if self.has_chunk(index):
+                return False
+            byte_index = index >> 3
+            self.bitmap[byte_index] |= 1 << (index & 7)
+            self.received += 1
+            f.seek(MANIFEST_HEADER.size + byte_index)
+            f.write(self.bitmap[byte_index:byte_index + 1])
+            f.seek(0)
+            f.write(MANIFEST_HEADER.pack(self.total_chunks, self.received))
+            return True
+
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+
+def upload_id_for(file_hash, target_path=None):
+    """Key an upload by its content hash, plus its destination when it is assembled in place."""
+    if target_path is None:
+        return file_hash
+    return f"{file_hash}-{hashlib.sha1(os.path.abspath(target_path).encode()).hexdigest()[:16]}"
+
+def get_upload_session(upload_id, file_hash, total_chunks, algorithm=DEFAULT_UPLOAD_HASH, partial_path=None, chunk_size=None, file_size=None):
+    """Return the live session for an upload, resuming from its manifest if there is one."""
+    params = (file_hash, total_chunks, algorithm, partial_path, chunk_size, file_size)
+    with upload_sessions_lock:
+        upload = upload_sessions.get(upload_id)
+        if upload is None or upload.params != params or not upload.refresh():
+            upload = upload_sessions[upload_id] = UploadSession(upload_id, *params)
+        upload.last_used = time.time()
+        return upload
+
+def forget_idle_upload_sessions(now=None):
+    """Drop sessions unused for UPLOAD_SESSION_IDLE seconds, and those whose files the reaper has removed."""
+    now = time.time() if now is None else now
+    with upload_sessions_lock:
+        for upload_id, upload in list(upload_sessions.items()):
+            if now - upload.last_used > UPLOAD_SESSION_IDLE or (upload.received and not os.path.isdir(upload.directory)):
+                del upload_sessions[upload_id]
+
+def end_upload_session(upload):
+    """Forget a finished upload, returning False if another request already ended it."""
+    with upload_sessions_lock:
+        if upload_sessions.get(upload.upload_id) is not upload:
+            return False
+        del upload_sessions[upload.upload_id]
+    try:
+        os.remove(upload.manifest_path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def upload_from_request(fields):
+    """Resolve upload form or query fields to (session, final_dir, target_path), or None if they are invalid.
+
+    Uploads either carry the file hash with every chunk, or name a client-chosen
+    upload_id and send the hash to /upload/finalize once the file is through.
+    Clients that send file_size and chunk_size get chunks written straight into
+    a preallocated file at their offsets; others fall back to separate chunk files.
+
+    Raises PermissionError if the user may not write to the target directory,
+    before any session is created for it.
+    """
+    upload_id = fields.get('upload_id')
+    file_hash = fields.get('file_hash', '').lower()
+    total_chunks = fields.get('total_chunks', 0, type=int)
+    algorithm = fields.get('hash_algorithm', DEFAULT_UPLOAD_HASH)
+    filename = os.path.basename(fields.get('filename', ''))
+    final_dir = os.path.join(fields.get('target_dir', ''), os.path.dirname(fields.get('relative_path', '')))
+    file_size = fields.get('file_size', type=int)
+    chunk_size = fields.get('chunk_size', type=int)
+    in_place = file_size is not None and chunk_size is not None
+
+    if not 1 <= total_chunks <= UPLOAD_MAX_CHUNKS or not filename or algorithm not in UPLOAD_HASH_ALGORITHMS:
+        return None
+    if in_place and (chunk_size < 1 or not 0 <= file_size <= app.config['MAX_CONTENT_LENGTH']
+                     or total_chunks != max(1, -(-file_size // chunk_size))):
+        return None
+    if not is_path_allowed(final_dir):
+        raise PermissionError(final_dir)
+
+    target_path = os.path.join(final_dir, filename)
+    if upload_id is not None:
+        if not in_place or not UPLOAD_ID_RE.fullmatch(upload_id):
+            return None
+        upload = get_upload_session(upload_id, None, total_chunks, algorithm,
+                                    partial_path_for(target_path, upload_id), chunk_size, file_size)
+    elif not valid_upload_hash(file_hash, algorithm):
+        return None
+    elif in_place:
+        upload = get_upload_session(upload_id_for(file_hash, target_path), file_hash, total_chunks, algorithm,
+                                    partial_path_for(target_path, file_hash), chunk_size, file_size)
+    else:
+        upload = get_upload_session(file_hash, file_hash, total_chunks, algorithm)
+    return upload, final_dir, target_path
+
+def complete_upload(upload, target_path, target_dir):
+    """Close a fully received upload and answer with the outcome of its verification."""
+    if not end_upload_session(upload):
+        return jsonify({'message': 'Upload was already completed.'}), 409
+    verified = upload.finish(target_path)
+    dir_cache.invalidate(os.path.dirname(target_path))
+    dir_cache.invalidate(target_dir)
+    if verified:
+        file_index.update_path(target_path)
+        file_index.record_hash(target_path, upload.algorithm, upload.file_hash)
+        if THUMBNAIL_PREWARM and is_thumbnailable(target_path):
+            thumbnails.prewarm(target_path)
+        return jsonify({'message': 'File uploaded and verified successfully!'})
+    return jsonify({'message': 'File verification failed.'}), 500
+
+def complete_from_copy(algorithm, file_hash, file_size, target_path, target_dir):
+    """Complete an upload by cloning a file the user can already read with the same content.
+
+    Returns the response to send, or None if there is no such file and the
+    upload has to go ahead.
+    """
+    if algorithm not in DEDUP_HASH_ALGORITHMS:
+        return None
+    target_path = os.path.abspath(target_path)
+    for source in file_index.copies_of(algorithm, file_hash, file_size):
+        if not is_path_allowed(source):
+            continue
+        if source != target_path:
+            try:
+                method = clone_file(source, target_path)
+            except OSError as e:
+                print(f"Could not copy {source} to {target_path}: {e}")
+                return None
+            dir_cache.invalidate(os.path.dirname(target_path))
+            dir_cache.invalidate(target_dir)
+            file_index.update_path(target_path)
+            file_index.record_hash(target_path, algorithm, file_hash)
+        else:
+            method = 'existing'
+        return jsonify({'message': 'File already on the server, copied without uploading.', 'complete': True, 'deduplicated': method})
+    return None
+
+def clone_file(source, target_path):
+    """Copy source to target_path as cheaply as the filesystem allows, returning how it was done.
+
+    A reflink shares the data until either copy is changed. Failing that a
+    hardlink (if DEDUP_HARDLINKS) or a plain copy is made. The copy is built
+    under a temporary name so target_path never holds a partial file.
+    """
+    directory, name = os.path.split(target_path)
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{name}.{secrets.token_hex(8)}.clone")
+    try:
+        if reflink(source, temp_path):
+            method = 'reflink'
+        else:
+            method = 'copy'
+            if DEDUP_HARDLINKS:
+                try:
+                    os.link(source, temp_path)
+                    method = 'hardlink'
+                except OSError:
+                    pass # Different filesystem, or links not supported
+            if method == 'copy':
+                shutil.copyfile(source, temp_path)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return method
+
+def reflink(source, target_path):
+    """Create target_path sharing source's data blocks, returning False where the filesystem can't."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(source, 'rb') as src, open(target_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(target_path)
+    return False
+
+def valid_upload_hash(file_hash, algorithm):
+    """Check that file_hash looks like a hex digest of a supported upload hash algorithm."""
+    factory = UPLOAD_HASH_ALGORITHMS.get(algorithm)
+    return factory is not None and FILE_HASH_RE.fullmatch(file_hash) is not None and len(file_hash) == 2 * factory().digest_size
+
+def partial_path_for(target_path, file_hash):
+    """Hidden file next to the destination that an in-place upload is written into."""
+    directory, name = os.path.split(target_path)
+    return os.path.join(directory, f".{name}.{file_hash[:16]}.part")
+
+def is_partial_upload(path):
+    """True for the name partial_path_for gives an in-place upload that is still arriving."""
+    return PARTIAL_UPLOAD_RE.fullmatch(os.path.basename(path)) is not None
+
+def preallocate(fd, size):
+    """Reserve size bytes for fd, falling back to a sparse extend where fallocate isn't supported."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+def hash_block(hashers, block):
+    """Feed block to each hasher, counting the time it takes towards the hashing metrics."""
+    with metrics.timed('fileserver_hash_seconds_total'):
+        for hasher in hashers:
+            hasher.update(block)
+    metrics.inc('fileserver_hash_bytes_total', len(block))
+
+def write_chunk_at(path, file_size, offset, stream, hashers=()):
+    """Copy an uploaded chunk into the partial file at offset, creating and preallocating it first if needed."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        if os.fstat(fd).st_size < file_size:
+            preallocate(fd, file_size)
+        while block := stream.read(UPLOAD_WRITE_SIZE):
+            if offset + len(block) > file_size:
+                raise ValueError("Chunk extends past the end of the file")
+            pwrite_all(fd, block, offset)
+            hash_block(hashers, block)
+            offset += len(block)
+    finally:
+        os.close(fd)
+
+# --- JSON Stores ---
+class JsonStore:
+    """A JSON file kept parsed in memory and reloaded only when it is replaced.
+
+    Writes go to a temp file that is renamed over the original, so readers
+    never see a half-written file. Writers hold a thread lock and an flock on
+    a hidden sidecar file, so an edit made by one worker process is never
+    lost to a concurrent edit in another.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory, name = os.path.split(path)
+        self.lock_path = os.path.join(directory, f".{name}.lock")
+        self.lock = threading.RLock()
+        self.lock_file = None # Open while this process holds the flock
+        self.data = None
+        self.version = None
+
+    def load(self):
+        """Return a private copy of the file's contents.
+
+        If the file has gone missing or been damaged, say by a hand edit, the
+        last good copy is used until it is fixed; with no good copy the error
+        is raised.
+        """
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+                version = (st.st_ino, st.st_mtime_ns) # Every save is a new file, even within one mtime tick
+            except FileNotFoundError:
+                version = 'missing'
+            if version != self.version:
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    if self.data is None:
+                        raise
+                    print(f"Could not read {self.path}, using the last good copy: {e}")
+                else:
+                    self.data = data
+                self.version = version
+            return copy.deepcopy(self.data)
+
+    @contextmanager
+    def locked(self):
+        """Hold the store against writers in this process and, where flock exists, in every other."""
+        with self.lock:
+            if fcntl is None or self.lock_file is not None:
+                yield # Already held further up this thread's stack
+                return
+            lock_file = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.lock_file = lock_file
+                yield
+            finally:
+                self.lock_file = None
+                lock_file.close()
+
+    def save(self, data):
+        with self.locked():
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix=f".{os.path.basename(self.path)}.")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.path.exists(self.path):
+                    shutil.copymode(self.path, temp_path)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self.data = copy.deepcopy(data)
+            st = os.stat(self.path)
+            self.version = (st.st_ino, st.st_mtime_ns)
+
+    @contextmanager
+    def edit(self):
+        """Hold the lock while the caller changes the data, then save it if anything changed."""
+        with self.locked():
+            data = self.load()
+            yield data
+            if data != self.data:
+                self.save(data)
+
+users_store = JsonStore(USERS_FILE)
+config_store = JsonStore(CONFIG_FILE)
+
+# --- Upload Reaper ---
+class UploadReaper:
+    """Expires abandoned uploads and keeps their scratch space within a budget.
+
+    Every UPLOAD_REAP_INTERVAL seconds, whichever process holds the reaper lock
+    sweeps CHUNK_DIR. Uploads without a new chunk for UPLOAD_SESSION_TTL are
+    removed, then the least recently active go until the rest fit in
+    UPLOAD_SCRATCH_BUDGET. Uploads that received a chunk in the last
+    UPLOAD_REAP_MIN_IDLE seconds are never dropped to make room. Each sweep
+    saves the usage it found and running totals of what it reclaimed, so any
+    worker can show them on the admin page. Every process also drops the
+    sessions in upload_sessions that have gone unused or lost their files.
+    """
+
+    def __init__(self, stats_path):
+        self.store = JsonStore(stats_path)
+        self.lock_path = f"{stats_path}.lock"
+        self.lock_file = None
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                forget_idle_upload_sessions() # Every process keeps its own sessions
+                if self._holds_lock():
+                    self.sweep()
+            except Exception as e:
+                print(f"Upload reaper error: {e}")
+            time.sleep(UPLOAD_REAP_INTERVAL)
+
+    def _holds_lock(self):
+        """Take the reaper lock if no other process holds it, so only one process sweeps."""
+        if not fcntl or self.lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close() # Another process is reaping
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def sweep(self, now=None):
+        """Remove expired uploads, then the least recently active ones while over budget."""
+        now = time.time() if now is None else now
+        uploads = sorted(scratch_uploads(), key=lambda upload: upload['last_active'])
+        expired = [upload for upload in uploads if now - upload['last_active'] > UPLOAD_SESSION_TTL]
+        kept = uploads[len(expired):]
+        total = sum(upload['size'] for upload in kept)
+        evicted = []
+        for upload in kept:
+            if total <= UPLOAD_SCRATCH_BUDGET or now - upload['last_active'] < UPLOAD_REAP_MIN_IDLE:
+                break
+            evicted.append(upload)
+            total -= upload['size']
+        for upload in expired + evicted:
+            remove_scratch_upload(upload)
+        if expired or evicted:
+            forget_idle_upload_sessions(now)
+        for shard in os.scandir(CHUNK_DIR):
+            try:
+                if shard.is_dir(follow_symlinks=False) and now - shard.stat().st_mtime > UPLOAD_REAP_MIN_IDLE:
+                    os.rmdir(shard.path)
+            except OSError:
+                pass # Still holds uploads
+
+        stats = self.stats()
+        stats.update({
+            'last_sweep': now,
+            'bytes': total,
+            'uploads': len(kept) - len(evicted),
+            'expired': stats['expired'] + len(expired),
+            'evicted': stats['evicted'] + len(evicted),
+            'reclaimed_bytes': stats['reclaimed_bytes'] + sum(upload['size'] for upload in expired + evicted),
+        })
+        del stats['budget']
+        self.store.save(stats)
+
+    def stats(self):
+        stats = {'last_sweep': None, 'bytes': None, 'uploads': None, 'expired': 0, 'evicted': 0, 'reclaimed_bytes': 0}
+        try:
+            stats.update(self.store.load())
+        except FileNotFoundError:
+            pass # No sweep yet
+        stats['budget'] = UPLOAD_SCRATCH_BUDGET
+        return stats
+
+def scratch_uploads():
+    """Describe every unfinished upload in CHUNK_DIR by its files, disk usage and the time it last received a chunk."""
+    uploads = []
+    for shard in os.scandir(CHUNK_DIR):
+        if not shard.is_dir(follow_symlinks=False):
+            # Chunk files and manifests from before uploads had their own directories
+            uploads.append(scratch_upload(shard.path, [shard.path]))
+            continue
+        for entry in os.scandir(shard.path):
+            paths = [f.path for f in os.scandir(entry.path)] if entry.is_dir(follow_symlinks=False) else [entry.path]
+            upload = scratch_upload(entry.path, paths)
+            try:
+                with open(os.path.join(entry.path, 'partial'), 'rb') as note:
+                    upload['partial'] = os.fsdecode(note.read())
+                st = os.stat(upload['partial'])
+            except OSError:
+                pass
+            else:
+                upload['size'] += disk_usage_of(st)
+                upload['last_active'] = max(upload['last_active'], st.st_mtime)
+            uploads.append(upload)
+    return uploads
+
+def scratch_upload(path, files):
+    upload = {'path': path, 'partial': None, 'size': 0, 'last_active': 0}
+    try:
+        # An upload's directory is made just before its first chunk is written, and is
+        # all there is to show the upload is alive until that chunk is recorded
+        upload['last_active'] = os.stat(path, follow_symlinks=False).st_mtime
+    except OSError:
+        pass
+    for file_path in files:
+        try:
+            st = os.stat(file_path, follow_symlinks=False)
+        except OSError:
+            continue
+        upload['size'] += disk_usage_of(st)
+        upload['last_active'] = max(upload['last_active'], st.st_mtime)
+    return upload
+
+def disk_usage_of(stat_result):
+    """Bytes a file actually occupies; a sparse partial file counts only the chunks written so far."""
+    blocks = getattr(stat_result, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else stat_result.st_size
+
+def remove_scratch_upload(upload):
+    """Delete an abandoned upload's chunks, manifest and partial file."""
+    partial = upload['partial']
+    if partial and is_partial_upload(partial):
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+    if os.path.isdir(upload['path']):
+        shutil.rmtree(upload['path'], ignore_errors=True)
+    else:
+        try:
+            os.remove(upload['path'])
+        except OSError:
+            pass
+
+upload_reaper = UploadReaper(REAPER_STATS_FILE)
+
+# --- File Index ---
+class FileIndex:
+    """SQLite index of the name, size, mtime and type of everything under the allowed directories.
+
+    Whichever process takes the index lock walks the tree in a background
+    thread, then follows inotify events (or rescans every INDEX_RESCAN_INTERVAL
+    seconds without inotify). Every process can search the index and record
+    finished uploads in it. Names go into an FTS5 trigram index, so a search
+    matches any part of a name; without FTS5 searches fall back to LIKE.
+
+    dir_sizes keeps each directory's recursive size and file and folder counts.
+    A full rescan rebuilds it in one pass; every other change is added to the
+    totals of the directories above it as it is recorded.
+
+    hashes holds the content hash of every verified upload, with the size and
+    mtime the file had then, so an upload of the same content can be cloned
+    from it. An entry is only trusted while the file still has that size and
+    mtime.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.fts = True
+        self.inotify = None
+        self.watches = {} # watch descriptor -> directory
+        self.watched = {} # directory -> watch descriptor
+        self.watch_mask = 0
+        self.started = False
+
+    def connect(self):
+        """Return this thread's connection, creating the schema on first use."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._create_schema(conn)
+            self.local.conn = conn
+        return conn
+
+    def _create_schema(self, conn):
+        with conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    is_dir INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    type TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+                CREATE INDEX IF NOT EXISTS files_name ON files (name COLLATE NOCASE);
+                CREATE INDEX IF NOT EXISTS files_type ON files (type);
+                CREATE TABLE IF NOT EXISTS dir_sizes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    files INTEGER NOT NULL,
+                    dirs INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS hashes (
+                    path TEXT PRIMARY KEY,
+                    algorithm TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS hashes_hash ON hashes (hash, algorithm);
+                CREATE INDEX IF NOT EXISTS hashes_size ON hashes (size);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            ''')
+        try:
+            with conn:
+                conn.executescript('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5 (name, content='files', content_rowid='rowid', tokenize='trigram');
+                    CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                        INSERT INTO files_fts (rowid, name) VALUES (new.rowid, new.name);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                        INSERT INTO files_fts (files_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+                    END;
+                ''')
+        except sqlite3.OperationalError as e:
+            print(f"SQLite full-text search unavailable, searching names with LIKE: {e}")
+            self.fts = False
+
+    def start(self):
+        """Start the background indexer; it only does work once this process holds the index lock."""
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        if fcntl:
+            self.lock_file = open(f"{self.db_path}.lock", 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX) # Waits here while another process is indexing
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+            except OSError as e:
+                print(f"inotify unavailable, the file index is refreshed by periodic rescans: {e}")
+            else:
+                self.watch_mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.CLOSE_WRITE |
+                                   inotify_flags.ATTRIB | inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO)
+        roots = None
+        next_rescan = 0
+        while True:
+            try:
+                if roots != index_roots() or time.monotonic() >= next_rescan:
+                    roots = index_roots()
+                    self.rescan(roots)
+                    next_rescan = time.monotonic() + INDEX_RESCAN_INTERVAL
+                if self.inotify:
+                    if self._apply_events(roots):
+                        next_rescan = 0
+                else:
+                    time.sleep(1)
+            except Exception as e:
+                print(f"File indexer error: {e}")
+                time.sleep(INDEX_RETRY_DELAY)
+
+    def rescan(self, roots):
+        """Bring the whole index in line with the disk, dropping anything outside roots."""
+        conn = self.connect()
+        self._set_meta(conn, 'scan_started', time.time())
+        clause, params = under_clause(roots)
+        with conn:
+            conn.execute(f"DELETE FROM files WHERE NOT {clause}", params)
+        self._walk(conn, roots, rollup=False)
+        self.rebuild_rollups(conn, roots)
+        self._set_meta(conn, 'last_scan', time.time())
+
+    def _walk(self, conn, directories, rollup=True):
+        """Sync directories and everything below them, committing every INDEX_BATCH_SIZE rows.
+
+        A full rescan passes rollup=False and rebuilds the directory totals in
+        one pass afterwards, rather than updating every ancestor per change.
+        """
+        stack = [d for d in directories if not skip_indexing(d)]
+        pending = 0
+        while stack:
+            path = stack.pop()
+            self._add_watch(path)
+            subdirs, changed = self.sync_directory(conn, path, rollup)
+            stack.extend(d for d in subdirs if not skip_indexing(d))
+            pending += changed
+            if pending >= INDEX_BATCH_SIZE:
+                conn.commit()
+                pending = 0
+        conn.commit()
+
+    def sync_directory(self, conn, path, rollup=True):
+        """Update the rows for path's children, returning (subdirectories, rows changed)."""
+        known = {name: (is_dir, size, mtime) for name, is_dir, size, mtime in
+                 conn.execute('SELECT name, is_dir, size, mtime FROM files WHERE parent = ?', (path,))}
+        rows = []
+        subdirs = []
+        seen = set()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        stat_result = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    row = index_row(entry.path, stat_result)
+                    if not row[3] and is_partial_upload(entry.name):
+                        continue # Not a file until the upload is verified and moved into place
+                    seen.add(entry.name)
+                    if row[3]:
+                        subdirs.append(entry.path)
+                    if known.get(entry.name) != row[3:6]:
+                        rows.append(row)
+        except FileNotFoundError:
+            self._delete(conn, path, rollup)
+            return [], 1
+        except OSError:
+            return [], 0 # Unreadable; keep whatever we knew
+
+        for row in rows:
+            old = known.get(row[2])
+            if old is not None and old[0] != row[3]:
+                self._delete(conn, row[0], rollup) # Swapped between file and directory
+        replaced = [row for row in rows if row[2] in known and known[row[2]][0] == row[3]]
+        added = [row for row in rows if row[2] not in known or known[row[2]][0] != row[3]]
+        conn.executemany(INDEX_UPSERT, rows)
+        conn.executemany('INSERT OR IGNORE INTO dir_sizes (path, size, files, dirs) VALUES (?, 0, 0, 0)',
+                         [(row[0],) for row in added if row[3]])
+        if rollup and rows:
+            size = sum(row[4] for row in rows) - sum(known[row[2]][1] for row in replaced)
+            dirs = sum(row[3] for row in added)
+            self._propagate(conn, path, size, len(added) - dirs, dirs)
+
+        gone = known.keys() - seen
+        for name in gone:
+            self._delete(conn, os.path.join(path, name), rollup)
+        return subdirs, len(rows) + len(gone)
+
+    def update_path(self, path):
+        """Record the current state of one file or directory, and any parent directories missing from the index."""
+        path = os.path.abspath(path)
+        roots = index_roots()
+        if skip_indexing(path) or not any(is_within(path, root) and path != root for root in roots):
+            return
+        if is_partial_upload(path) and not os.path.isdir(path):
+            return
+        conn = self.connect()
+        try:
+            with conn:
+                try:
+                    stat_result = os.stat(path, follow_symlinks=False)
+                except OSError:
+                    self._delete(conn, path)
+                    return
+                missing = []
+                parent = os.path.dirname(path)
+                while parent not in roots and conn.execute('SELECT 1 FROM files WHERE path = ?', (parent,)).fetchone() is None:
+                    missing.append(parent)
+                    parent = os.path.dirname(parent)
+                for directory in reversed(missing):
+                    try:
+                        self._write(conn, index_row(directory, os.stat(directory)))
+                    except OSError:
+                        return
+                self._write(conn, index_row(path, stat_result))
+        except sqlite3.Error as e:
+            print(f"Could not update file index for {path}: {e}") # The next rescan picks it up
+
+    def _write(self, conn, row):
+        """Insert or update one row and carry the change up to its ancestors' directory totals."""
+        old = conn.execute('SELECT is_dir, size FROM files WHERE path = ?', (row[0],)).fetchone()
+        if old is not None and old[0] != row[3]:
+            self._delete(conn, row[0])
+            old = None
+        conn.execute(INDEX_UPSERT, row)
+        if row[3]:
+            conn.execute('INSERT OR IGNORE INTO dir_sizes (path, size, files, dirs) VALUES (?, 0, 0, 0)', (row[0],))
+        if old is None:
+            self._propagate(conn, row[1], row[4], 0 if row[3] else 1, 1 if row[3] else 0)
+        elif old[1] != row[4]:
+            self._propagate(conn, row[1], row[4] - old[1], 0, 0)
+
+    def _delete(self, conn, path, rollup=True):
+        """Drop path and everything below it, taking its share out of its ancestors' directory totals."""
+        row = conn.execute('SELECT is_dir, size FROM files WHERE path = ?', (path,)).fetchone()
+        if rollup and row is not None:
+            if row[0]:
+                size, files, dirs = conn.execute('SELECT size, files, dirs FROM dir_sizes WHERE path = ?', (path,)).fetchone() or (0, 0, 0)
+                self._propagate(conn, os.path.dirname(path), -size, -files, -dirs - 1)
+            else:
+                self._propagate(conn, os.path.dirname(path), -row[1], -1, 0)
+        for table in ('files', 'dir_sizes', 'hashes'):
+            conn.execute(f"DELETE FROM {table} WHERE path = ? OR (path > ? AND path < ?)", (path, path + '/', path + '0'))
+
+    def _propagate(self, conn, directory, size, files, dirs):
+        """Add a change in size and file/folder counts to directory and every directory above it."""
+        ancestors = [directory]
+        while os.path.dirname(ancestors[-1]) != ancestors[-1]:
+            ancestors.append(os.path.dirname(ancestors[-1]))
+        conn.executemany('UPDATE dir_sizes SET size = size + ?, files = files + ?, dirs = dirs + ? WHERE path = ?',
+                         [(size, files, dirs, ancestor) for ancestor in ancestors])
+
+    def rebuild_rollups(self, conn, roots):
+        """Recompute every directory's recursive size and file and folder counts from the files table."""
+        with conn:
+            conn.execute('BEGIN IMMEDIATE') # Uploads recorded meanwhile wait, so none are lost
+            totals = {root: [0, 0, 0] for root in roots}
+            for (path,) in conn.execute('SELECT path FROM files WHERE is_dir'):
+                totals[path] = [0, 0, 0]
+            for parent, size, files, dirs in conn.execute(
+                    'SELECT parent, sum(size), sum(is_dir = 0), sum(is_dir) FROM files GROUP BY parent'):
+                if parent in totals:
+                    totals[parent] = [size, files, dirs]
+            for path in sorted(totals, key=lambda p: p.count('/'), reverse=True):
+                parent = os.path.dirname(path)
+                if path not in roots and parent in totals:
+                    for i, value in enumerate(totals[path]):
+                        totals[parent][i] += value
+            conn.execute('DELETE FROM dir_sizes')
+            conn.executemany('INSERT INTO dir_sizes (path, size, files, dirs) VALUES (?, ?, ?, ?)',
+                             [(path, *values) for path, values in totals.items()])
+
+    def dir_totals(self, paths):
+        """Map each indexed directory in paths to its (size, files, dirs) totals."""
+        paths = list(paths)
+        totals = {}
+        try:
+            conn = self.connect()
+            for start in range(0, len(paths), 500):
+                batch = paths[start:start + 500]
+                totals.update((path, (size, files, dirs)) for path, size, files, dirs in conn.execute(
+                    f"SELECT path, size, files, dirs FROM dir_sizes WHERE path IN ({', '.join('?' * len(batch))})", batch))
+        except sqlite3.Error as e:
+            print(f"Could not read folder sizes from the file index: {e}") # Listings go out without them
+        return totals
+
+    def largest_children(self, path, limit=DISK_USAGE_TOP):
+        """The biggest folders directly inside path, as (path, size, files) rows."""
+        try:
+            return self.connect().execute(
+                'SELECT dir_sizes.path, dir_sizes.size, dir_sizes.files FROM files JOIN dir_sizes ON dir_sizes.path = files.path '
+                'WHERE files.parent = ? AND files.is_dir ORDER BY dir_sizes.size DESC LIMIT ?', (path, limit)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Could not read folder sizes from the file index: {e}")
+            return []
+
+    def _add_watch(self, path):
+        if not self.inotify or path in self.watched:
+            return
+        try:
+            wd = self.inotify.add_watch(path, self.watch_mask)
+        except OSError:
+            return # Out of watches; the periodic rescan still covers this directory
+        self.watches[wd] = path
+        self.watched[path] = wd
+
+    def _apply_events(self, roots):
+        """Apply a batch of inotify events, returning True if events were lost and a full rescan is needed."""
+        events = self.inotify.read(timeout=1000, read_delay=INDEX_EVENT_DELAY)
+        changed = set()
+        new_dirs = set()
+        for event in events:
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                return True
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & inotify_flags.IGNORED:
+                del self.watches[event.wd]
+                self.watched.pop(directory, None)
+                continue
+            if not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & inotify_flags.ISDIR and event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                new_dirs.add(path)
+            else:
+                changed.add(path)
+        for path in changed - new_dirs:
+            self.update_path(path)
+        if new_dirs:
+            for path in new_dirs:
+                self.update_path(path)
+            self._walk(self.connect(), new_dirs)
+        return False
+
+    def search(self, dirs, terms=(), types=(), kind=None, min_size=None, max_size=None,
+               modified_after=None, modified_before=None, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Return (items, next_offset) for entries under dirs whose names contain every term."""
+        if not dirs:
+            return [], None
+        clause, params = under_clause(dirs)
+        where = [clause]
+        long_terms = [t for t in terms if len(t) >= 3] if self.fts else []
+        for term in terms:
+            if term not in long_terms:
+                where.append("files.name LIKE ? ESCAPE '\\'")
+                params.append('%' + re.sub(r'([%_\\])', r'\\\1', term) + '%')
+        if types:
+            where.append(f"files.type IN ({', '.join('?' * len(types))})")
+            params.extend(types)
+        if kind is not None:
+            where.append('files.is_dir = ?')
+            params.append(int(kind == 'dir'))
+        for column, op, value in (('size', '>=', min_size), ('size', '<=', max_size),
+                                  ('mtime', '>=', modified_after), ('mtime', '<=', modified_before)):
+            if value is not None:
+                where.append(f"files.{column} {op} ?")
+                params.append(value)
+
+        if long_terms:
+            sql = 'SELECT files.* FROM files_fts JOIN files ON files.rowid = files_fts.rowid WHERE files_fts MATCH ? AND '
+            params.insert(0, ' '.join('"' + t.replace('"', '""') + '"' for t in long_terms))
+        else:
+            sql = 'SELECT files.* FROM files WHERE '
+        sql += ' AND '.join(where) + ' ORDER BY files.name COLLATE NOCASE, files.path LIMIT ? OFFSET ?'
+        rows = self.connect().execute(sql, params + [limit + 1, offset]).fetchall()
+        items = [{'name': name, 'is_dir': bool(is_dir), 'path': path, 'size': size, 'mtime': mtime, 'type': file_type}
+                 for path, parent, name, is_dir, size, mtime, file_type in rows[:limit]]
+        return items, offset + limit if len(rows) > limit else None
+
+    def record_hash(self, path, algorithm, file_hash):
+        """Remember the content hash of a file, so later uploads of the same content can be cloned from it."""
+        try:
+            st = os.stat(path)
+            with self.connect() as conn:
+                conn.execute('INSERT INTO hashes (path, algorithm, hash, size, mtime_ns) VALUES (?, ?, ?, ?, ?) '
+                             'ON CONFLICT(path) DO UPDATE SET algorithm = excluded.algorithm, hash = excluded.hash, '
+                             'size = excluded.size, mtime_ns = excluded.mtime_ns',
+                             (os.path.abspath(path), algorithm, file_hash, st.st_size, st.st_mtime_ns))
+        except (OSError, sqlite3.Error) as e:
+            print(f"Could not record the hash of {path}: {e}")
+
+    def copies_of(self, algorithm, file_hash, size=None):
+        """Yield files whose content had file_hash and that are unchanged since, forgetting any that have changed."""
+        try:
+            conn = self.connect()
+            rows = conn.execute('SELECT path, size, mtime_ns FROM hashes WHERE hash = ? AND algorithm = ?',
+                                (file_hash, algorithm)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Could not look up file hashes: {e}")
+            return
+        for path, recorded_size, mtime_ns in rows:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode) or (st.st_size, st.st_mtime_ns) != (recorded_size, mtime_ns):
+                try:
+                    with conn:
+                        conn.execute('DELETE FROM hashes WHERE path = ? AND mtime_ns = ?', (path, mtime_ns))
+                except sqlite3.Error:
+                    pass # Only a stale entry; it is checked again next time
+            elif size is None or size == recorded_size:
+                yield path
+
+    def has_size(self, size, allowed):
+        """Whether any hashed file of exactly size bytes passes allowed, i.e. whether an upload of that size might be a copy."""
+        try:
+            rows = self.connect().execute('SELECT path FROM hashes WHERE size = ?', (size,))
+            return any(allowed(path) for path, in rows)
+        except sqlite3.Error as e:
+            print(f"Could not look up file hashes: {e}")
+            return False
+
+    def _set_meta(self, conn, key, value):
+        with conn:
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
+
+    def stats(self):
+        conn = self.connect()
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        started, finished = meta.get('scan_started'), meta.get('last_scan')
+        return {
+            'entries': conn.execute('SELECT count(*) FROM files').fetchone()[0],
+            'hashed_files': conn.execute('SELECT count(*) FROM hashes').fetchone()[0],
+            'full_text': self.fts,
+            'scanning': started is not None and (finished is None or finished < started),
+            'last_scan': finished,
+        }
+
+INDEX_UPSERT = '''
+    INSERT INTO files (path, parent, name, is_dir, size, mtime, type) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET is_dir = excluded.is_dir, size = excluded.size, mtime = excluded.mtime, type = excluded.type
+'''
+
+def index_row(path, stat_result):
+    """Row for the files table describing path."""
+    is_dir = stat.S_ISDIR(stat_result.st_mode)
+    name = os.path.basename(path)
+    file_type = '' if is_dir else os.path.splitext(name)[1][1:].lower()
+    return (path, os.path.dirname(path), name, int(is_dir), 0 if is_dir else stat_result.st_size, stat_result.st_mtime, file_type)
+
+def is_within(path, directory):
+    return directory == '/' or path == directory or path.startswith(directory + '/')
+
+def under_clause(dirs):
+    """SQL condition and parameters matching index rows at or below any of dirs."""
+    parts = []
+    params = []
+    for d in dirs:
+        d = os.path.abspath(d)
+        if d == '/':
+            return '1', []
+        parts.append('(files.path = ? OR (files.path > ? AND files.path < ?))')
+        params.extend((d, d + '/', d + '0'))
+    return '(' + (' OR '.join(parts) or '0') + ')', params
+
+def index_roots():
+    """The allowed directories to index, leaving out any nested inside another."""
+    roots = []
+    for d in sorted({os.path.abspath(d) for d in get_config().get('allowed_directories', [])}):
+        if not any(is_within(d, root) for root in roots):
+            roots.append(d)
+    return roots
+
+def skip_indexing(path):
+    """Pseudo filesystems and the server's own data are never indexed."""
+    return any(is_within(path, d) for d in INDEX_SKIP_DIRS) or any(
+        is_within(path, os.path.abspath(d)) for d in (DATA_DIR, UPLOADS_DIR))
+
+file_index = FileIndex(INDEX_DB)
+
+# --- Disk Caches ---
+class DiskCache:
+    """Files derived from other files, kept in a directory of bounded size.
+
+    Entries are named after a hash of their key, which includes the source's
+    mtime and size, so a changed source simply gets a new entry. Using an
+    entry bumps its atime; once the cache outgrows max_bytes the least
+    recently used entries are removed until it is back under 90%. Worker
+    processes share the directory, each keeping its own running estimate of
+    the total and sweeping when that goes over.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.used = None # Estimated bytes on disk; unknown until the first sweep
+        self.sweeping = False
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, key, suffix):
+        digest = hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.{suffix}")
+
+    def lookup(self, path):
+        """Return True and mark the entry used if path is in the cache."""
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime)) # Only atime, so ETags stay put
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def added(self, path):
+        """Count a new entry towards the size of the cache, sweeping if it has grown too big."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            if self.used is not None:
+                self.used += size
+            if self.sweeping or (self.used is not None and self.used <= self.max_bytes):
+                return
+            self.sweeping = True
+        threading.Thread(target=self.sweep, daemon=True).start()
+
+    def sweep(self):
+        """Remove the least recently used entries until the cache is back under 90% of max_bytes."""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp') and st.st_mtime > time.time() - 3600:
+                    continue # Still being written
+                files.append((st.st_atime, st.st_size, path))
+        total = sum(size for atime, size, path in files)
+        if total > self.max_bytes:
+            files.sort()
+            for atime, size, path in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+        with self.lock:
+            self.used = total
+            self.sweeping = False
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self.used, 'max_bytes': self.max_bytes}
+
+# --- Thumbnails ---
+class ThumbnailCache(DiskCache):
+    """Resized previews of images, rendered in a process pool and kept in a DiskCache."""
+
+    def __init__(self, directory, max_bytes=THUMBNAIL_CACHE_BYTES):
+        super().__init__(directory, max_bytes)
+        self.pool = None
+        self.pending = {} # cache path -> Future of its render
+        self.renders = 0
+        self.failures = 0
+
+    def path_for(self, source, stat_result, size):
+        return self.entry_path(f"{source}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}\0{size}", THUMBNAIL_FORMAT.lower())
+
+    def get(self, source, size, timeout=THUMBNAIL_TIMEOUT):
+        """Return the path of source's preview, rendering it first if it isn't cached."""
+        target = self.path_for(source, os.stat(source), size)
+        if not self.lookup(target):
+            self.render(source, target, size).result(timeout)
+        return target
+
+    def prewarm(self, source):
+        """Start rendering source's small preview without waiting for it."""
+        try:
+            target = self.path_for(source, os.stat(source), THUMBNAIL_SIZES['small'])
+        except OSError:
+            return
+        if not os.path.exists(target):
+            self.render(source, target, THUMBNAIL_SIZES['small'])
+
+    def render(self, source, target, size):
+        """Queue a render of target, or return the one already under way."""
+        with self.lock:
+            future = self.pending.get(target)
+            if future is not None:
+                return future
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                future = self._pool().submit(render_thumbnail, source, target, size, THUMBNAIL_FORMAT)
+            except BrokenProcessPool:
+                self.pool = None # A render crashed its process; start over with a fresh pool
+                future = self._pool().submit(render_thumbnail, source, target, size, THUMBNAIL_FORMAT)
+            self.pending[target] = future
+        future.add_done_callback(lambda f: self._rendered(target, f))
+        return future
+
+    def _pool(self):
+        if self.pool is None:
+            # Spawned rather than forked, since this process is already running threads
+            self.pool = ProcessPoolExecutor(THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool
+
+    def _rendered(self, target, future):
+        failed = future.exception() is not None
+        with self.lock:
+            self.pending.pop(target, None)
+            if failed:
+                self.failures += 1
+            else:
+                self.renders += 1
+        if not failed:
+            self.added(target)
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats.update({
+                'available': Image is not None,
+                'format': THUMBNAIL_FORMAT,
+                'renders': self.renders,
+                'failures': self.failures,
+                'rendering': len(self.pending),
+            })
+        return stats
+
+def render_thumbnail(source, target, size, image_format):
+    """Write a preview of source, at most size pixels on its longest side, to target. Runs in the thumbnail process pool."""
+    temp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (size, size)) # JPEGs are decoded at a fraction of their full resolution
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+                has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+                image = image.convert('RGBA' if has_alpha and image_format != 'JPEG' else 'RGB')
+            image.save(temp_path, image_format, quality=THUMBNAIL_QUALITY)
+        os.replace(temp_path, target)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def is_thumbnailable(path):
+    return Image is not None and os.path.splitext(path)[1].lower() in THUMBNAIL_EXTENSIONS
+
+thumbnails = ThumbnailCache(THUMBNAIL_DIR)
+
+# --- Response Compression ---
+class BrotliCompressor:
+    """brotli.Compressor with the compress/flush interface of zlib's compressobj."""
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+    def sync(self):
+        return self.compressor.flush()
+
+def new_compressor(encoding):
+    """Return a streaming compressor for the content coding, with compress(data) and flush() methods."""
+    level = COMPRESSION_LEVELS[encoding]
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if encoding == 'br':
+        return BrotliCompressor(level)
+    return zlib.compressobj(level, zlib.DEFLATED, 31) # wbits 31 writes a gzip header and trailer
+
+def compress_stream(chunks, encoding, sync=False):
+    """Yield chunks compressed with the content coding.
+
+    With sync, everything compressed so far is flushed out after each chunk,
+    so a client reading a streamed response isn't left waiting on data the
+    compressor is holding back.
+    """
+    compressor = new_compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if sync:
+            data += sync_flush(compressor, encoding)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def sync_flush(compressor, encoding):
+    """Return what compressor has buffered, ending at a byte boundary the client can decode up to, without ending the stream."""
+    if encoding == 'zstd':
+        return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    if encoding == 'br':
+        return compressor.sync()
+    return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def is_compressible_type(mimetype):
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES or mimetype.endswith(('+json', '+xml'))
+
+def is_compressible_file(path, mimetype):
+    """True for text files worth compressing; archives and media are left alone whatever their type says."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in STORED_EXTENSIONS:
+        return False
+    return ext in COMPRESSIBLE_EXTENSIONS or is_compressible_type(mimetype)
+
+class CompressedFileCache(DiskCache):
+    """Compressed copies of text files, so repeat downloads are sent without compressing them again.
+
+    A file's first download in an encoding is compressed while it is sent and
+    written to the cache alongside; the copy is only kept if the whole file
+    went out and hasn't changed in the meantime.
+    """
+
+    def __init__(self, directory, max_bytes=COMPRESS_CACHE_BYTES):
+        super().__init__(directory, max_bytes)
+        self.compressions = 0
+
+    def path_for(self, source, stat_result, encoding):
+        return self.entry_path(f"{source}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}\0{encoding}", encoding)
+
+    def response(self, source, stat_result, mimetype, encoding):
+        """Response body of source in the content coding, from the cache when it is there."""
+        target = self.path_for(source, stat_result, encoding)
+        if self.lookup(target):
+            try:
+                size = os.path.getsize(target)
+            except OSError:
+                pass # Swept in the meantime
+            else:
+                response = Response(file_body(target, 0, size), mimetype=mimetype, direct_passthrough=True)
+                response.content_length = size
+                return response
+        return Response(self.compress(source, stat_result, target, encoding), mimetype=mimetype, direct_passthrough=True)
+
+    def compress(self, source, stat_result, target, encoding):
+        """Yield source compressed with the content coding, keeping a copy at target once it is all sent."""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        compressor = new_compressor(encoding)
+        complete = False
+        try:
+            with open(temp_path, 'wb') as out:
+                for chunk in read_file_range(source, 0, stat_result.st_size):
+                    if data := compressor.compress(chunk):
+                        out.write(data)
+                        yield data
+                data = compressor.flush()
+                out.write(data)
+                yield data
+            try:
+                st = os.stat(source)
+            except OSError:
+                pass
+            else:
+                complete = (st.st_mtime_ns, st.st_size) == (stat_result.st_mtime_ns, stat_result.st_size)
+        finally:
+            if complete:
+                os.replace(temp_path, target)
+                with self.lock:
+                    self.compressions += 1
+                self.added(target)
+            else:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats.update({'encodings': COMPRESSION_ENCODINGS, 'compressions': self.compressions})
+        return stats
+
+compressed_files = CompressedFileCache(COMPRESS_CACHE_DIR)
+
+# --- Metrics ---
+METRICS = {
+    'fileserver_requests_total': ('counter', "Requests answered, by route, method and status."),
+    'fileserver_request_duration_seconds': ('histogram', "Time from receiving a request to its response headers, by route and method."),
+    'fileserver_request_bytes_total': ('counter', "Request body bytes received, by route and user."),
+    'fileserver_response_bytes_total': ('counter', "Response body bytes sent, by route and user."),
+    'fileserver_active_streams': ('gauge', "Files and folder archives being sent."),
+    'fileserver_active_uploads': ('gauge', "Upload chunk requests in progress."),
+    'fileserver_zip_seconds_total': ('counter', "Time spent building folder archives."),
+    'fileserver_zip_bytes_total': ('counter', "Bytes of folder archives built."),
+    'fileserver_hash_seconds_total': ('counter', "Time spent hashing uploaded data."),
+    'fileserver_hash_bytes_total': ('counter', "Bytes of uploaded data hashed."),
+    'fileserver_cache_hits_total': ('counter', "Lookups answered from a cache."),
+    'fileserver_cache_misses_total': ('counter', "Lookups a cache couldn't answer."),
+    'fileserver_upload_scratch_uploads': ('gauge', "Unfinished uploads in the chunk store at the last reaper sweep."),
+    'fileserver_upload_scratch_bytes': ('gauge', "Disk space used by unfinished uploads at the last reaper sweep."),
+    'fileserver_workers': ('gauge', "Worker processes whose metrics are included."),
+}
+
+class Metrics:
+    """Prometheus counters, gauges and histograms of this worker process.
+
+    Recording a value only takes a lock and adds to a number. Each worker
+    writes its values to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds and
+    /metrics adds up the files of the workers still running, so a scrape sees
+    the whole server whichever worker answers it. A worker that exits takes
+    its counts with it, which Prometheus treats as a counter reset.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {} # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        """Move a gauge up or down by value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(METRICS_LATENCY_BUCKETS, value)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(METRICS_LATENCY_BUCKETS) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Add the time spent in the block to a seconds counter."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """This process's values, along with the counts its caches and upload limiter keep themselves."""
+        counters = {}
+        for cache, stats in (('dir_listing', dir_cache.stats()), ('thumbnails', thumbnails.stats()),
+                             ('compressed_files', compressed_files.stats())):
+            counters[('fileserver_cache_hits_total', (('cache', cache),))] = stats['hits']
+            counters[('fileserver_cache_misses_total', (('cache', cache),))] = stats['misses']
+        with upload_streams_lock:
+            uploads = sum(upload_streams.values())
+        with self.lock:
+            counters.update(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+        gauges[('fileserver_active_uploads', ())] = uploads
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in gauges.items()],
+            'histograms': [[name, labels, counts] for (name, labels), counts in histograms.items()],
+        }
+
+    def start(self):
+        """Start writing this process's values where the other workers' /metrics can read them."""
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        while True:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(temp_path, 'w') as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f"Error writing metrics: {e}")
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    def collect(self):
+        """Add up the snapshots of this process and of every other worker that has written one recently."""
+        snapshots = [self.snapshot()]
+        own = f"{os.getpid()}.json"
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name == own or not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < time.time() - 3 * METRICS_FLUSH_INTERVAL:
+                    os.remove(path) # Its worker has exited
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in snapshots:
+            for totals, kind in ((counters, 'counters'), (gauges, 'gauges')):
+                for name, labels, value in snapshot[kind]:
+                    key = (name, tuple(tuple(label) for label in labels))
+                    totals[key] = totals.get(key, 0) + value
+            for name, labels, counts in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+        gauges[('fileserver_workers', ())] = len(snapshots)
+        return counters, gauges, histograms
+
+metrics = Metrics(METRICS_DIR)
+
+def metric_labels(labels, **extra):
+    """Format labels as a Prometheus label set, or '' when there are none."""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in pairs) + '}'
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics(counters, gauges, histograms):
+    """Render collected values in the Prometheus text exposition format."""
+    samples = {}
+    for totals in (counters, gauges):
+        for (name, labels), value in sorted(totals.items()):
+            samples.setdefault(name, []).append(f"{name}{metric_labels(labels)} {value}")
+    for (name, labels), counts in sorted(histograms.items()):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(METRICS_LATENCY_BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{metric_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{name}_sum{metric_labels(labels)} {counts[-1]}")
+        lines.append(f"{name}_count{metric_labels(labels)} {cumulative}")
+    out = []
+    for name in sorted(samples):
+        kind, description = METRICS[name]
+        out.append(f"# HELP {name} {description}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(samples[name])
+    return '\n'.join(out) + '\n'
+
+class CountedBody:
+    """Streamed response body that counts the bytes handed to the server once it is closed.
+
+    close() is passed on to the wrapped body, so the files and generators
+    behind it are released even when the client goes away early.
+    """
+
+    def __init__(self, body, route, user):
+        self.body = body
+        self.route = route
+        self.user = user
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            count_response_bytes(self.sent, self.route, self.user)
+
+def count_response_bytes(sent, route, user):
+    metrics.inc('fileserver_response_bytes_total', sent, route=route, user=user)
+
+def timed_archive(chunks):
+    """Yield a folder archive, counting the time spent building it but not the time spent waiting on the client."""
+    metrics.add('fileserver_active_streams', 1, kind='archive')
+    try:
+        while True:
+            with metrics.timed('fileserver_zip_seconds_total'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            metrics.inc('fileserver_zip_bytes_total', len(chunk))
+            yield chunk
+    finally:
+        metrics.add('fileserver_active_streams', -1, kind='archive')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Count the request towards the metrics. Registered first so it runs last, after compression."""
+    route = request.endpoint or 'unmatched'
+    user = session['user'].get('username', '') if session.accessed and 'user' in session else ''
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    metrics.inc('fileserver_requests_total', route=route, method=request.method, status=response.status_code)
+    metrics.observe('fileserver_request_duration_seconds', elapsed, route=route, method=request.method)
+    if request.content_length:
+        metrics.inc('fileserver_request_bytes_total', request.content_length, route=route, user=user)
+    if request.method == 'HEAD' or response.status_code in (204, 304):
+        pass
+    elif not response.is_streamed:
+        count_response_bytes(response.calculate_content_length() or 0, route, user)
+    elif g.get('file_range') is not None:
+        # Left as the server's file wrapper so it can still use sendfile; the file knows how far it got
+        g.file_range.on_close = partial(count_response_bytes, route=route, user=user)
+    else:
+        # Content-Length is what we meant to send; a client that goes away early gets less
+        response.response = CountedBody(response.response, route, user)
+    return response
+
+# --- Helper Functions ---
+def setup():
+    """Create necessary directories and files if they don't exist."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    os.makedirs(CHUNK_DIR, exist_ok=True)
+    if not os.path.exists(USERS_FILE):
+        with open(USERS_FILE, 'w') as f:
+            json.dump({}, f)
+    if not os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump({'allowed_directories': ['/']}, f)
+
+def get_users():
+    """Load user data from the JSON file."""
+    return users_store.load()
+
+def save_users(users):
+    """Save user data to the JSON file."""
+    users_store.save(users)
+
+def get_config():
+    """Load configuration from the JSON file."""
+    return config_store.load()
+
+def save_config(config):
+    """Save configuration to the JSON file."""
+    config_store.save(config)
+
+def is_admin_setup():
+    """Check if an admin user has been created."""
+    users = get_users()
+    for user in users.values():
+        if user.get('is_admin'):
+            return True
+    return False
+
+def get_user_dirs():
+    user = session['user']
+    config = get_config()
+    if user.get('is_admin'):
+        return config['allowed_directories']
+    return user.get('allowed_dirs', [])
+
+def split_path(path):
+    """Normalize a path and split it into its components."""
+    return [part for part in os.path.normcase(os.path.abspath(path)).split(os.sep) if part]
+
+class PathAuthorizer:
+    """Answers whether a path lies inside one of a user's allowed directories.
+
+    The directories are normalized once into a trie of path components, so a
+    lookup costs one step per component of the path, and /data never lets
+    /data2 through.
+    """
+
+    def __init__(self, roots):
+        self.trie = {}
+        for root in roots:
+            node = self.trie
+            for part in split_path(root):
+                node = node.setdefault(part, {})
+            node[None] = True # Marks an allowed directory
+
+    def allows(self, path):
+        node = self.trie
+        if None in node:
+            return True
+        for part in split_path(path):
+            node = node.get(part)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+@lru_cache(maxsize=256)
+def path_authorizer(user_dirs):
+    """Compile an authorizer for a tuple of allowed directories, once per distinct set."""
+    return PathAuthorizer(user_dirs)
+
+def is_path_allowed(path):
+    """Check a path against the current user's allowed directories."""
+    return path_authorizer(tuple(get_user_dirs())).allows(path)
+
+def build_dir_tree(path, depth=1, cursor=None, limit=DIR_TREE_PAGE_SIZE):
+    """Return one page of subdirectories of an allowed path and the cursor for the next page.
+
+    Directories are ordered by name and the cursor is the last name returned, so
+    a page only costs one scandir of path no matter how wide or deep it is.
+    Subdirectories are expanded while depth > 1; below that their children are
+    left as None for the client to fetch on demand. Everything under an allowed
+    directory is allowed too, so entries need no authorization check of their own.
+    """
+    if not os.path.isdir(path):
+        return [], None
+
+    names = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if cursor is not None and entry.name <= cursor:
+                    continue
+                try:
+                    if entry.is_dir():
+                        names.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        pass # Unreadable, or removed while the tree was being walked; show it as empty
+
+    page = heapq.nsmallest(limit + 1, names)
+    next_cursor = page[limit - 1] if len(page) > limit else None
+    tree = [tree_node(name, os.path.join(path, name), depth - 1) for name in page[:limit]]
+    return tree, next_cursor
+
+def tree_node(name, path, depth=0):
+    """Build a directory tree node, expanding its children depth levels down."""
+    node = {'name': name, 'path': path, 'children': None, 'next_cursor': None}
+    if depth > 0:
+        node['children'], node['next_cursor'] = build_dir_tree(path, depth)
+    return node
+
+def browse_item(entry):
+    """Describe one directory entry for /api/browse, or None if it vanished or can't be read."""
+    try:
+        stat_result = entry.stat()
+        is_dir = entry.is_dir()
+    except OSError:
+        return None
+    return {
+        'name': entry.name,
+        'is_dir': is_dir,
+        'path': entry.path,
+        'size': stat_result.st_size if not is_dir else 0,
+        'mtime': stat_result.st_mtime,
+    }
+
+def scan_directory(path):
+    """List a directory for /api/browse, giving folders their indexed size so they sort by it."""
+    with os.scandir(path) as entries:
+        items = [item for item in map(browse_item, entries) if item is not None]
+    totals = file_index.dir_totals(item['path'] for item in items if item['is_dir'])
+    for item in items:
+        if item['path'] in totals:
+            item['size'] = totals[item['path']][0]
+    return DirListing(items)
+
+def with_dir_totals(items):
+    """Copy items, giving each folder its current recursive size and file count from the index.
+
+    Cached listings only notice changes to the directory itself, so the totals
+    are looked up again for every page. Folders the index hasn't reached yet
+    get a size and file_count of None.
+    """
+    totals = file_index.dir_totals(item['path'] for item in items if item['is_dir'])
+    result = []
+    for item in items:
+        if item['is_dir']:
+            size, files, dirs = totals.get(item['path'], (None, None, None))
+            item = dict(item, size=size, file_count=files)
+        result.append(item)
+    return result
+
+class DirListing:
+    """The entries of one scanned directory, with the sorted and filtered views asked of it.
+
+    Views are built on first use and kept alongside the cached listing, so
+    paging through a large directory sorts and filters it once rather than
+    once per page. Folders always come before files.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.views = OrderedDict() # (sort, descending, pattern) -> items
+        self.lock = threading.Lock()
+
+    def view(self, sort='name', descending=False, pattern=None):
+        key = (sort, descending, pattern)
+        with self.lock:
+            if key in self.views:
+                self.views.move_to_end(key)
+                return self.views[key]
+
+        items = self.items if pattern is None else [item for item in self.items if name_matches(item['name'], pattern)]
+        items = sorted(items, key=BROWSE_SORT_KEYS[sort], reverse=descending)
+        items.sort(key=lambda item: not item['is_dir'])
+
+        with self.lock:
+            self.views[key] = items
+            while len(self.views) > BROWSE_MAX_VIEWS:
+                self.views.popitem(last=False)
+        return items
+
+BROWSE_SORT_KEYS = {
+    'name': lambda item: (item['name'].lower(), item['name']),
+    'size': lambda item: (item['size'], item['name'].lower()),
+    'mtime': lambda item: (item['mtime'], item['name'].lower()),
+    'type': lambda item: (os.path.splitext(item['name'])[1].lower(), item['name'].lower()),
+}
+
+def name_filter(fields):
+    """Read the glob or prefix filter from request fields as a lowercase glob pattern, or None."""
+    pattern = fields.get('glob', '')
+    if not pattern and fields.get('prefix'):
+        pattern = glob_escape(fields['prefix']) + '*'
+    return pattern.lower() or None
+
+def page_bounds(fields, page_size, max_page_size):
+    """Read offset and limit from request fields, capping limit at max_page_size, or return None if either is invalid."""
+    try:
+        offset = int(fields.get('offset', 0))
+        limit = int(fields.get('limit', page_size))
+    except ValueError:
+        return None
+    if offset < 0 or limit < 1:
+        return None
+    return offset, min(limit, max_page_size)
+
+def glob_escape(text):
+    return re.sub(r'([*?\[])', r'[\1]', text)
+
+def name_matches(name, pattern):
+    """Case-insensitive glob match of a file name."""
+    return fnmatch.fnmatchcase(name.lower(), pattern)
+
+def stream_directory_page(path, entries, pattern, offset, limit):
+    """Yield a JSON page of scandir entries in on-disk order as they are read, without listing the whole directory.
+
+    Entries go out in batches of about BROWSE_STREAM_BATCH_BYTES, or sooner when
+    the directory is slow to read, since every piece yielded is flushed on its
+    own when the response is compressed.
+    """
+    batch = [f'{{"path": {json.dumps(path)}, "sort": "none", "offset": {offset}, "items": [']
+    batch_size = 0
+    batch_started = time.monotonic()
+    sent = 0
+    skipped = 0
+    next_offset = None
+    with entries:
+        for entry in entries:
+            if pattern is not None and not name_matches(entry.name, pattern):
+                continue
+            item = browse_item(entry)
+            if item is None:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if sent == limit:
+                next_offset = offset + limit
+                break
+            if item['is_dir']:
+                item = with_dir_totals([item])[0]
+            text = (', ' if sent else '') + json.dumps(item)
+            batch.append(text)
+            batch_size += len(text)
+            sent += 1
+            if batch_size >= BROWSE_STREAM_BATCH_BYTES or time.monotonic() - batch_started >= BROWSE_STREAM_BATCH_SECONDS:
+                yield ''.join(batch)
+                batch.clear()
+                batch_size = 0
+                batch_started = time.monotonic()
+    batch.append(f'], "total": null, "next_offset": {json.dumps(next_offset)}}}')
+    yield ''.join(batch)
+
+class ZipStream(io.RawIOBase):
+    """Write-only sink that lets ZipFile stream into a response instead of a file."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def generate_zip(folder, compression='auto'):
+    """Yield a ZIP archive of folder as it is built, without staging it on disk.
+
+    The output is never seeked, so entries carry data descriptors and switch to
+    ZIP64 as needed. In 'auto' mode files that are already compressed are
+    stored rather than deflated.
+    """
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as zf:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames.sort()
+            arc_dir = os.path.relpath(dirpath, folder)
+            if arc_dir != '.':
+                zf.writestr(zipfile.ZipInfo.from_file(dirpath, arc_dir), b'')
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                arcname = os.path.normpath(os.path.join(arc_dir, name))
+                try:
+                    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                    infile = open(path, 'rb')
+                except OSError as e:
+                    print(f"Skipping {path} while zipping: {e}")
+                    continue
+                if compression == 'store' or (compression == 'auto' and os.path.splitext(name)[1].lower() in STORED_EXTENSIONS):
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                # Once the entry has started a failed read can't be skipped: closing the entry would
+                # record a truncated file with a matching CRC. The error ends the response instead,
+                # so the client sees a failed download rather than a corrupt archive that looks fine.
+                with infile, zf.open(zinfo, 'w', force_zip64=zinfo.file_size >= ZIP64_THRESHOLD) as outfile:
+                    while chunk := infile.read(ZIP_READ_SIZE):
+                        outfile.write(chunk)
+                        yield sink.drain()
+                yield sink.drain()
+    yield sink.drain() # Central directory
+
+def content_disposition(filename):
+    """Build an attachment Content-Disposition header that survives any file name.
+
+    filename is an escaped printable-ASCII fallback for old clients; when the
+    real name differs from it, filename* carries the real name (RFC 5987).
+    """
+    fallback = ''.join(c if ' ' <= c <= '~' else '_' for c in filename)
+    header = 'attachment; filename="{}"'.format(fallback.replace('\\', '\\\\').replace('"', '\\"'))
+    if fallback != filename:
+        header += f"; filename*=UTF-8''{quote(filename)}"
+    return header
+
+class FileRange:
+    """File-like view of bytes [start, end) of a file on disk.
+
+    Handed to the server's wsgi.file_wrapper, which servers such as gunicorn
+    turn into os.sendfile on fileno() bounded by Content-Length, so the bytes
+    never pass through Python. read() keeps pure-Python wrappers inside the
+    range as well.
+    """
+
+    def __init__(self, path, start, end):
+        self.file = open(path, 'rb', buffering=0)
+        metrics.add('fileserver_active_streams', 1, kind='file')
+        self.file.seek(start)
+        self.start = start
+        self.remaining = end - start
+        self.sent = 0
+        self.on_close = None # Called with self.sent
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.file.fileno(), start, self.remaining, os.POSIX_FADV_SEQUENTIAL)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        self.sent += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # socket.sendfile() seeks to just past what it sent, even when the client went away;
+        # gunicorn rewinds the descriptor afterwards, so remember how far it got
+        position = self.file.seek(offset, whence)
+        self.sent = max(self.sent, position - self.start)
+        return position
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            metrics.add('fileserver_active_streams', -1, kind='file')
+            if self.on_close is not None:
+                self.on_close(self.sent)
+
+    def __del__(self):
+        if hasattr(self, 'file'):
+            self.close() # Bodies of HEAD responses are dropped without being closed
+
+def read_file_range(path, start, end):
+    """Yield bytes [start, end) of path in STREAM_CHUNK_SIZE pieces."""
+    source = FileRange(path, start, end)
+    try:
+        while chunk := source.read(STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        source.close()
+
+def file_body(path, start, end):
+    """Response body for bytes [start, end) of path, zero-copy when the server offers a file wrapper."""
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        g.file_range = FileRange(path, start, end) # record_request counts the bytes it serves
+        return file_wrapper(g.file_range, STREAM_CHUNK_SIZE)
+    return read_file_range(path, start, end)
+
+def requested_ranges(size, etag, last_modified):
+    """Resolve the request's Range header against a file of the given size.
+
+    Returns None when the whole file should be sent, an empty list when no range
+    is satisfiable, or a list of (start, end) pairs with end exclusive.
+    """
+    header_range = parse_range_header(request.headers.get('Range'))
+    if header_range is None or header_range.units != 'bytes':
+        return None
+
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if if_range.startswith(('"', 'W/')):
+            if if_range != f'"{etag}"':
+                return None
+        elif parse_date(if_range) != last_modified:
+            return None
+
+    if len(header_range.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in header_range.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+def serve_file(abs_path, as_attachment=False):
+    """Send a file with ETag/Last-Modified validation and single or multipart byte ranges."""
+    try:
+        st = os.stat(abs_path)
+    except FileNotFoundError:
+        return "File Not Found", 404
+
+    size = st.st_size
+    etag = f"{st.st_mtime_ns:x}-{size:x}"
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), tz=timezone.utc)
+    mimetype = mimetypes.guess_type(abs_path)[0] or 'application/octet-stream'
+    compressible = COMPRESS_MIN_SIZE <= size <= COMPRESS_MAX_FILE_SIZE and is_compressible_file(abs_path, mimetype)
+    encoding = None
+    if compressible and 'Range' not in request.headers:
+        encoding = negotiate_encoding(COMPRESSION_ENCODINGS, COMPRESSION_ENCODINGS)
+        if encoding:
+            etag = f"{etag}-{encoding}"
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    elif encoding:
+        response = compressed_files.response(abs_path, st, mimetype, encoding)
+        response.content_encoding = encoding
+    else:
+        ranges = requested_ranges(size, etag, last_modified)
+        if ranges is None:
+            response = Response(file_body(abs_path, 0, size), mimetype=mimetype, direct_passthrough=True)
+            response.content_length = size
+        elif not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = Response(file_body(abs_path, start, end), status=206, mimetype=mimetype, direct_passthrough=True)
+            response.content_length = end - start
+            response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        else:
+            boundary = secrets.token_hex(16)
+            part_headers = [
+                f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{end - 1}/{size}\r\n\r\n".encode()
+                for start, end in ranges
+            ]
+            closing = f"\r\n--{boundary}--\r\n".encode()
+
+            def generate():
+                for header, (start, end) in zip(part_headers, ranges):
+                    yield header
+                    yield from read_file_range(abs_path, start, end)
+                yield closing
+
+            response = Response(generate(), status=206, mimetype=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
+            response.content_length = sum(len(h) for h in part_headers) + sum(end - start for start, end in ranges) + len(closing)
+
+    if not encoding:
+        response.headers['Accept-Ranges'] = 'bytes' # Ranges are of the uncompressed file, which is what Range requests get
+    if compressible:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if as_attachment:
+        response.headers['Content-Disposition'] = content_disposition(os.path.basename(abs_path))
+    return response
+
+def render_with_layout(template_name, **context):
+    """Helper to render a content template within the main layout."""
+    context['session'] = session
+    content_html = render_template(template_name, **context)
+    return render_page('layout.html', content=content_html, **context)
+
+def render_page(template_name, **context):
+    """Render a page with an ETag so browsers revalidate it instead of downloading it again."""
+    response = make_response(render_template(template_name, **context))
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# --- Decorators ---
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user' not in session:
+            return redirect(url_for('login'))
+        session.permanent = True # Extend session on activity
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user' not in session or not session['user'].get('is_admin'):
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+upload_streams = {} # username -> chunk requests in flight
+upload_streams_lock = threading.Lock()
+
+def upload_slot_required(f):
+    """Answer 429 once a user has MAX_UPLOAD_STREAMS_PER_USER chunk uploads in flight."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        username = session['user'].get('username')
+        with upload_streams_lock:
+            if upload_streams.get(username, 0) >= MAX_UPLOAD_STREAMS_PER_USER:
+                response = jsonify({'message': 'Too many uploads in progress, retry shortly.'})
+                response.status_code = 429
+                response.headers['Retry-After'] = '1'
+                return response
+            upload_streams[username] = upload_streams.get(username, 0) + 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            with upload_streams_lock:
+                upload_streams[username] -= 1
+                if not upload_streams[username]:
+                    del upload_streams[username]
+    return decorated_function
+
+# --- Routes ---
+@app.after_request
+def compress_response(response):
+    """Compress JSON and text responses for clients that accept it; files are compressed by serve_file."""
+    if response.direct_passthrough or response.content_encoding or not is_compressible_type(response.mimetype or ''):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or (not response.is_streamed and len(response.get_data()) < COMPRESS_MIN_SIZE):
+        return response
+    encoding = negotiate_encoding(COMPRESSION_ENCODINGS, COMPRESSION_ENCODINGS)
+    if not encoding:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding, sync=True)
+    else:
+        response.set_data(b''.join(compress_stream([response.get_data()], encoding)))
+    response.content_encoding = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True) # Same content as the uncompressed response, different bytes
+    return response
+
+@app.route('/')
+@login_required
+def index():
+    return render_with_layout('index.html', thumbnail_types=THUMBNAIL_EXTENSIONS if Image is not None else ())
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    if filename not in ASSETS:
+        return "Not Found", 404
+    encodings, mimetype, etag = ASSETS[filename]
+    encoding = negotiate_encoding(encodings)
+    response = Response(encodings[encoding], mimetype=mimetype)
+    if encoding:
+        response.content_encoding = encoding
+        etag = f"{etag}-{encoding}"
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if not is_admin_setup():
+        return redirect(url_for('setup_admin'))
+    
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
+        users = get_users()
+        user = users.get(username)
+        if user and check_password_hash(user['password_hash'], password):
+            session.permanent = True
+            session['user'] = user
+            session['user']['username'] = username
+            return redirect(url_for('index'))
+        return render_page('login.html', error='Invalid username or password')
+    return render_page('login.html')
+
+@app.route('/logout')
+def logout():
+    session.pop('user', None)
+    return redirect(url_for('login'))
+
+@app.route('/setup_admin', methods=['GET', 'POST'])
+def setup_admin():
+    if is_admin_setup():
+        return redirect(url_for('login'))
+
+    if request.method == 'POST':
+        username = request.form['username']
+        password_hash = generate_password_hash(request.form['password'])
+        with users_store.edit() as users:
+            if username in users:
+                return render_page('setup_admin.html', error='Username already exists')
+            
+            users[username] = {
+                'password_hash': password_hash,
+                'is_admin': True,
+                'allowed_dirs': []
+            }
+        return redirect(url_for('login'))
+    return render_page('setup_admin.html')
+
+@app.route('/admin', methods=['GET', 'POST'])
 @admin_required
-def delete_user(username):
+def admin():
+    if request.method == 'POST':
+        with config_store.edit() as config:
+            new_dir = request.form.get('new_dir')
+            if new_dir and os.path.isdir(new_dir):
+                if new_dir not in config['allowed_directories']:
+                    config['allowed_directories'].append(os.path.abspath(new_dir))
+            
+            remove_dir = request.form.get('remove_dir')
+            if remove_dir:
+                if remove_dir in config['allowed_directories']:
+                    config['allowed_directories'].remove(remove_dir)
+
+        return redirect(url_for('admin'))
+
+    config = get_config()
     users = get_users()
-    if username in users and not users[username].get('is_admin'):
-        del users[username]
-        save_users(users)
+    roots = index_roots()
+    usage_path = request.args.get('usage')
+    usage_total = usage_up = None
+    if usage_path and any(is_within(os.path.abspath(usage_path), root) for root in roots):
+        usage_path = os.path.abspath(usage_path)
+        usage_total = file_index.dir_totals([usage_path]).get(usage_path)
+        usage_rows = file_index.largest_children(usage_path)
+        if usage_path not in roots:
+            usage_up = os.path.dirname(usage_path)
+    else:
+        usage_path = None
+        totals = file_index.dir_totals(roots)
+        usage_rows = [(root, *totals[root][:2]) for root in roots if root in totals]
+    return render_with_layout('admin.html', config=config, users=users, usage_path=usage_path,
+                              usage_total=usage_total, usage_up=usage_up, usage_rows=usage_rows,
+                              scratch=upload_reaper.stats())
+
+@app.route('/admin/create_user', methods=['POST'])
+@admin_required
+def create_user():
+    username = request.form['username']
+    password_hash = generate_password_hash(request.form['password'])
+    with users_store.edit() as users:
+        if username not in users:
+            users[username] = {
+                'password_hash': password_hash,
+                'is_admin': 'is_admin' in request.form,
+                'allowed_dirs': request.form.getlist('allowed_dirs')
+            }
+    return redirect(url_for('admin'))
+
+@app.route('/admin/delete_user/<username>', methods=['POST'])
+@admin_required
+def delete_user(username):
+    with users_store.edit() as users:
+        if username in users and not users[username].get('is_admin'):
+            del users[username]
     return redirect(url_for('admin'))
 
 @app.route('/download/<path:filepath>')
 @login_required
 def download_file(filepath):
     abs_path = f"/{filepath}"
-    user_dirs = get_user_dirs()
-    is_allowed = any(os.path.abspath(abs_path).startswith(os.path.abspath(d)) for d in user_dirs)
+    is_allowed = is_path_allowed(abs_path)
 
     if not is_allowed or os.path.isdir(abs_path):
         return "Access Denied or Not a File", 403
         
-    directory = os.path.dirname(abs_path)
-    filename = os.path.basename(abs_path)
-    return send_from_directory(directory, filename, as_attachment=True)
+    return serve_file(abs_path, as_attachment=True)
 
 @app.route('/download_folder/<path:folderpath>')
 @login_required
 def download_folder(folderpath):
     abs_path = f"/{folderpath}"
-    user_dirs = get_user_dirs()
-    is_allowed = any(os.path.abspath(abs_path).startswith(os.path.abspath(d)) for d in user_dirs)
+    is_allowed = is_path_allowed(abs_path)
 
     if not is_allowed or not os.path.isdir(abs_path):
         return "Access Denied or Not a Directory", 403
 
-    temp_dir = tempfile.mkdtemp()
-    archive_basename = os.path.join(temp_dir, os.path.basename(abs_path))
-    archive_path = shutil.make_archive(archive_basename, 'zip', abs_path)
-    archive_filename = os.path.basename(archive_path)
+    compression = request.args.get('compression', 'auto')
+    if compression not in ('auto', 'store', 'deflate'):
+        return "Unknown compression mode", 400
 
-    @after_this_request
-    def cleanup(response):
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception as e:
-            print(f"Error cleaning up temp directory {temp_dir}: {e}")
-        return response
-    
-    response = make_response(send_from_directory(temp_dir, archive_filename, as_attachment=True))
+    archive_filename = f"{os.path.basename(abs_path.rstrip('/')) or 'archive'}.zip"
+    response = Response(timed_archive(generate_zip(abs_path, compression)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = content_disposition(archive_filename)
+    totals = file_index.dir_totals([os.path.abspath(abs_path)])
+    if totals:
+        # The archive's length isn't known until it's built, but the index knows what goes into it
+        size, files, dirs = totals[os.path.abspath(abs_path)]
+        response.headers['X-Folder-Size'] = str(size)
+        response.headers['X-Folder-Files'] = str(files)
     token = request.args.get('token')
     if token:
         response.set_cookie(f'download-ready', token, max_age=20) # Short-lived cookie
@@ -893,93 +4202,180 @@ def download_folder(folderpath):
 @login_required
 def stream_file(filepath):
     abs_path = f"/{filepath}"
-    user_dirs = get_user_dirs()
-    is_allowed = any(os.path.abspath(abs_path).startswith(os.path.abspath(d)) for d in user_dirs)
+    is_allowed = is_path_allowed(abs_path)
 
     if not is_allowed or os.path.isdir(abs_path):
         return "Access Denied or Not a File", 403
 
-    def generate():
-        with open(abs_path, "rb") as f:
-            while True:
-                chunk = f.read(1024*1024)
-                if not chunk:
-                    break
-                yield chunk
-    
-    mimetype, _ = mimetypes.guess_type(abs_path)
-    return Response(generate(), mimetype=mimetype or "application/octet-stream")
+    return serve_file(abs_path)
+
+@app.route('/thumbnail/<path:filepath>')
+@login_required
+def thumbnail(filepath):
+    abs_path = f"/{filepath}"
+    is_allowed = is_path_allowed(abs_path)
+
+    if not is_allowed or not os.path.isfile(abs_path):
+        return "Access Denied or Not a File", 403
+
+    if not is_thumbnailable(abs_path):
+        return "No Preview Available", 404
+
+    size = THUMBNAIL_SIZES.get(request.args.get('size', 'small'))
+    if size is None:
+        return "Unknown preview size", 400
+
+    try:
+        preview_path = thumbnails.get(abs_path, size)
+    except FutureTimeoutError:
+        return "Preview is still rendering", 503
+    except Exception as e:
+        print(f"Could not render a preview of {abs_path}: {e}")
+        return "No Preview Available", 415
+
+    response = serve_file(preview_path)
+    response.cache_control.private = True
+    if request.args.get('v'):
+        response.cache_control.max_age = THUMBNAIL_MAX_AGE # The client puts the image's mtime in the URL
+    return response
 
 @app.route('/upload', methods=['POST'])
 @login_required
+@upload_slot_required
 def upload_chunk():
     file = request.files['file']
-    file_hash = request.form['file_hash']
     chunk_index = int(request.form['chunk_index'])
-    total_chunks = int(request.form['total_chunks'])
-    filename = request.form['filename']
-    target_dir = request.form['target_dir']
-    relative_path = request.form.get('relative_path', '')
+    try:
+        fields = upload_from_request(request.form)
+    except PermissionError:
+        return jsonify({'message': 'Upload failed: Target directory not allowed.'}), 403
+    if fields is None or not 0 <= chunk_index < fields[0].total_chunks:
+        return jsonify({'message': 'Upload failed: Invalid chunk.'}), 400
+    upload, final_dir, target_path = fields
 
-    user_dirs = get_user_dirs()
-    
-    final_dir = os.path.join(target_dir, os.path.dirname(relative_path))
-    is_allowed = any(os.path.abspath(final_dir).startswith(os.path.abspath(d)) for d in user_dirs)
+    if upload.file_hash is not None and not upload.received:
+        # The hash came with the chunk, so a file we already have needs none of its chunks
+        response = complete_from_copy(upload.algorithm, upload.file_hash, upload.file_size, target_path, request.form['target_dir'])
+        if response is not None:
+            if end_upload_session(upload):
+                upload.discard()
+            return response
+
+    if upload.partial_path:
+        os.makedirs(final_dir, exist_ok=True)
+    try:
+        completed = upload.store_chunk(chunk_index, file.stream, request.form.get('chunk_hash'))
+    except ValueError as e:
+        return jsonify({'message': f'Upload failed: {e}.'}), 400
+
+    if completed and upload.file_hash is not None:
+        return complete_upload(upload, target_path, request.form['target_dir'])
+    if completed:
+        return jsonify({'message': 'All chunks uploaded, waiting for the file hash.'})
+    return jsonify({'message': f'Chunk {chunk_index + 1}/{upload.total_chunks} uploaded.'})
+
+@app.route('/upload/finalize', methods=['POST'])
+@login_required
+def upload_finalize():
+    """Verify an upload against the file hash sent after its chunks, and move it into place."""
+    try:
+        fields = upload_from_request(request.form)
+    except PermissionError:
+        return jsonify({'message': 'Upload failed: Target directory not allowed.'}), 403
+    file_hash = request.form.get('file_hash', '').lower()
+    if fields is None or fields[0].file_hash is not None or not valid_upload_hash(file_hash, fields[0].algorithm):
+        return jsonify({'message': 'Invalid upload.'}), 400
+    upload, final_dir, target_path = fields
+
+    if upload.received != upload.total_chunks:
+        return jsonify({'message': 'Upload is missing chunks.', 'missing': upload.missing_ranges()}), 409
+    upload.file_hash = file_hash
+    return complete_upload(upload, target_path, request.form['target_dir'])
+
+@app.route('/upload/check', methods=['POST'])
+@login_required
+def upload_check():
+    """Pre-flight for an upload: finish it straight away from a copy already on the server, or say whether one might exist.
+
+    Without file_hash the answer only says whether a file of that size is
+    known, so clients need only hash files up front when they could be copies.
+    """
+    filename = os.path.basename(request.form.get('filename', ''))
+    final_dir = os.path.join(request.form.get('target_dir', ''), os.path.dirname(request.form.get('relative_path', '')))
+    file_size = request.form.get('file_size', type=int)
+    file_hash = request.form.get('file_hash', '').lower()
+    algorithm = request.form.get('hash_algorithm', DEFAULT_UPLOAD_HASH)
+    if not filename or file_size is None or file_size < 0 or algorithm not in UPLOAD_HASH_ALGORITHMS:
+        return jsonify({'message': 'Invalid upload.'}), 400
+
+    is_allowed = is_path_allowed(final_dir)
 
     if not is_allowed:
         return jsonify({'message': 'Upload failed: Target directory not allowed.'}), 403
 
-    chunk_filename = f"{file_hash}_{chunk_index}"
-    chunk_path = os.path.join(CHUNK_DIR, chunk_filename)
-    file.save(chunk_path)
-    
-    all_chunks_present = all(os.path.exists(os.path.join(CHUNK_DIR, f"{file_hash}_{i}")) for i in range(total_chunks))
-            
-    if all_chunks_present:
-        os.makedirs(final_dir, exist_ok=True)
-        target_path = os.path.join(final_dir, filename)
-
-        with open(target_path, 'wb') as outfile:
-            for i in range(total_chunks):
-                chunk_to_write = os.path.join(CHUNK_DIR, f"{file_hash}_{i}")
-                with open(chunk_to_write, 'rb') as infile:
-                    outfile.write(infile.read())
-                os.remove(chunk_to_write)
-
-        hasher = hashlib.sha256()
-        with open(target_path, 'rb') as f:
-            while chunk := f.read(4096):
-                hasher.update(chunk)
-        
-        if hasher.hexdigest() == file_hash:
-            return jsonify({'message': 'File uploaded and verified successfully!'})
-        else:
-            os.remove(target_path)
-            return jsonify({'message': 'File verification failed.'}), 500
+    if not file_hash:
+        candidates = algorithm in DEDUP_HASH_ALGORITHMS and file_index.has_size(file_size, is_path_allowed)
+        return jsonify({'complete': False, 'candidates': candidates})
+    if not valid_upload_hash(file_hash, algorithm):
+        return jsonify({'message': 'Invalid upload.'}), 400
+
+    response = complete_from_copy(algorithm, file_hash, file_size, os.path.join(final_dir, filename), request.form['target_dir'])
+    if response is None:
+        return jsonify({'complete': False, 'candidates': False})
+    fields = upload_from_request(request.form)
+    if fields is not None and end_upload_session(fields[0]):
+        fields[0].discard() # Left over from an earlier attempt at this upload
+    return response
+
+@app.route('/upload/status')
+@login_required
+def upload_status():
+    """Report which chunks of an upload the server still needs, so clients only resend those."""
+    try:
+        fields = upload_from_request(request.args)
+    except PermissionError:
+        return jsonify({'message': 'Target directory not allowed.'}), 403
+    if fields is None:
+        return jsonify({'message': 'Invalid upload.'}), 400
+    upload = fields[0]
 
-    return jsonify({'message': f'Chunk {chunk_index + 1}/{total_chunks} uploaded.'})
+    return jsonify({
+        'total_chunks': upload.total_chunks,
+        'received': upload.received,
+        'missing': upload.missing_ranges(),
+        'hash_algorithms': sorted(UPLOAD_HASH_ALGORITHMS),
+    })
 
 # --- API Routes ---
 @app.route('/api/dir_tree')
 @login_required
 def dir_tree():
     user_dirs = get_user_dirs()
-    tree = []
-    for d in user_dirs:
-        tree.append({
-            'name': os.path.basename(d) or d,
-            'path': d,
-            'children': build_dir_tree(d, user_dirs)
-        })
-    return jsonify(tree)
+    path = request.args.get('path')
+    cursor = request.args.get('cursor') or None
+    depth = min(max(request.args.get('depth', 1, type=int), 1), DIR_TREE_MAX_DEPTH)
+    limit = min(max(request.args.get('limit', DIR_TREE_PAGE_SIZE, type=int), 1), DIR_TREE_MAX_PAGE_SIZE)
+
+    if not path:
+        roots = [tree_node(os.path.basename(d) or d, d, depth - 1) for d in user_dirs]
+        return jsonify({'path': None, 'children': roots, 'next_cursor': None})
+
+    is_allowed = is_path_allowed(path)
+    if not is_allowed:
+        return jsonify({'error': 'Access Denied'}), 403
+
+    if not os.path.isdir(path):
+        return jsonify({'error': 'Directory Not Found'}), 404
+
+    children, next_cursor = build_dir_tree(path, depth, cursor, limit)
+    return jsonify({'path': path, 'children': children, 'next_cursor': next_cursor})
 
 @app.route('/api/browse/', defaults={'subpath': ''})
 @app.route('/api/browse/<path:subpath>')
 @login_required
 def api_browse(subpath):
     abs_path = f"/{subpath}"
-    user_dirs = get_user_dirs()
-    is_allowed = any(os.path.abspath(abs_path).startswith(os.path.abspath(d)) for d in user_dirs)
+    is_allowed = is_path_allowed(abs_path)
 
     if not is_allowed:
         return jsonify({'error': 'Access Denied'}), 403
@@ -987,23 +4383,307 @@ def api_browse(subpath):
     if not os.path.isdir(abs_path):
         return jsonify({'error': 'Directory Not Found'}), 404
 
-    items = []
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    descending = order == 'desc'
+    pattern = name_filter(request.args)
+    bounds = page_bounds(request.args, BROWSE_PAGE_SIZE, BROWSE_MAX_PAGE_SIZE)
+    if sort != 'none' and sort not in BROWSE_SORT_KEYS:
+        return jsonify({'error': f'Unknown sort key: {sort}'}), 400
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': 'order must be asc or desc'}), 400
+    if bounds is None:
+        return jsonify({'error': 'offset must be a whole number and limit a positive one'}), 400
+    offset, limit = bounds
+
     try:
-        for item in os.scandir(abs_path):
-            stat_result = item.stat()
-            items.append({
-                'name': item.name,
-                'is_dir': item.is_dir(),
-                'path': item.path,
-                'size': stat_result.st_size if not item.is_dir() else 0
-            })
+        if sort == 'none':
+            # Entries go out as scandir returns them, so the first page of a huge directory comes back right away
+            return Response(stream_directory_page(abs_path, os.scandir(abs_path), pattern, offset, limit), mimetype='application/json')
+        items = dir_cache.get(os.path.abspath(abs_path), scan_directory).view(sort, descending, pattern)
     except PermissionError:
         return jsonify({'error': f'Permission denied to read directory: {abs_path}'}), 403
-    
-    items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
-    return jsonify(items)
+    next_offset = offset + limit if offset + limit < len(items) else None
+    return jsonify({
+        'path': abs_path,
+        'sort': sort,
+        'order': 'desc' if descending else 'asc',
+        'offset': offset,
+        'items': with_dir_totals(items[offset:offset + limit]),
+        'total': len(items),
+        'next_offset': next_offset,
+    })
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """Search the file index by name and attributes, within the directories the user may access."""
+    within = request.args.get('path')
+    if within:
+        if not is_path_allowed(within):
+            return jsonify({'error': 'Access Denied'}), 403
+        dirs = [within]
+    else:
+        dirs = get_user_dirs()
+
+    kind = request.args.get('kind')
+    if kind not in (None, 'file', 'dir'):
+        return jsonify({'error': 'kind must be file or dir'}), 400
+    types = [t.strip().lstrip('.').lower() for t in request.args.get('type', '').split(',') if t.strip()]
+    bounds = page_bounds(request.args, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+    if bounds is None:
+        return jsonify({'error': 'offset must be a whole number and limit a positive one'}), 400
+    offset, limit = bounds
+
+    items, next_offset = file_index.search(
+        dirs, request.args.get('q', '').split(), types, kind,
+        request.args.get('min_size', type=int), request.args.get('max_size', type=int),
+        request.args.get('modified_after', type=float), request.args.get('modified_before', type=float),
+        offset, limit)
+    return jsonify({'items': items, 'offset': offset, 'next_offset': next_offset})
+
+@app.route('/api/cache_stats')
+@admin_required
+def cache_stats():
+    return jsonify({'dir_listing': dir_cache.stats(), 'file_index': file_index.stats(), 'thumbnails': thumbnails.stats(),
+                    'upload_scratch': upload_reaper.stats(), 'compressed_files': compressed_files.stats()})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics in the Prometheus text format, for admins or scrapers sending config.json's metrics_token as a bearer token."""
+    token = get_config().get('metrics_token')
+    authorization = request.headers.get('Authorization', '').encode()
+    if not (token and secrets.compare_digest(authorization, f"Bearer {token}".encode())):
+        if 'user' not in session or not session['user'].get('is_admin'):
+            return "Forbidden", 403
+    counters, gauges, histograms = metrics.collect()
+    scratch = upload_reaper.stats()
+    if scratch['uploads'] is not None:
+        gauges[('fileserver_upload_scratch_uploads', ())] = scratch['uploads']
+        gauges[('fileserver_upload_scratch_bytes', ())] = scratch['bytes']
+    return Response(render_metrics(counters, gauges, histograms), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# --- Server ---
+def parse_args():
+    parser = argparse.ArgumentParser(description="Python File Server")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help="worker processes (needs gunicorn)")
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS, help="requests served at once by each worker")
+    parser.add_argument('--keepalive', type=int, default=SERVER_KEEPALIVE, help="seconds to hold idle connections open")
+    parser.add_argument('--graceful-timeout', type=int, default=SERVER_GRACEFUL_TIMEOUT,
+                        help="seconds in-flight requests get to finish on shutdown or reload")
+    parser.add_argument('--asyncio', action=argparse.BooleanOptionalAction, default=SERVER_ASYNCIO,
+                        help="stream responses from an event loop so slow downloads don't hold a thread each")
+    parser.add_argument('--connections', type=int, default=SERVER_CONNECTIONS, help="open connections per asyncio worker")
+    parser.add_argument('--dev', action='store_true', help="run Flask's debug server with auto-reload; never expose it")
+    return parser.parse_args()
+
+def post_fork(server, worker):
+    """Per-worker startup; threads started before the fork don't carry over into the worker."""
+    reset_dir_cache()
+    file_index.start()
+    upload_reaper.start()
+    metrics.start()
+
+def run_gunicorn(args):
+    """Serve the app from gunicorn's threaded workers, configured from the command line.
+
+    The app is loaded before the workers fork, so they share the session secret.
+    SIGTERM shuts down gracefully and SIGHUP replaces the workers without
+    dropping in-flight requests.
+    """
+    options = {
+        'bind': f"{args.host}:{args.port}",
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'keepalive': args.keepalive,
+        'graceful_timeout': args.graceful_timeout,
+        'post_fork': post_fork,
+    }
+    application = app
+    if args.asyncio:
+        if 'asgi' in SUPPORTED_WORKERS:
+            options.update(worker_class='asgi', threads=1, worker_connections=args.connections)
+            application = AsgiBridge(app, args.threads)
+        else:
+            print("This version of gunicorn has no asyncio (asgi) worker; serving from threads instead.")
+
+    class FileServerApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return application
+
+    FileServerApplication().run()
+
+class AsgiInput(io.RawIOBase):
+    """Blocking wsgi.input over an ASGI receive channel, read from the thread handling the request."""
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = memoryview(b'')
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            self.pending = memoryview(message.get('body', b''))
+            self.more_body = message['type'] == 'http.request' and message.get('more_body', False)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+def asgi_file_wrapper(file, block_size=STREAM_CHUNK_SIZE):
+    """wsgi.file_wrapper for asyncio mode, reading in blocks small enough to park one per slow client."""
+    return FileWrapper(file, min(block_size, ASGI_STREAM_CHUNK_SIZE))
+
+def asgi_environ(scope, body):
+    """Build the WSGI environ for an ASGI HTTP request."""
+    root_path = scope.get('root_path', '')
+    raw_path = scope.get('raw_path') or scope['path'].encode('utf-8')
+    path = unquote_to_bytes(raw_path.split(b'?', 1)[0]).decode('latin-1')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or (SERVER_HOST, SERVER_PORT)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': asgi_file_wrapper,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def has_request_body(environ):
+    return environ.get('CONTENT_LENGTH', '0') not in ('', '0') or 'HTTP_TRANSFER_ENCODING' in environ
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+class AsgiBridge:
+    """Serves the Flask app to an asyncio (ASGI) server.
+
+    Each request still runs through the app on one of `threads` worker threads,
+    but its response body is then pulled a block at a time on a short-lived
+    pool thread and written from the event loop. A download or media stream
+    waiting on a slow client therefore holds no thread, only the block being
+    sent and the one after it, and browsing never queues behind transfers.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        body_input = AsgiInput(receive, loop)
+        environ = asgi_environ(scope, body_input)
+        body = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        if body_input.more_body and has_request_body(environ):
+            # Listening for a disconnect would mean reading the body the app left unread
+            disconnected = loop.create_future()
+        else:
+            disconnected = loop.create_task(wait_for_disconnect(receive))
+        try:
+            blocks = iter(body)
+            block = await loop.run_in_executor(None, next, blocks, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            # Each block is held until the next is read, so the last one goes out with more_body=False
+            while block is not None and not disconnected.done():
+                following = await loop.run_in_executor(None, next, blocks, None)
+                if following is None:
+                    break
+                if block:
+                    await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+                block = following
+        finally:
+            disconnected.cancel()
+            with suppress(asyncio.CancelledError):
+                await disconnected
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(None, body.close)
+        # The client may send its next request as soon as it has this response,
+        # so nothing is awaited between the last bytes and the end of the response
+        await send({'type': 'http.response.body', 'body': block or b'', 'more_body': False})
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
 
+def run_threaded(args):
+    """Serve the app from a single process with a thread per request, for when gunicorn isn't available."""
+    if args.workers > 1 or args.asyncio:
+        print("gunicorn is not installed; serving from one process with a thread per request.")
+    run_simple(args.host, args.port, app, threaded=True, request_handler=KeepAliveRequestHandler)
 
 if __name__ == '__main__':
+    args = parse_args()
     setup()
-    app.run(host='0.0.0.0', debug=True, port=5001)
+    if args.dev:
+        file_index.start()
+        upload_reaper.start()
+        metrics.start()
+        app.run(host=args.host, port=args.port, debug=True)
+    elif BaseApplication is not None:
+        run_gunicorn(args)
+    else:
+        file_index.start()
+        upload_reaper.start()
+        metrics.start()
+        run_threaded(args)
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+PASSWORD = 'pw'
+PASSWORD_HASH = generate_password_hash(PASSWORD) # Hashing is slow on purpose, so do it once
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    """An allowed directory, with the app's data directory and caches kept under tmp_path."""
+    monkeypatch.chdir(tmp_path) # main.py keeps its data relative to the working directory
+    main.setup()
+    root = tmp_path / 'files'
+    root.mkdir()
+    config = main.get_config()
+    config['allowed_directories'] = [str(root)]
+    main.save_config(config)
+    main.save_users({
+        'admin': {'password_hash': PASSWORD_HASH, 'is_admin': True, 'allowed_dirs': []},
+        'bob': {'password_hash': PASSWORD_HASH, 'is_admin': False, 'allowed_dirs': [str(root)]},
+    })
+    monkeypatch.setattr(main, 'file_index', main.FileIndex(main.INDEX_DB))
+    monkeypatch.setattr(main, 'compressed_files', main.CompressedFileCache(main.COMPRESS_CACHE_DIR))
+    monkeypatch.setattr(main, 'metrics', main.Metrics(main.METRICS_DIR))
+    monkeypatch.setattr(main, 'upload_sessions', {})
+    return root
+
+
+def login(username='admin'):
+    client = main.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def client(root):
+    """A test client logged in as the admin."""
+    return login()
@@ -0,0 +1,65 @@
+import io
+import uuid
+
+import pytest
+
+import main
+from conftest import login
+
+
+@pytest.fixture
+def siblings(root, tmp_path):
+    """Directories next to bob's whose names start with his directory's name, all indexed."""
+    (root / 'mine.txt').write_text('mine')
+    paths = []
+    for name in (f"{root.name}2", f"{root.name}-old"):
+        sibling = tmp_path / name
+        sibling.mkdir()
+        (sibling / 'secret.txt').write_text('secret')
+        paths.append(sibling)
+    config = main.get_config()
+    config['allowed_directories'] = [str(tmp_path)] # The admin sees everything, so everything is indexed
+    main.save_config(config)
+    main.file_index.rescan(main.index_roots())
+    return paths
+
+
+def sibling_paths(root, siblings):
+    for sibling in siblings:
+        yield sibling
+        yield root / '..' / sibling.name # The same place, spelled through bob's own directory
+
+
+def test_sibling_directories_cannot_be_read(root, siblings):
+    client = login('bob')
+    assert client.get(f"/api/browse{root}").status_code == 200
+    assert client.get(f"/download{root}/mine.txt").status_code == 200
+    for sibling in sibling_paths(root, siblings):
+        assert client.get(f"/api/browse{sibling}").status_code == 403
+        assert client.get(f"/download{sibling}/secret.txt").status_code == 403
+        assert client.get(f"/stream{sibling}/secret.txt").status_code == 403
+        assert client.get(f"/download_folder{sibling}").status_code == 403
+        assert client.get('/api/dir_tree', query_string={'path': str(sibling)}).status_code == 403
+
+
+def test_search_stays_inside_allowed_directories(root, siblings):
+    client = login('bob')
+    names = [item['name'] for item in client.get('/api/search', query_string={'q': 'txt'}).get_json()['items']]
+    assert names == ['mine.txt']
+    for sibling in sibling_paths(root, siblings):
+        assert client.get('/api/search', query_string={'q': 'txt', 'path': str(sibling)}).status_code == 403
+    admin_names = sorted(item['name'] for item in login().get('/api/search', query_string={'q': 'txt'}).get_json()['items'])
+    assert admin_names == ['mine.txt', 'secret.txt', 'secret.txt']
+
+
+def test_uploads_into_sibling_directories_are_refused(root, siblings):
+    client = login('bob')
+    for sibling in sibling_paths(root, siblings):
+        fields = {'upload_id': uuid.uuid4().hex, 'total_chunks': 1, 'file_size': 4, 'chunk_size': 4,
+                  'filename': 'planted.txt', 'target_dir': str(sibling)}
+        response = client.post('/upload', data=dict(fields, chunk_index=0, file=(io.BytesIO(b'evil'), 'blob')),
+                               content_type='multipart/form-data')
+        assert response.status_code == 403
+        assert not (sibling / 'planted.txt').exists()
+    for sibling in siblings:
+        assert sorted(p.name for p in sibling.iterdir()) == ['secret.txt']
@@ -0,0 +1,131 @@
+import asyncio
+import os
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+import pytest
+
+import main
+from conftest import PASSWORD
+
+
+class Connection:
+    """Fake ASGI receive/send for one request, recording what the bridge does with them."""
+
+    def __init__(self, body=b'', parts=1, disconnect_after_blocks=None):
+        size = -(-len(body) // parts) if body else 0
+        self.messages = [{'type': 'http.request', 'body': body[i:i + size], 'more_body': i + size < len(body)}
+                         for i in range(0, len(body), size)] if body else [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        self.disconnect_after_blocks = disconnect_after_blocks
+        self.disconnected = asyncio.Event()
+        self.sent = []
+        self.waiting = 0
+        self.yielded_after_response = False
+
+    async def receive(self):
+        self.waiting += 1
+        try:
+            if self.messages:
+                return self.messages.pop(0)
+            await self.disconnected.wait()
+            return {'type': 'http.disconnect'}
+        finally:
+            self.waiting -= 1
+
+    async def send(self, message):
+        assert not self.sent or self.sent[-1].get('more_body', True), "Sent after the response was complete"
+        self.sent.append(message)
+        if message['type'] == 'http.response.body' and not message.get('more_body', False):
+            # A real server reads the connection's next request as soon as the loop runs again
+            asyncio.get_running_loop().call_soon(setattr, self, 'yielded_after_response', True)
+        blocks = sum(1 for m in self.sent if m['type'] == 'http.response.body')
+        if self.disconnect_after_blocks is not None and blocks >= self.disconnect_after_blocks:
+            self.disconnected.set()
+
+    @property
+    def status(self):
+        return self.sent[0]['status']
+
+    @property
+    def headers(self):
+        return {name.decode(): value.decode() for name, value in self.sent[0]['headers']}
+
+    @property
+    def body(self):
+        return b''.join(m.get('body', b'') for m in self.sent[1:])
+
+
+def http_scope(method, path, headers=(), query=''):
+    return {
+        'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'scheme': 'http', 'http_version': '1.1',
+        'server': ('127.0.0.1', 8000), 'client': ('127.0.0.1', 50000),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+    }
+
+
+@pytest.fixture
+def bridge(root):
+    bridge = main.AsgiBridge(main.app, 4)
+    yield bridge
+    bridge.executor.shutdown()
+
+
+def serve(bridge, scope, connection):
+    async def run():
+        await bridge(scope, connection.receive, connection.send)
+        assert not connection.yielded_after_response, "The bridge awaited something after completing the response"
+        assert connection.waiting == 0, "A receive() was left pending after the response"
+    asyncio.run(run())
+    assert connection.sent[-1] == {'type': 'http.response.body', 'body': connection.sent[-1]['body'], 'more_body': False}
+    return connection
+
+
+def log_in(bridge, parts=1):
+    form = urlencode({'username': 'admin', 'password': PASSWORD}).encode()
+    headers = [('Content-Type', 'application/x-www-form-urlencoded'), ('Content-Length', str(len(form)))]
+    response = serve(bridge, http_scope('POST', '/login', headers), Connection(form, parts))
+    assert response.status == 302
+    cookie = SimpleCookie(response.headers['set-cookie'])
+    return [('Cookie', '; '.join(f"{key}={morsel.value}" for key, morsel in cookie.items()))]
+
+
+def test_sequential_requests_with_a_posted_body(bridge, root):
+    cookie = log_in(bridge, parts=3) # The form arrives in several messages
+    for _ in range(2):
+        response = serve(bridge, http_scope('GET', f"/api/browse{root}", cookie), Connection())
+        assert response.status == 200
+        assert response.body.startswith(b'{')
+
+
+def test_streamed_body_is_sent_block_by_block(bridge, root):
+    data = os.urandom(3 * main.ASGI_STREAM_CHUNK_SIZE + 1000)
+    (root / 'big.bin').write_bytes(data)
+    cookie = log_in(bridge)
+    response = serve(bridge, http_scope('GET', f"/download{root}/big.bin", cookie), Connection())
+    assert response.status == 200
+    assert response.headers['content-length'] == str(len(data))
+    assert response.body == data
+    body_messages = response.sent[1:]
+    assert len(body_messages) == 4
+    assert [m['more_body'] for m in body_messages] == [True, True, True, False]
+
+
+def test_client_disconnect_stops_the_stream(bridge, root):
+    data = os.urandom(20 * main.ASGI_STREAM_CHUNK_SIZE)
+    (root / 'big.bin').write_bytes(data)
+    cookie = log_in(bridge)
+    response = serve(bridge, http_scope('GET', f"/download{root}/big.bin", cookie), Connection(disconnect_after_blocks=1))
+    assert len(response.body) < len(data)
+    counters, gauges, _ = main.metrics.collect()
+    assert gauges[('fileserver_active_streams', (('kind', 'file'),))] == 0 # The file was closed
+
+
+def test_unread_body_is_left_alone(bridge, root):
+    # Refused before the app reads the upload, so the bridge mustn't read it either while watching for a disconnect
+    data = b'x' * 1000
+    headers = [('Content-Type', 'application/octet-stream'), ('Content-Length', str(len(data)))]
+    connection = Connection(data, parts=2)
+    response = serve(bridge, http_scope('POST', '/upload', headers), connection)
+    assert response.status == 302 # To the login page
+    assert len(connection.messages) == 2
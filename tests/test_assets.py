@@ -0,0 +1,62 @@
+import gzip
+import re
+
+import pytest
+
+import main
+
+
+def asset_urls(html):
+    return re.findall(r'(/assets/[^"\'?]+)', html)
+
+
+def test_pages_link_their_assets_by_content_hash(client):
+    urls = asset_urls(client.get('/').get_data(as_text=True))
+    assert urls
+    for url in urls:
+        name = url.rsplit('/', 1)[1]
+        assert name in main.ASSETS
+        assert re.fullmatch(r'[\w-]+\.[0-9a-f]{12}\.(css|js)', name)
+    with main.app.test_request_context():
+        assert main.asset_url('index.js') in urls
+
+
+@pytest.mark.parametrize('name', ['app.css', 'index.js'])
+def test_assets_are_immutable_and_revalidate_with_304(client, name):
+    with main.app.test_request_context():
+        url = main.asset_url(name)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.public
+    assert response.cache_control.max_age == main.ASSET_MAX_AGE
+    assert response.cache_control.immutable
+    etag = response.headers['ETag']
+
+    revalidated = client.get(url, headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+    assert client.get(url, headers={'If-None-Match': '"something-else"'}).status_code == 200
+
+
+def test_assets_come_precompressed(client):
+    with main.app.test_request_context():
+        url = main.asset_url('index.js')
+    identity = client.get(url, headers={'Accept-Encoding': 'identity'})
+    gzipped = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert identity.content_encoding is None
+    assert gzipped.content_encoding == 'gzip'
+    assert gzip.decompress(gzipped.data) == identity.data
+    assert gzipped.headers['ETag'] != identity.headers['ETag'] # Caches must not mix up the variants
+    assert 'Accept-Encoding' in gzipped.vary
+    assert client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzipped.headers['ETag']}).status_code == 304
+
+
+def test_changed_content_gets_a_new_url(client, monkeypatch):
+    monkeypatch.setattr(main, 'ASSETS', dict(main.ASSETS))
+    monkeypatch.setattr(main, 'ASSET_FILENAMES', dict(main.ASSET_FILENAMES))
+    old = main.ASSET_FILENAMES['layout.js']
+    main.register_asset('layout.js', main.LAYOUT_JS + '\nwindow.changed = true;\n', 'text/javascript')
+    new = main.ASSET_FILENAMES['layout.js']
+    assert new != old
+    assert client.get(f'/assets/{new}').data.endswith(b'window.changed = true;\n')
+    assert client.get('/assets/layout.0123456789ab.js').status_code == 404
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+import main
+
+NAMES = ['b.txt', 'A.md', 'c.log', 'apple.txt', 'Banana.csv', 'd[1].txt', 'e.bin', 'f', 'g.txt', 'h.md']
+
+
+@pytest.fixture
+def listing(root):
+    for i, name in enumerate(NAMES):
+        path = root / name
+        path.write_bytes(b'x' * (len(NAMES) - i) * 10)
+        os.utime(path, (1_000_000 + i * 7 % 10, 1_000_000 + i * 7 % 10))
+    for name in ('zeta', 'Alpha'):
+        (root / name).mkdir()
+    return root
+
+
+def browse(client, root, **params):
+    response = client.get(f"/api/browse{root}", query_string=params)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def names(page):
+    return [item['name'] for item in page['items']]
+
+
+def test_pages_join_up_into_the_whole_listing(client, listing):
+    whole = browse(client, listing, limit=100)
+    assert whole['total'] == len(NAMES) + 2
+    assert whole['next_offset'] is None
+
+    paged, offset = [], 0
+    while offset is not None:
+        page = browse(client, listing, offset=offset, limit=5)
+        assert page['total'] == whole['total']
+        paged += names(page)
+        offset = page['next_offset']
+    assert paged == names(whole)
+    assert browse(client, listing, offset=100)['items'] == []
+
+
+@pytest.mark.parametrize('sort', sorted(main.BROWSE_SORT_KEYS))
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_sort_keys(client, listing, sort, order):
+    page = browse(client, listing, sort=sort, order=order)
+    assert page['sort'] == sort and page['order'] == order
+    items = page['items']
+    dirs = [item for item in items if item['is_dir']]
+    files = [item for item in items if not item['is_dir']]
+    assert items == dirs + files # Folders first, whichever way round
+    key = main.BROWSE_SORT_KEYS[sort]
+    assert files == sorted(files, key=key, reverse=order == 'desc')
+    assert dirs == sorted(dirs, key=key, reverse=order == 'desc')
+    if sort == 'name':
+        assert names(page)[:2] == (['Alpha', 'zeta'] if order == 'asc' else ['zeta', 'Alpha'])
+
+
+def test_unsorted_listing_pages(client, listing):
+    first = browse(client, listing, sort='none', limit=7)
+    assert len(first['items']) == 7
+    assert first['next_offset'] == 7
+    rest = browse(client, listing, sort='none', offset=7, limit=100)
+    assert rest['next_offset'] is None
+    assert sorted(names(first) + names(rest)) == sorted(NAMES + ['zeta', 'Alpha'])
+
+
+def test_filters(client, listing):
+    assert names(browse(client, listing, glob='*.TXT')) == ['apple.txt', 'b.txt', 'd[1].txt', 'g.txt']
+    assert names(browse(client, listing, prefix='a')) == ['Alpha', 'A.md', 'apple.txt']
+    assert names(browse(client, listing, prefix='d[1')) == ['d[1].txt'] # Taken literally, not as a glob
+    filtered = browse(client, listing, glob='*.md', limit=1)
+    assert filtered['total'] == 2
+    assert filtered['next_offset'] == 1
+    assert sorted(names(browse(client, listing, sort='none', glob='*.md'))) == ['A.md', 'h.md']
+
+
+@pytest.mark.parametrize('params', [
+    {'limit': 'ten'}, {'limit': 0}, {'limit': -5}, {'offset': 'x'}, {'offset': -1}, {'offset': '1.5'},
+    {'sort': 'colour'}, {'order': 'sideways'}, {'sort': 'none', 'limit': 'ten'},
+])
+def test_invalid_parameters_are_rejected(client, listing, params):
+    response = client.get(f"/api/browse{listing}", query_string=params)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_limit_is_capped(client, listing, monkeypatch):
+    monkeypatch.setattr(main, 'BROWSE_MAX_PAGE_SIZE', 3)
+    page = browse(client, listing, limit=1000)
+    assert len(page['items']) == 3
+    assert page['next_offset'] == 3
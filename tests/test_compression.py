@@ -0,0 +1,82 @@
+import gzip
+import json
+import zlib
+
+import main
+
+TEXT = ('All work and no play makes Jack a dull boy.\n' * 2000).encode()
+
+
+def test_text_download_is_gzipped_when_accepted(root, client):
+    (root / 'notes.txt').write_bytes(TEXT)
+    plain = client.get(f"/download{root}/notes.txt")
+    assert plain.content_encoding is None
+    assert plain.data == TEXT
+    assert 'Accept-Encoding' in plain.vary
+
+    headers = {'Accept-Encoding': 'gzip'}
+    first = client.get(f"/download{root}/notes.txt", headers=headers)
+    assert first.content_encoding == 'gzip'
+    assert 'Accept-Encoding' in first.vary
+    assert gzip.decompress(first.data) == TEXT
+    assert len(first.data) < len(TEXT) // 10
+    assert first.get_etag()[0] != plain.get_etag()[0]
+
+    second = client.get(f"/download{root}/notes.txt", headers=headers)
+    assert second.data == first.data
+    assert main.compressed_files.stats()['compressions'] == 1 # Sent from the cached copy
+
+    revalidated = client.get(f"/download{root}/notes.txt", headers=dict(headers, **{'If-None-Match': first.headers['ETag']}))
+    assert revalidated.status_code == 304
+
+
+def test_ranges_and_media_are_sent_as_is(root, client):
+    (root / 'notes.txt').write_bytes(TEXT)
+    (root / 'image.png').write_bytes(TEXT)
+    partial = client.get(f"/download{root}/notes.txt", headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-99'})
+    assert partial.status_code == 206
+    assert partial.content_encoding is None
+    assert partial.data == TEXT[:100]
+    image = client.get(f"/download{root}/image.png", headers={'Accept-Encoding': 'gzip'})
+    assert image.content_encoding is None
+
+
+def test_json_responses_get_a_weak_etag(root, client):
+    for i in range(100):
+        (root / f"file-{i:03}.txt").write_text('x')
+    response = client.get(f"/api/browse{root}", headers={'Accept-Encoding': 'gzip'})
+    assert response.content_encoding == 'gzip'
+    assert len(json.loads(gzip.decompress(response.data))['items']) == 100
+    etag, weak = response.get_etag()
+    assert etag is None or weak
+
+
+def test_streamed_listing_is_flushed_in_batches(root, client):
+    for i in range(3000):
+        (root / f"file-with-a-fairly-long-name-{i:05}.txt").write_text('x')
+    response = client.get(f"/api/browse{root}", query_string={'sort': 'none', 'limit': 3000},
+                          headers={'Accept-Encoding': 'gzip'}, buffered=False)
+    assert response.content_encoding == 'gzip'
+    decompressor = zlib.decompressobj(31)
+    chunks = list(response.response)
+    response.close()
+    decoded = [decompressor.decompress(chunk) for chunk in chunks]
+    assert decoded[0].startswith(b'{"path": ')
+    assert all(decoded[:-1]) # Every batch could be read as soon as it was sent; the last piece is the gzip trailer
+    assert len(decoded) > 5
+    raw = b''.join(decoded)
+    assert len(json.loads(raw)['items']) == 3000
+
+    # Flushing each batch costs little against compressing the page in one go
+    compressed = sum(len(chunk) for chunk in chunks)
+    assert compressed < 1.1 * len(gzip.compress(raw, 6))
+
+
+def test_compress_stream_sync_flushes_every_chunk():
+    decompressor = zlib.decompressobj(31)
+    pieces = [f"piece {i} ".encode() for i in range(50)]
+    out = main.compress_stream(iter(pieces), 'gzip', sync=True)
+    for piece in pieces:
+        assert decompressor.decompress(next(out)) == piece
+    decompressor.decompress(b''.join(out))
+    assert decompressor.eof
@@ -0,0 +1,103 @@
+import hashlib
+import io
+import os
+import time
+import uuid
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def poll_cache(root, monkeypatch):
+    """A listing cache built as it is without inotify_simple."""
+    monkeypatch.setattr(main, 'INotify', None)
+    cache = main.DirListingCache(ttl=0.5)
+    monkeypatch.setattr(main, 'dir_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def inotify_cache(root, monkeypatch):
+    if main.INotify is None:
+        pytest.skip('inotify_simple is not installed')
+    cache = main.DirListingCache(ttl=3600) # Only inotify can invalidate within the test
+    if cache.inotify is None:
+        pytest.skip('inotify is not available here')
+    monkeypatch.setattr(main, 'dir_cache', cache)
+    return cache
+
+
+def listing(client, directory):
+    return {item['name']: item['size'] for item in client.get(f"/api/browse{directory}").get_json()['items']}
+
+
+def eventually(check, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, "The listing never caught up"
+        time.sleep(0.02)
+
+
+def touch_later(directory):
+    """Move a directory's mtime on, as the next tick of a coarse filesystem clock would."""
+    st = os.stat(directory)
+    os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def upload(client, root, name, data):
+    fields = {'upload_id': uuid.uuid4().hex, 'total_chunks': 1, 'file_size': len(data), 'chunk_size': len(data),
+              'filename': name, 'target_dir': str(root)}
+    client.post('/upload', data=dict(fields, chunk_index=0, file=(io.BytesIO(data), 'blob')), content_type='multipart/form-data')
+    response = client.post('/upload/finalize', data=dict(fields, file_hash=hashlib.sha256(data).hexdigest()))
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('cache', ['poll_cache', 'inotify_cache'])
+def test_upload_shows_up_straight_away(client, root, cache, request):
+    cache = request.getfixturevalue(cache)
+    (root / 'old.txt').write_text('old')
+    assert listing(client, root) == {'old.txt': 3}
+    upload(client, root, 'new.txt', b'new file')
+    assert listing(client, root) == {'old.txt': 3, 'new.txt': 8}
+    assert cache.stats()['invalidations'] >= 1
+
+
+def test_external_changes_with_inotify(client, root, inotify_cache):
+    (root / 'a.txt').write_text('a')
+    assert listing(client, root) == {'a.txt': 1}
+    hits = inotify_cache.stats()['hits']
+    assert listing(client, root) == {'a.txt': 1}
+    assert inotify_cache.stats()['hits'] == hits + 1 # Served from the cache while nothing changed
+
+    (root / 'b.txt').write_text('bb')
+    eventually(lambda: listing(client, root) == {'a.txt': 1, 'b.txt': 2})
+    os.rename(root / 'b.txt', root / 'c.txt')
+    eventually(lambda: listing(client, root) == {'a.txt': 1, 'c.txt': 2})
+    os.remove(root / 'a.txt')
+    eventually(lambda: listing(client, root) == {'c.txt': 2})
+    with open(root / 'c.txt', 'a') as f: # Grows in place; the directory itself doesn't change
+        f.write('more')
+    eventually(lambda: listing(client, root) == {'c.txt': 6})
+
+
+def test_external_changes_without_inotify(client, root, poll_cache):
+    assert poll_cache.stats()['invalidation'] == 'poll'
+    (root / 'a.txt').write_text('a')
+    assert listing(client, root) == {'a.txt': 1}
+
+    (root / 'b.txt').write_text('bb')
+    touch_later(root)
+    assert listing(client, root) == {'a.txt': 1, 'b.txt': 2} # The directory's mtime moved
+    os.rename(root / 'b.txt', root / 'c.txt')
+    touch_later(root)
+    assert listing(client, root) == {'a.txt': 1, 'c.txt': 2}
+    os.remove(root / 'a.txt')
+    touch_later(root)
+    assert listing(client, root) == {'c.txt': 2}
+
+    with open(root / 'c.txt', 'a') as f:
+        f.write('more')
+    time.sleep(poll_cache.ttl + 0.1) # An in-place change is only picked up once the TTL runs out
+    assert listing(client, root) == {'c.txt': 6}
@@ -0,0 +1,74 @@
+import errno
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def tree(root):
+    for i in range(12):
+        (root / f"dir{i:02}" / 'sub' / 'deeper' / 'deepest').mkdir(parents=True)
+    (root / 'file.txt').write_text('not a directory')
+    return root
+
+
+def get_tree(client, **params):
+    response = client.get('/api/dir_tree', query_string=params)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_roots(client, tree):
+    roots = get_tree(client)
+    assert [node['path'] for node in roots['children']] == [str(tree)]
+    assert roots['children'][0]['children'] is None # Fetched on demand
+    assert len(get_tree(client, depth=2)['children'][0]['children']) == 12
+
+
+def test_pages_follow_the_cursor(client, tree):
+    seen, cursor = [], None
+    while True:
+        page = get_tree(client, path=str(tree), limit=5, **({'cursor': cursor} if cursor else {}))
+        assert len(page['children']) <= 5
+        seen += [node['name'] for node in page['children']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+        assert cursor == seen[-1]
+    assert seen == [f"dir{i:02}" for i in range(12)] # In order, each once, and no files
+
+
+def test_depth_expands_levels_up_to_the_maximum(client, tree, monkeypatch):
+    def levels(node):
+        return 0 if not node['children'] else 1 + levels(node['children'][0])
+
+    first = lambda depth: get_tree(client, path=str(tree), depth=depth)['children'][0]
+    assert levels(first(1)) == 0
+    assert levels(first(2)) == 1
+    assert levels(first(3)) == 2
+    monkeypatch.setattr(main, 'DIR_TREE_MAX_DEPTH', 2)
+    assert levels(first(10)) == 1
+
+
+def test_unreadable_directories_are_shown_empty(client, tree, monkeypatch):
+    real_scandir = os.scandir
+    failures = {str(tree / 'dir03'): FileNotFoundError(errno.ENOENT, 'gone'),
+                str(tree / 'dir05'): OSError(errno.EIO, 'I/O error')}
+
+    def scandir(path='.'):
+        if str(path) in failures:
+            raise failures[str(path)]
+        return real_scandir(path)
+    monkeypatch.setattr(main.os, 'scandir', scandir)
+
+    children = {node['name']: node for node in get_tree(client, path=str(tree), depth=2)['children']}
+    assert children['dir03']['children'] == []
+    assert children['dir05']['children'] == []
+    assert [node['name'] for node in children['dir04']['children']] == ['sub']
+
+
+def test_bad_paths(client, tree, tmp_path):
+    assert client.get('/api/dir_tree', query_string={'path': str(tree / 'missing')}).status_code == 404
+    assert client.get('/api/dir_tree', query_string={'path': str(tmp_path)}).status_code == 403
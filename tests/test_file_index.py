@@ -0,0 +1,64 @@
+import os
+
+import main
+
+
+def walk_totals(directory):
+    size = files = dirs = 0
+    for _, dirnames, filenames in os.walk(directory):
+        dirs += len(dirnames)
+        files += len(filenames)
+        size += sum(os.path.getsize(os.path.join(_, name)) for name in filenames)
+    return size, files, dirs
+
+
+def make_tree(root):
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'c').mkdir()
+    (root / 'top.txt').write_bytes(b'x' * 10)
+    (root / 'a' / 'one.txt').write_bytes(b'x' * 100)
+    (root / 'a' / 'b' / 'two.txt').write_bytes(b'x' * 1000)
+    (root / 'c' / 'three.txt').write_bytes(b'x' * 5)
+
+
+def totals(path):
+    return main.file_index.dir_totals([str(path)])[str(path)]
+
+
+def test_rescan_rollups_match_disk(root):
+    make_tree(root)
+    main.file_index.rescan(main.index_roots())
+    for directory in (root / 'a', root / 'a' / 'b', root / 'c'):
+        assert totals(directory) == walk_totals(directory)
+
+
+def test_update_path_propagates_to_ancestors(root):
+    make_tree(root)
+    main.file_index.rescan(main.index_roots())
+    new = root / 'a' / 'b' / 'new.txt'
+    new.write_bytes(b'x' * 50)
+    main.file_index.update_path(str(new))
+    assert totals(root / 'a') == walk_totals(root / 'a')
+    assert totals(root / 'a' / 'b') == walk_totals(root / 'a' / 'b')
+
+    new.unlink()
+    main.file_index.update_path(str(new))
+    assert totals(root / 'a') == (1100, 2, 1)
+
+
+def test_partial_uploads_are_not_indexed(root, client):
+    make_tree(root)
+    partial = main.partial_path_for(str(root / 'a' / 'big.bin'), 'ab' * 32)
+    with open(partial, 'wb') as f:
+        f.write(b'x' * 4000)
+    main.file_index.rescan(main.index_roots())
+    main.file_index.update_path(partial)
+
+    assert totals(root / 'a') == (1100, 2, 1)
+    items = client.get('/api/search', query_string={'q': 'big'}).get_json()['items']
+    assert items == []
+
+    # An ordinary hidden file with the same suffix is still a file
+    (root / 'a' / '.notes.part').write_bytes(b'x')
+    main.file_index.update_path(str(root / 'a' / '.notes.part'))
+    assert totals(root / 'a') == (1101, 3, 1)
@@ -0,0 +1,96 @@
+import multiprocessing
+
+import pytest
+
+import main
+
+
+def add_to_counter(path, times):
+    store = main.JsonStore(path)
+    for _ in range(times):
+        with store.edit() as data:
+            data['count'] += 1
+
+
+def test_edits_from_several_processes_are_not_lost(tmp_path):
+    path = str(tmp_path / 'store.json')
+    main.JsonStore(path).save({'count': 0})
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=add_to_counter, args=(path, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    assert main.JsonStore(path).load() == {'count': 200}
+
+
+def test_save_replaces_the_file_atomically(tmp_path, monkeypatch):
+    path = tmp_path / 'store.json'
+    store = main.JsonStore(str(path))
+    store.save({'a': 1})
+    first_inode = path.stat().st_ino
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(main.json, 'dump', fail)
+    with pytest.raises(OSError):
+        store.save({'a': 2})
+    monkeypatch.undo()
+    assert main.json.loads(path.read_text()) == {'a': 1} # The old file is untouched
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['.store.json.lock', 'store.json'] # No temp file left behind
+
+    store.save({'a': 3})
+    assert path.stat().st_ino != first_inode # A new file renamed over the old one
+    assert main.JsonStore(str(path)).load() == {'a': 3}
+
+
+def test_load_sees_changes_from_other_writers(tmp_path):
+    path = str(tmp_path / 'store.json')
+    ours, theirs = main.JsonStore(path), main.JsonStore(path)
+    ours.save({'n': 1})
+    assert theirs.load() == {'n': 1}
+    for n in range(2, 5): # Several saves within one timestamp tick
+        ours.save({'n': n})
+        assert theirs.load() == {'n': n}
+
+
+def test_damaged_or_missing_file_falls_back_to_the_last_good_copy(tmp_path):
+    path = tmp_path / 'store.json'
+    store = main.JsonStore(str(path))
+    with pytest.raises(FileNotFoundError): # Nothing to fall back on yet
+        store.load()
+
+    store.save({'users': ['admin']})
+    path.write_text('{"users": [') # A bad hand edit
+    assert store.load() == {'users': ['admin']}
+    path.unlink()
+    assert store.load() == {'users': ['admin']}
+
+    with store.edit() as data: # An edit writes the file back
+        data['users'].append('bob')
+    assert main.JsonStore(str(path)).load() == {'users': ['admin', 'bob']}
+
+
+def test_edit_saves_only_changes(tmp_path):
+    path = tmp_path / 'store.json'
+    store = main.JsonStore(str(path))
+    store.save({'a': 1})
+    inode = path.stat().st_ino
+    with store.edit() as data:
+        assert data == {'a': 1}
+    assert path.stat().st_ino == inode # Nothing changed, nothing written
+
+    with store.edit() as data:
+        data['b'] = 2
+    assert store.load() == {'a': 1, 'b': 2}
+
+    loaded = store.load()
+    loaded['c'] = 3 # load() hands out a private copy
+    assert store.load() == {'a': 1, 'b': 2}
+
+    with pytest.raises(RuntimeError):
+        with store.edit() as data:
+            data['d'] = 4
+            raise RuntimeError
+    assert store.load() == {'a': 1, 'b': 2} # An edit that fails isn't saved
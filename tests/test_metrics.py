@@ -0,0 +1,122 @@
+import json
+import os
+import re
+import socket
+import time
+
+import pytest
+from werkzeug.wsgi import FileWrapper
+
+import main
+from conftest import login
+
+
+def sample(text, name, **labels):
+    """Value of the sample name{labels} in Prometheus text output, or None."""
+    label_set = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    pattern = re.escape(f"{name}{{{label_set}}}" if labels else name) + r' (\S+)$'
+    match = re.search(pattern, text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+
+def test_requests_are_counted(root, client):
+    (root / 'a.txt').write_bytes(b'x' * 5000)
+    for _ in range(3):
+        with client.get(f"/download{root}/a.txt") as response: # Counted once the body has been sent and closed
+            assert len(response.data) == 5000
+    text = client.get('/metrics').get_data(as_text=True)
+
+    assert '# TYPE fileserver_requests_total counter' in text
+    assert sample(text, 'fileserver_requests_total', method='GET', route='download_file', status=200) == 3
+    assert sample(text, 'fileserver_response_bytes_total', route='download_file', user='admin') == 15000
+    buckets = [float(count) for count in re.findall(
+        r'^fileserver_request_duration_seconds_bucket\{method="GET",route="download_file",le="[^"]+"\} (\S+)$', text, re.MULTILINE)]
+    assert len(buckets) == len(main.METRICS_LATENCY_BUCKETS) + 1
+    assert buckets == sorted(buckets) # Cumulative
+    assert buckets[-1] == sample(text, 'fileserver_request_duration_seconds_count', method='GET', route='download_file') == 3
+
+
+def test_metrics_need_an_admin_or_the_token(root):
+    anonymous = main.app.test_client()
+    assert anonymous.get('/metrics').status_code == 403
+    assert login('bob').get('/metrics').status_code == 403
+
+    config = main.get_config()
+    config['metrics_token'] = 'secret-token'
+    main.save_config(config)
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer secret-token'}).status_code == 200
+
+
+def write_worker_snapshot(pid, counters, age=0):
+    os.makedirs(main.METRICS_DIR, exist_ok=True)
+    path = os.path.join(main.METRICS_DIR, f"{pid}.json")
+    with open(path, 'w') as f:
+        json.dump({'counters': counters, 'gauges': [], 'histograms': []}, f)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_collect_adds_up_live_workers_and_drops_exited_ones(root):
+    main.metrics.inc('fileserver_zip_bytes_total', 100)
+    live = write_worker_snapshot(1_000_001, [['fileserver_zip_bytes_total', [], 50]])
+    exited = write_worker_snapshot(1_000_002, [['fileserver_zip_bytes_total', [], 7]], age=4 * main.METRICS_FLUSH_INTERVAL)
+
+    counters, gauges, _ = main.metrics.collect()
+    assert counters[('fileserver_zip_bytes_total', ())] == 150
+    assert gauges[('fileserver_workers', ())] == 2
+    assert os.path.exists(live)
+    assert not os.path.exists(exited)
+
+
+def sent_bytes(client, route='download_file'):
+    text = client.get('/metrics').get_data(as_text=True)
+    return sample(text, 'fileserver_response_bytes_total', route=route, user='admin'), \
+        sample(text, 'fileserver_active_streams', kind='file')
+
+
+@pytest.mark.parametrize('file_wrapper', [None, FileWrapper])
+def test_an_aborted_download_counts_only_what_was_sent(root, client, file_wrapper):
+    (root / 'big.bin').write_bytes(os.urandom(5 * main.STREAM_CHUNK_SIZE))
+    overrides = {'wsgi.file_wrapper': file_wrapper} if file_wrapper else {}
+    response = client.get(f"/download{root}/big.bin", environ_overrides=overrides)
+    assert response.content_length == 5 * main.STREAM_CHUNK_SIZE
+    body = iter(response.response)
+    first = next(body)
+    response.close() # The client went away
+    assert sent_bytes(client) == (len(first), 0)
+
+
+def test_a_sendfile_download_counts_what_the_socket_sent(root):
+    path = root / 'clip.bin'
+    path.write_bytes(os.urandom(20000))
+    counted = []
+    source = main.FileRange(path, 1000, 9000)
+    source.on_close = counted.append
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        assert sender.sendfile(source, offset=1000, count=3000) == 3000
+        assert receiver.recv(4000) == path.read_bytes()[1000:4000]
+    os.lseek(source.fileno(), 1000, os.SEEK_SET) # As gunicorn leaves it
+    source.close()
+    assert counted == [3000]
+
+
+def test_counted_body_closes_what_it_wraps(root):
+    class Body:
+        closed = False
+        def __iter__(self):
+            yield b'abc'
+            yield b'def'
+        def close(self):
+            self.closed = True
+
+    body = Body()
+    counted = main.CountedBody(body, 'download_file', 'admin')
+    assert next(iter(counted)) == b'abc'
+    counted.close()
+    counted.close()
+    assert body.closed
+    counters, _, _ = main.metrics.collect()
+    assert [value for (name, _), value in counters.items() if name == 'fileserver_response_bytes_total'] == [3]
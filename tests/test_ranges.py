@@ -0,0 +1,108 @@
+from urllib.parse import quote
+
+import pytest
+
+import main
+
+DATA = bytes(range(256)) * 40 # 10240 bytes
+
+
+@pytest.fixture
+def movie(root):
+    path = root / 'clip.bin'
+    path.write_bytes(DATA)
+    return path
+
+
+@pytest.mark.parametrize('route', ['/download', '/stream'])
+def test_whole_file(client, movie, route):
+    response = client.get(f'{route}{movie}')
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Content-Length'] == str(len(DATA))
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 100),
+    ('bytes=10000-', 10000, 10240),
+    ('bytes=-40', 10200, 10240),
+    ('bytes=10000-99999', 10000, 10240), # Clamped to the end of the file
+])
+def test_single_range(client, movie, header, start, end):
+    response = client.get(f'/stream{movie}', headers={'Range': header})
+    assert response.status_code == 206
+    assert response.data == DATA[start:end]
+    assert response.headers['Content-Range'] == f'bytes {start}-{end - 1}/{len(DATA)}'
+    assert response.headers['Content-Length'] == str(end - start)
+
+
+def test_multiple_ranges(client, movie):
+    response = client.get(f'/stream{movie}', headers={'Range': 'bytes=0-9,100-109'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary']
+    parts = response.data.split(f'--{boundary}'.encode())
+    assert parts[-1] == b'--\r\n'
+    bodies = [part.split(b'\r\n\r\n', 1) for part in parts[1:-1]]
+    assert b'Content-Range: bytes 0-9/10240' in bodies[0][0]
+    assert bodies[0][1] == DATA[0:10] + b'\r\n'
+    assert b'Content-Range: bytes 100-109/10240' in bodies[1][0]
+    assert bodies[1][1] == DATA[100:110] + b'\r\n'
+    assert int(response.headers['Content-Length']) == len(response.data)
+
+
+def test_unsatisfiable_range(client, movie):
+    response = client.get(f'/stream{movie}', headers={'Range': 'bytes=20000-30000'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_conditional_get(client, movie):
+    first = client.get(f'/download{movie}')
+    etag = first.headers['ETag']
+    assert client.get(f'/download{movie}', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(f'/download{movie}', headers={'If-Modified-Since': first.headers['Last-Modified']}).status_code == 304
+    assert client.get(f'/download{movie}', headers={'If-None-Match': '"something-else"'}).status_code == 200
+
+
+def test_if_range(client, movie):
+    etag = client.get(f'/stream{movie}').headers['ETag']
+    matching = client.get(f'/stream{movie}', headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert matching.status_code == 206
+    assert matching.data == DATA[:10]
+    stale = client.get(f'/stream{movie}', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert stale.status_code == 200
+    assert stale.data == DATA
+
+
+def test_changed_file_gets_a_new_etag(client, movie):
+    etag = client.get(f'/download{movie}').headers['ETag']
+    movie.write_bytes(DATA + b'more')
+    response = client.get(f'/download{movie}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.data == DATA + b'more'
+
+
+def test_outside_allowed_directories(client, tmp_path):
+    secret = tmp_path / 'secret.txt'
+    secret.write_bytes(b'nope')
+    assert client.get(f'/download{secret}').status_code == 403
+
+
+@pytest.mark.parametrize('name, header', [
+    ('clip.bin', 'attachment; filename="clip.bin"'),
+    ('say "hi"\\now.txt', 'attachment; filename="say \\"hi\\"\\\\now.txt"'),
+    ('tab\there.txt', "attachment; filename=\"tab_here.txt\"; filename*=UTF-8''tab%09here.txt"),
+    ('résumé.txt', "attachment; filename=\"r_sum_.txt\"; filename*=UTF-8''r%C3%A9sum%C3%A9.txt"),
+])
+def test_content_disposition(client, root, name, header):
+    (root / name).write_bytes(b'x')
+    response = client.get('/download' + quote(str(root / name)))
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == header
+
+
+def test_content_disposition_has_no_line_breaks():
+    header = main.content_disposition('a\r\nSet-Cookie: x=1.txt')
+    assert header == "attachment; filename=\"a__Set-Cookie: x=1.txt\"; filename*=UTF-8''a%0D%0ASet-Cookie%3A%20x%3D1.txt"
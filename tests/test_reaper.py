@@ -0,0 +1,69 @@
+import io
+import os
+import time
+import uuid
+
+import main
+
+
+def make_upload(size, age, now):
+    """A chunked upload in CHUNK_DIR whose last chunk arrived age seconds before now."""
+    upload_id = uuid.uuid4().hex
+    directory = os.path.join(main.CHUNK_DIR, upload_id[:2], upload_id)
+    os.makedirs(directory)
+    chunk = os.path.join(directory, '0')
+    with open(chunk, 'wb') as f:
+        f.write(os.urandom(size))
+    for path in (chunk, directory):
+        os.utime(path, (now - age, now - age))
+    return directory
+
+
+def test_sweep_expires_uploads_past_the_ttl(root):
+    now = time.time()
+    stale = make_upload(10, main.UPLOAD_SESSION_TTL + 60, now)
+    fresh = make_upload(10, main.UPLOAD_SESSION_TTL - 60, now)
+    main.upload_reaper.sweep(now)
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+    stats = main.upload_reaper.stats()
+    assert stats['expired'] == 1
+    assert stats['uploads'] == 1
+
+
+def test_sweep_evicts_the_least_recently_active_over_budget(root, monkeypatch):
+    now = time.time()
+    oldest = make_upload(100_000, 3 * 3600, now)
+    older = make_upload(100_000, 2 * 3600, now)
+    recent = make_upload(100_000, 60, now)
+    monkeypatch.setattr(main, 'UPLOAD_SCRATCH_BUDGET', 150_000)
+    main.upload_reaper.sweep(now)
+    assert not os.path.exists(oldest)
+    assert not os.path.exists(older)
+    assert os.path.exists(recent)
+
+    # Active uploads stay even when they alone are over budget
+    monkeypatch.setattr(main, 'UPLOAD_SCRATCH_BUDGET', 0)
+    main.upload_reaper.sweep(now)
+    assert os.path.exists(recent)
+    assert main.upload_reaper.stats()['evicted'] == 2
+
+
+class SweepingStream(io.BytesIO):
+    """Request body that runs a sweep while it is being read, as another worker's reaper might."""
+
+    def read(self, size=-1):
+        if self.tell() == 0:
+            main.upload_reaper.sweep()
+        return super().read(size)
+
+
+def test_sweep_spares_an_upload_whose_first_chunk_is_still_arriving(root, monkeypatch):
+    monkeypatch.setattr(main, 'UPLOAD_SCRATCH_BUDGET', 0)
+    data = os.urandom(1000)
+    target = root / 'big.bin'
+    upload = main.UploadSession(uuid.uuid4().hex, None, 2, partial_path=main.partial_path_for(str(target), uuid.uuid4().hex),
+                                chunk_size=len(data), file_size=2 * len(data))
+    upload.store_chunk(0, SweepingStream(data))
+    assert os.path.exists(upload.manifest_path)
+    assert upload.missing_ranges() == [[1, 1]]
@@ -0,0 +1,80 @@
+import pytest
+
+import main
+from conftest import login
+
+
+@pytest.fixture
+def indexed(root, tmp_path):
+    """root holds bob's files; private is only allowed to admins."""
+    private = tmp_path / 'private'
+    private.mkdir()
+    config = main.get_config()
+    config['allowed_directories'].append(str(private))
+    main.save_config(config)
+    (root / 'docs').mkdir()
+    for i in range(25):
+        (root / 'docs' / f"report-{i:02}.txt").write_bytes(b'x' * i)
+    (root / 'ab.md').write_bytes(b'short')
+    (private / 'report-secret.txt').write_bytes(b'secret')
+    (private / 'ab-private.md').write_bytes(b'secret')
+    main.file_index.rescan(main.index_roots())
+    return root, private
+
+
+def search(client, **args):
+    response = client.get('/api/search', query_string=args)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def names(result):
+    return [item['name'] for item in result['items']]
+
+
+def test_results_stay_inside_the_users_directories(indexed):
+    root, private = indexed
+    bob, admin = login('bob'), login('admin')
+    assert 'report-secret.txt' not in names(search(bob, q='report', limit=1000))
+    assert 'report-secret.txt' in names(search(admin, q='report', limit=1000))
+    assert all(item['path'].startswith(str(root) + '/') for item in search(bob, limit=1000)['items'])
+    assert bob.get('/api/search', query_string={'q': 'report', 'path': str(private)}).status_code == 403
+    assert names(search(admin, q='report', path=str(private))) == ['report-secret.txt']
+
+
+def test_empty_and_short_queries(indexed):
+    root, _ = indexed
+    bob = login('bob')
+    everything = search(bob, limit=1000)
+    assert len(everything['items']) == 25 + 2 # Files plus the docs directory
+    assert everything['next_offset'] is None
+    assert names(search(bob, q='ab')) == ['ab.md'] # Too short for the trigram index; matched with LIKE
+    assert names(search(bob, q='b.m')) == ['ab.md']
+    assert names(search(bob, q='report 07')) == ['report-07.txt']
+    assert names(search(bob, q='nothing-like-this')) == []
+    assert names(search(bob, q='%')) == [] # LIKE wildcards are matched literally
+
+
+def test_pagination_walks_every_result_once(indexed):
+    bob = login('bob')
+    seen, offset = [], 0
+    while offset is not None:
+        page = search(bob, q='report', limit=10, offset=offset)
+        assert page['offset'] == offset
+        assert len(page['items']) <= 10
+        seen += names(page)
+        offset = page['next_offset']
+    assert seen == [f"report-{i:02}.txt" for i in range(25)]
+    assert search(bob, q='report', offset=100)['items'] == []
+
+
+@pytest.mark.parametrize('args', [{'limit': 0}, {'limit': 'ten'}, {'offset': -1}, {'offset': '1.5'}, {'kind': 'link'}])
+def test_invalid_parameters_are_refused(indexed, args):
+    assert login('bob').get('/api/search', query_string=dict(args, q='report')).status_code == 400
+
+
+def test_limit_is_capped(indexed, monkeypatch):
+    monkeypatch.setattr(main, 'SEARCH_MAX_PAGE_SIZE', 5)
+    page = search(login('bob'), q='report', limit=1000)
+    assert len(page['items']) == 5
+    assert page['next_offset'] == 5
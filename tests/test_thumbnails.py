@@ -0,0 +1,56 @@
+import io
+import time
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(main.Image is None, reason='Pillow is not installed')
+
+
+@pytest.fixture
+def thumbnails(root, monkeypatch):
+    cache = main.ThumbnailCache(main.THUMBNAIL_DIR)
+    monkeypatch.setattr(main, 'thumbnails', cache)
+    yield cache
+    if cache.pool is not None:
+        cache.pool.shutdown()
+
+
+def settled(cache):
+    """The cache's stats once its done callbacks, which run just after a render's waiters wake, have caught up."""
+    deadline = time.monotonic() + 5
+    while cache.stats()['rendering'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return cache.stats()
+
+
+def write_png(path, size):
+    main.Image.new('RGB', size, (200, 30, 30)).save(path, 'PNG')
+
+
+def test_preview_is_rendered_once_and_cached(root, client, thumbnails):
+    write_png(root / 'photo.png', (800, 400))
+    for _ in range(2):
+        response = client.get(f"/thumbnail{root}/photo.png")
+        assert response.status_code == 200
+        with main.Image.open(io.BytesIO(response.data)) as image:
+            assert image.format == main.THUMBNAIL_FORMAT
+            assert image.size == (main.THUMBNAIL_SIZES['small'], main.THUMBNAIL_SIZES['small'] // 2)
+    assert settled(thumbnails)['renders'] == 1
+
+    response = client.get(f"/thumbnail{root}/photo.png?size=large&v=1")
+    with main.Image.open(io.BytesIO(response.data)) as image:
+        assert image.size == (800, 400) # Never enlarged
+    assert response.cache_control.max_age == main.THUMBNAIL_MAX_AGE
+
+
+def test_preview_errors(root, client, thumbnails):
+    (root / 'notes.txt').write_text('hello')
+    (root / 'broken.png').write_bytes(b'not a png')
+    write_png(root / 'photo.png', (10, 10))
+    assert client.get(f"/thumbnail{root}/notes.txt").status_code == 404
+    assert client.get(f"/thumbnail{root}/photo.png?size=huge").status_code == 400
+    assert client.get(f"/thumbnail{root}/broken.png").status_code == 415
+    assert settled(thumbnails)['failures'] == 1
+    assert client.get(f"/thumbnail{root.parent}/elsewhere.png").status_code == 403
@@ -0,0 +1,240 @@
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+
+import main
+from conftest import login
+
+CHUNK_SIZE = 1000
+DATA = os.urandom(3500)
+CHUNKS = [DATA[i:i + CHUNK_SIZE] for i in range(0, len(DATA), CHUNK_SIZE)]
+
+
+def upload_fields(root, upload_id):
+    return {'upload_id': upload_id, 'total_chunks': len(CHUNKS), 'file_size': len(DATA),
+            'chunk_size': CHUNK_SIZE, 'filename': 'up.bin', 'target_dir': str(root)}
+
+
+def send_chunk(client, fields, index):
+    return client.post('/upload', data=dict(fields, chunk_index=index, file=(io.BytesIO(CHUNKS[index]), 'blob')),
+                       content_type='multipart/form-data')
+
+
+def test_upload_resumes_from_the_manifest_after_a_restart(client, root, monkeypatch):
+    fields = upload_fields(root, uuid.uuid4().hex)
+    for index in (0, 2):
+        assert send_chunk(client, fields, index).status_code == 200
+
+    monkeypatch.setattr(main, 'upload_sessions', {}) # The server restarted; only the files on disk are left
+    status = client.get('/upload/status', query_string=fields).get_json()
+    assert status['received'] == 2
+    assert status['missing'] == [[1, 1], [3, 3]]
+
+    for index in (1, 3):
+        assert send_chunk(client, fields, index).status_code == 200
+    response = client.post('/upload/finalize', data=dict(fields, file_hash=hashlib.sha256(DATA).hexdigest()))
+    assert response.status_code == 200, response.get_json()
+    assert (root / 'up.bin').read_bytes() == DATA
+    assert not any(name.startswith('.up.bin') for name in os.listdir(root))
+
+
+def test_finalize_refuses_a_wrong_hash(client, root):
+    fields = upload_fields(root, uuid.uuid4().hex)
+    for index in range(len(CHUNKS)):
+        send_chunk(client, fields, index)
+    response = client.post('/upload/finalize', data=dict(fields, file_hash='0' * 64))
+    assert response.status_code == 500
+    assert not (root / 'up.bin').exists()
+
+
+def test_finalize_reports_missing_chunks(client, root):
+    fields = upload_fields(root, uuid.uuid4().hex)
+    send_chunk(client, fields, 1)
+    response = client.post('/upload/finalize', data=dict(fields, file_hash=hashlib.sha256(DATA).hexdigest()))
+    assert response.status_code == 409
+    assert response.get_json()['missing'] == [[0, 0], [2, 3]]
+
+
+def new_session(upload_id):
+    return main.UploadSession(upload_id, None, len(CHUNKS))
+
+
+def test_sessions_in_two_workers_share_the_manifest(root):
+    upload_id = uuid.uuid4().hex
+    first, second = new_session(upload_id), new_session(upload_id) # As if held by two worker processes
+    assert not first.store_chunk(0, io.BytesIO(CHUNKS[0]))
+    assert not second.store_chunk(1, io.BytesIO(CHUNKS[1]))
+    assert not first.store_chunk(2, io.BytesIO(CHUNKS[2]))
+    assert first.received == 3 # Picked up the chunk the other worker recorded
+    assert not second.store_chunk(0, io.BytesIO(CHUNKS[0])) # Already recorded by the other worker
+    assert second.store_chunk(3, io.BytesIO(CHUNKS[3])) # Only the call that completes the upload returns True
+    assert new_session(upload_id).missing_ranges() == []
+
+
+def test_chunk_requests_only_read_the_bitmap_after_other_writers(client, root, monkeypatch):
+    merges = []
+    real_merge = main.UploadSession._merge
+    monkeypatch.setattr(main.UploadSession, '_merge', lambda self, f: merges.append(1) or real_merge(self, f))
+    total_chunks = 50
+    fields = {'upload_id': uuid.uuid4().hex, 'total_chunks': total_chunks, 'file_size': total_chunks,
+              'chunk_size': 1, 'filename': 'many.bin', 'target_dir': str(root)}
+
+    def send(index):
+        response = client.post('/upload', data=dict(fields, chunk_index=index, file=(io.BytesIO(b'x'), 'blob')),
+                               content_type='multipart/form-data')
+        assert response.status_code == 200
+
+    for index in range(total_chunks - 10):
+        send(index)
+    assert len(merges) <= 1 # Only when the manifest is first created
+
+    # Another worker records chunks; the next request picks them up with one merge
+    other = main.UploadSession(fields['upload_id'], None, total_chunks, partial_path=main.partial_path_for(str(root / 'many.bin'), fields['upload_id']),
+                               chunk_size=1, file_size=total_chunks)
+    for index in range(total_chunks - 10, total_chunks - 5):
+        other.store_chunk(index, io.BytesIO(b'x'))
+    merges.clear()
+    for index in range(total_chunks - 5, total_chunks):
+        send(index)
+    assert len(merges) == 1
+    status = client.get('/upload/status', query_string=fields).get_json()
+    assert status['received'] == total_chunks
+
+
+def test_upload_size_limits(client, root):
+    fields = upload_fields(root, uuid.uuid4().hex)
+    too_many = dict(fields, total_chunks=20_000_000, file_size=20_000_000, chunk_size=1)
+    assert client.get('/upload/status', query_string=too_many).status_code == 400
+    too_big = dict(fields, file_size=main.app.config['MAX_CONTENT_LENGTH'] + 1, chunk_size=2 ** 30)
+    too_big['total_chunks'] = -(-too_big['file_size'] // too_big['chunk_size'])
+    assert client.get('/upload/status', query_string=too_big).status_code == 400
+    wrong_count = dict(fields, total_chunks=len(CHUNKS) + 1)
+    assert client.get('/upload/status', query_string=wrong_count).status_code == 400
+    assert send_chunk(client, wrong_count, 0).status_code == 400
+    assert main.upload_sessions == {}
+
+
+def test_upload_to_a_forbidden_directory_creates_no_session(root, tmp_path):
+    client = login('bob')
+    fields = upload_fields(tmp_path, uuid.uuid4().hex) # Outside bob's directory
+    assert client.get('/upload/status', query_string=fields).status_code == 403
+    assert send_chunk(client, fields, 0).status_code == 403
+    response = client.post('/upload/finalize', data=dict(fields, file_hash=hashlib.sha256(DATA).hexdigest()))
+    assert response.status_code == 403
+    assert main.upload_sessions == {}
+    assert not os.path.exists(main.CHUNK_DIR) or not os.listdir(main.CHUNK_DIR)
+
+
+def test_idle_and_reaped_sessions_are_forgotten(client, root, monkeypatch):
+    idle = upload_fields(root, uuid.uuid4().hex)
+    client.get('/upload/status', query_string=idle)
+    reaped = upload_fields(root, uuid.uuid4().hex)
+    send_chunk(client, reaped, 0)
+    assert len(main.upload_sessions) == 2
+
+    main.forget_idle_upload_sessions()
+    assert len(main.upload_sessions) == 2 # Both still in use
+    main.forget_idle_upload_sessions(time.time() + main.UPLOAD_SESSION_IDLE + 1)
+    assert main.upload_sessions == {}
+
+    send_chunk(client, reaped, 0)
+    monkeypatch.setattr(main, 'UPLOAD_SESSION_TTL', -1) # Everything has expired
+    main.upload_reaper.sweep()
+    assert main.upload_sessions == {}
+    status = client.get('/upload/status', query_string=reaped).get_json()
+    assert status['received'] == 0 # Starts over
+
+
+def upload_whole_file(client, root):
+    fields = upload_fields(root, uuid.uuid4().hex)
+    for index in range(len(CHUNKS)):
+        send_chunk(client, fields, index)
+    response = client.post('/upload/finalize', data=dict(fields, file_hash=hashlib.sha256(DATA).hexdigest()))
+    assert response.status_code == 200
+
+
+def check_duplicate(client, root):
+    (root / 'copy').mkdir(exist_ok=True)
+    response = client.post('/upload/check', data={'filename': 'up.bin', 'target_dir': str(root / 'copy'),
+                                                  'file_size': len(DATA), 'file_hash': hashlib.sha256(DATA).hexdigest()})
+    assert response.get_json()['complete']
+    return response.get_json()['deduplicated']
+
+
+def test_duplicate_upload_is_an_independent_copy(client, root):
+    upload_whole_file(client, root)
+    assert check_duplicate(client, root) in ('reflink', 'copy')
+    assert (root / 'copy' / 'up.bin').read_bytes() == DATA
+    with open(root / 'up.bin', 'r+b') as f:
+        f.write(b'changed')
+    assert (root / 'copy' / 'up.bin').read_bytes() == DATA
+
+
+def test_duplicate_upload_hardlinks_when_enabled(client, root, monkeypatch):
+    monkeypatch.setattr(main, 'DEDUP_HARDLINKS', True)
+    monkeypatch.setattr(main, 'reflink', lambda source, target_path: False)
+    upload_whole_file(client, root)
+    assert check_duplicate(client, root) == 'hardlink'
+    assert os.path.samefile(root / 'up.bin', root / 'copy' / 'up.bin')
+
+
+def test_too_many_uploads_in_flight_get_429_per_user(root, monkeypatch):
+    monkeypatch.setattr(main, 'MAX_UPLOAD_STREAMS_PER_USER', 2)
+    started, release = threading.Semaphore(0), threading.Event()
+    upload_from_request = main.upload_from_request
+
+    def held(fields):
+        started.release()
+        release.wait(10)
+        return upload_from_request(fields)
+    monkeypatch.setattr(main, 'upload_from_request', held)
+
+    bobs = [login('bob') for _ in range(3)]
+    fields = [upload_fields(root, uuid.uuid4().hex) for _ in range(3)]
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(send_chunk(bobs[i], fields[i], 0).status_code))
+               for i in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in threads:
+            assert started.acquire(timeout=10)
+        assert main.upload_streams == {'bob': 2}
+
+        response = send_chunk(bobs[2], fields[2], 0)
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '1'
+
+        monkeypatch.setattr(main, 'upload_from_request', upload_from_request)
+        admin = login('admin')
+        assert send_chunk(admin, upload_fields(root, uuid.uuid4().hex), 0).status_code == 200 # Only bob is at the limit
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+    assert results == [200, 200]
+    assert main.upload_streams == {}
+    assert send_chunk(bobs[2], fields[2], 0).status_code == 200
+
+
+def test_chunk_with_a_wrong_hash_is_refused_and_not_recorded(client, root):
+    in_place = upload_fields(root, uuid.uuid4().hex)
+    file_hash = hashlib.sha256(DATA).hexdigest()
+    chunk_files = {'file_hash': file_hash, 'total_chunks': len(CHUNKS), 'filename': 'up2.bin', 'target_dir': str(root)}
+    for fields in (in_place, chunk_files):
+        bad = dict(fields, chunk_index=1, chunk_hash='0' * 64, file=(io.BytesIO(CHUNKS[1]), 'blob'))
+        response = client.post('/upload', data=bad, content_type='multipart/form-data')
+        assert response.status_code == 400
+        assert 'hash mismatch' in response.get_json()['message']
+        assert client.get('/upload/status', query_string=fields).get_json()['missing'] == [[0, 3]]
+
+    main.upload_sessions.clear() # Nor in the manifest a restarted worker would read
+    for fields in (in_place, chunk_files):
+        assert client.get('/upload/status', query_string=fields).get_json()['missing'] == [[0, 3]]
+        good = dict(fields, chunk_index=1, chunk_hash=hashlib.sha256(CHUNKS[1]).hexdigest(), file=(io.BytesIO(CHUNKS[1]), 'blob'))
+        assert client.post('/upload', data=good, content_type='multipart/form-data').status_code == 200
+        assert client.get('/upload/status', query_string=fields).get_json()['missing'] == [[0, 0], [2, 3]]
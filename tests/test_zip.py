@@ -0,0 +1,62 @@
+import io
+import zipfile
+
+import pytest
+
+import main
+
+
+def make_folder(root):
+    folder = root / 'album'
+    (folder / 'sub').mkdir(parents=True)
+    (folder / 'a.txt').write_bytes(b'a' * 5000)
+    (folder / 'sub' / 'b.bin').write_bytes(bytes(range(256)) * 100)
+    return folder
+
+
+def test_download_folder_is_a_valid_zip(client, root):
+    folder = make_folder(root)
+    response = client.get(f'/download_folder{folder}')
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+        assert zf.testzip() is None
+        assert zf.read('a.txt') == b'a' * 5000
+        assert zf.read('sub/b.bin') == bytes(range(256)) * 100
+
+
+def test_unreadable_file_is_skipped(root, monkeypatch):
+    folder = make_folder(root)
+    real_open = open
+
+    def failing_open(path, *args, **kwargs):
+        if str(path).endswith('a.txt'):
+            raise PermissionError(13, 'Permission denied', str(path))
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(main, 'open', failing_open, raising=False)
+    archive = b''.join(main.generate_zip(str(folder)))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.namelist() == ['sub/', 'sub/b.bin']
+        assert zf.testzip() is None
+
+
+def test_read_error_mid_entry_aborts_the_archive(root, monkeypatch):
+    folder = make_folder(root)
+    real_open = open
+
+    class FailingFile(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise OSError(5, 'Input/output error')
+            return super().read(100)
+
+    def failing_open(path, *args, **kwargs):
+        if str(path).endswith('a.txt'):
+            return FailingFile(b'a' * 5000)
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(main, 'open', failing_open, raising=False)
+    chunks = main.generate_zip(str(folder))
+    with pytest.raises(OSError):
+        for chunk in chunks:
+            pass